@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# Cold-start benchmark of the Blossom-S3-Watcher Lambda:
+# import (init phase) + first invoke + warm invoke, each in a FRESH interpreter.
+# AWS endpoints are stubbed at the botocore 'before-send' hook, so the whole
+# client construction, request serialization and response parsing is measured,
+# but nothing leaves the machine.
+#
+# Usage:
+#   python bench-cold-start.py [--runs 20] [--records 1]
+import argparse
+import importlib.util
+import io
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+WATCHER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blossom-s3-watcher.py')
+### ops_request.py is deployed next to the watcher in the Lambda package
+OPS_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ec2', 'ops', 'src')
+
+STUB_ENV = {
+    'AWS_ACCESS_KEY_ID': 'bench',
+    'AWS_SECRET_ACCESS_KEY': 'bench',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'BLOSSOM_REGION': 'us-east-1',
+    'S3_AKID_VALUE': 'bench',
+    'S3_SAK_VALUE': 'bench',
+    'EC2_INSTANCE_ID': 'i-0123456789abcdef0',
+    'WORK_DIR': '/home/ec2-user/b@-ops',
+    'SSM_WAIT_MODE': 'poll',
+    'SSM_POLL_FIRST_DELAY': '0.001',
+}
+
+REQUEST_FILE = b'branch_name: account-request\nfile: ato/created_users/bench_created_user.yaml\nissue_number: 1\n'
+
+STUB_RESPONSES = {
+    'GetObject': (
+        {'Content-Type': 'text/plain', 'Content-Length': str(len(REQUEST_FILE)), 'ETag': '"bench"'},
+        REQUEST_FILE),
+    'SendCommand': (
+        {'Content-Type': 'application/x-amz-json-1.1'},
+        b'{"Command": {"CommandId": "00000000-0000-4000-8000-000000000000"}}'),
+    'GetCommandInvocation': (
+        {'Content-Type': 'application/x-amz-json-1.1'},
+        b'{"Status": "Success", "StandardOutputContent": "bench"}'),
+    'StartInstances': (
+        {'Content-Type': 'text/xml'},
+        b'<StartInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+        b'<requestId>bench</requestId><instancesSet/></StartInstancesResponse>'),
+    'DescribeInstances': (
+        {'Content-Type': 'text/xml'},
+        b'<DescribeInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+        b'<requestId>bench</requestId><reservationSet><item><reservationId>r-bench</reservationId>'
+        b'<instancesSet><item><instanceId>i-0123456789abcdef0</instanceId>'
+        b'<instanceState><code>16</code><name>running</name></instanceState>'
+        b'</item></instancesSet></item></reservationSet></DescribeInstancesResponse>'),
+    'CreateTags': (
+        {'Content-Type': 'text/xml'},
+        b'<CreateTagsResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+        b'<requestId>bench</requestId><return>true</return></CreateTagsResponse>'),
+    'DescribeInstanceInformation': (
+        {'Content-Type': 'application/x-amz-json-1.1'},
+        b'{"InstanceInformationList": [{"InstanceId": "i-0123456789abcdef0", "PingStatus": "Online"}]}'),
+    'ListCommands': (
+        {'Content-Type': 'application/x-amz-json-1.1'},
+        b'{"Commands": []}'),
+    'StopInstances': (
+        {'Content-Type': 'text/xml'},
+        b'<StopInstancesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">'
+        b'<requestId>bench</requestId><instancesSet/></StopInstancesResponse>'),
+}
+# -----------------------------------------------------------------------------
+
+
+class BenchContext:
+    aws_request_id = 'bench'
+
+    def get_remaining_time_in_millis(self) -> int:
+        return 60000
+# -----------------------------------------------------------------------------
+
+
+def make_event(records: int, version: str = '') -> dict:
+    return {'Records': [
+        {   'eventName': 'ObjectCreated:Put',
+            's3': { 'bucket': {'name': 'b-blossom-bench'},
+                    'object': {'key': f'bench-{index}.txt', 'eTag': f'bench{version}-{index}'}}}
+        for index in range(records)
+    ]}
+# -----------------------------------------------------------------------------
+
+
+def stub_endpoints(boto3) -> None:
+    """ Answers every AWS call of the default session from STUB_RESPONSES
+    """
+    from botocore.awsrequest import AWSResponse
+
+    class RawBody(io.BytesIO):
+        ### Streaming operations (S3 GetObject) read() it, the others stream() it
+        def stream(self, **kwargs):
+            yield self.getvalue()
+
+    def fake_send(request, event_name: str = '', **kwargs):
+        operation = event_name.split('.')[-1]
+        headers, body = STUB_RESPONSES[operation]
+        return AWSResponse(request.url, 200, headers, RawBody(body))
+
+    boto3.setup_default_session()
+    boto3.DEFAULT_SESSION.events.register('before-send', fake_send)
+# -----------------------------------------------------------------------------
+
+
+def run_child(records: int) -> dict:
+    """ One cold start: runs in its own interpreter
+    """
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    sys.path.insert(0, OPS_SRC)
+    t_start = time.perf_counter()
+    spec = importlib.util.spec_from_file_location('blossom_s3_watcher', WATCHER_FILE)
+    watcher = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(watcher)
+    t_import = time.perf_counter()
+
+    stub_endpoints(sys.modules['boto3'])
+    sys.stdout = devnull     ### The handler logs are not part of the measure
+    try:
+        t_stub = time.perf_counter()
+        watcher.lambda_handler(make_event(records), BenchContext())
+        t_first = time.perf_counter()
+        ### New versions of the files, not de-duplicated
+        watcher.lambda_handler(make_event(records, '-warm'), BenchContext())
+        t_warm = time.perf_counter()
+    finally:
+        sys.stdout = stdout
+    return {
+        'import_ms': (t_import - t_start) * 1000,
+        'first_invoke_ms': (t_first - t_stub) * 1000,
+        'warm_invoke_ms': (t_warm - t_first) * 1000,
+    }
+# -----------------------------------------------------------------------------
+
+
+def run_parent(runs: int, records: int) -> None:
+    env = {**os.environ, **STUB_ENV}
+    samples = []
+    for _ in range(runs):
+        proc = subprocess.run(
+            [sys.executable, __file__, '--child', '--records', str(records)],
+            env=env, encoding='utf-8', stdout=subprocess.PIPE, check=True)
+        samples.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    print(f'{runs} cold starts, {records} record(s) per event [ms]')
+    print(f'{"phase":<18}{"min":>10}{"median":>10}{"p90":>10}{"max":>10}')
+    for phase in ('import_ms', 'first_invoke_ms', 'warm_invoke_ms'):
+        values = sorted(sample[phase] for sample in samples)
+        p90 = values[min(len(values) - 1, int(round(0.9 * (len(values) - 1))))]
+        print(f'{phase:<18}{values[0]:>10.1f}{statistics.median(values):>10.1f}{p90:>10.1f}{values[-1]:>10.1f}')
+# -----------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Blossom-S3-Watcher cold-start benchmark')
+    parser.add_argument('--runs', type=int, default=20, help='Number of fresh interpreters')
+    parser.add_argument('--records', type=int, default=1, help='S3 records per event')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        print(json.dumps(run_child(args.records)))
+    else:
+        run_parent(args.runs, args.records)
@@ -1,9 +1,19 @@
+import bisect
+import hashlib
 import json
 import logging
+import math
 import boto3
+from botocore.config import Config
 import time
 import os
-from pprint import pprint
+import shlex
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import unquote_plus
+### Request-file codec shared with the EC2 ops (automation/ec2/ops/src/ops_request.py)
+from ops_request import RequestFormatError, parse_request, validate_request
 
 ### Ideally - these values should be in SecretManager, 
 ### but it would increase the budget for this RESEARCH project
@@ -16,24 +26,324 @@ USER_DIR = os.environ.get('USER_DIR')
 REPO_SSH = os.environ.get('REPO_SSH')
 #------------------------------------------------
 dGIT_PATH = os.environ.get('dGit_DIR') 
+#------------------------------------------------
+### 'async' - return as soon as SSM accepted the command, the completion 
+###           is reported by command_status_handler (EventBridge SSM rule)
+### 'poll'  - wait for the command within the Lambda remaining time
+SSM_WAIT_MODE = os.environ.get('SSM_WAIT_MODE', 'poll')
+SSM_POLL_FIRST_DELAY = float(os.environ.get('SSM_POLL_FIRST_DELAY', '0.5'))  # Seconds
+SSM_POLL_MAX_DELAY = float(os.environ.get('SSM_POLL_MAX_DELAY', '8'))        # Seconds
+SSM_POLL_SAFETY_MS = int(os.environ.get('SSM_POLL_SAFETY_MS', '3000'))       # Left for the Lambda to finish
+SSM_POLL_MAX_WAIT = float(os.environ.get('SSM_POLL_MAX_WAIT', '90'))         # Seconds, if no Lambda context
+SSM_EXEC_TIMEOUT = os.environ.get('SSM_EXEC_TIMEOUT', '99')                   # Seconds, on the EC2 side
+SSM_PENDING_STATUSES = ('Pending', 'InProgress', 'Delayed')
+#------------------------------------------------
+S3_MAX_REQUEST_BYTES = int(os.environ.get('S3_MAX_REQUEST_BYTES', '65536'))  # Request files are few lines
+S3_REJECT_BUCKET = os.environ.get('S3_REJECT_BUCKET')                        # Invalid request files are moved here
+LOG_MAX_CHARS = int(os.environ.get('LOG_MAX_CHARS', '2048'))                 # Per logged value
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'Blossom/S3Watcher')  # CloudWatch EMF namespace
+METRICS_SERVICE = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'blossom-s3-watcher')
 
 
-# Create client instance for S3 Bucket
-s3_bucket='aws:s3:::b-blossom-nist-gate'
-s3_client = boto3.client(
-    's3',
-    aws_access_key_id = S3_AKID,
-    aws_secret_access_key = S3_SAK
-    )
-    
+CLIENT_POOL_SIZE = int(os.environ.get('CLIENT_POOL_SIZE', '10'))           # Connections per client
+CLIENT_CONNECT_TIMEOUT = float(os.environ.get('CLIENT_CONNECT_TIMEOUT', '5'))   # Seconds
+CLIENT_READ_TIMEOUT = float(os.environ.get('CLIENT_READ_TIMEOUT', '30'))        # Seconds
+#------------------------------------------------
+WORKER_READY_TIMEOUT = float(os.environ.get('WORKER_READY_TIMEOUT', '240'))  # Seconds to wait for EC2+SSM-agent
+WORKER_IDLE_WINDOW = int(os.environ.get('WORKER_IDLE_WINDOW', '900'))        # Seconds without work before the stop
+WORKER_ACTIVITY_TAG = os.environ.get('WORKER_ACTIVITY_TAG', 'blossom:last-activity')
+S3_DROP_BUCKET = os.environ.get('S3_DROP_BUCKET')                            # Queue of requests for the idle check
+#------------------------------------------------
+SHARD_KEY = os.environ.get('SHARD_KEY', 'branch_name')        # Request-file field routing it to a worker
+SHARD_VNODES = int(os.environ.get('SHARD_VNODES', '64'))      # Virtual nodes per worker on the hash ring
+SHARD_LOAD_FACTOR = float(os.environ.get('SHARD_LOAD_FACTOR', '1.25'))  # Max worker load vs. the average
+#------------------------------------------------
+### S3 notifications are at-least-once: the same bucket/key/version is dispatched once per TTL
+DEDUP_TTL = int(os.environ.get('DEDUP_TTL', '86400'))            # Seconds, 0 turns de-duplication off
+DEDUP_LEASE = int(os.environ.get('DEDUP_LEASE', '900'))          # Seconds an in-flight claim holds, ~ the Lambda timeout
+DEDUP_TABLE = os.environ.get('DEDUP_TABLE')                      # DynamoDB table (hash key: dedup_key)
+DEDUP_SQLITE = os.environ.get('DEDUP_SQLITE')                    # Local stand-in, e.g. /tmp/dedup.sqlite
+#------------------------------------------------
+### Cross-invocation batching: the request files are buffered and dispatched together
+### once the oldest one waited BATCH_WINDOW seconds or BATCH_MAX_FILES are buffered
+BATCH_WINDOW = float(os.environ.get('BATCH_WINDOW', '0'))        # Seconds, 0 dispatches every event at once
+BATCH_MAX_FILES = int(os.environ.get('BATCH_MAX_FILES', '20'))   # Buffered files forcing the dispatch
+BATCH_TABLE = os.environ.get('BATCH_TABLE')                      # DynamoDB table (hash key: item_key)
+BATCH_SQLITE = os.environ.get('BATCH_SQLITE')                    # Local stand-in, e.g. /tmp/batch.sqlite
 
-# Create client instance for EC2 Instance
+
+s3_bucket='aws:s3:::b-blossom-nist-gate'
 # The EC2 Target ID: 'i-033da04a63408423f'
 ec2_instances = [EC2_ID] # Array in case DHS wants to split their members to different EC2 instances
-ec2_client = boto3.client('ec2', region_name=OUR_REGION)
+if os.environ.get('EC2_INSTANCE_IDS'): # Comma-separated list of the workers to shard the requests to
+    ec2_instances = [id.strip() for id in os.environ['EC2_INSTANCE_IDS'].split(',') if id.strip()]
+
+### Clients are built on the first use and live as long as the Lambda container,
+### so the init phase pays nothing and e.g. ObjectRemoved never builds s3/ssm clients
+_CLIENTS = {}
+
+def get_client_config() -> Config:
+    return Config(
+        max_pool_connections=CLIENT_POOL_SIZE,
+        tcp_keepalive=True,
+        connect_timeout=CLIENT_CONNECT_TIMEOUT,
+        read_timeout=CLIENT_READ_TIMEOUT,
+        retries={'mode': 'standard', 'max_attempts': 3},
+    )
+
+_CLIENT_FACTORIES = {
+    # Create client instance for S3 Bucket
+    's3': lambda: boto3.client(
+        's3',
+        aws_access_key_id = S3_AKID,
+        aws_secret_access_key = S3_SAK,
+        config = get_client_config(),
+        ),
+    # Create client instance for EC2 Instance
+    'ec2': lambda: boto3.client('ec2', region_name=OUR_REGION, config=get_client_config()),
+    # Create SSM Client
+    'ssm': lambda: boto3.client('ssm', config=get_client_config()),
+    # Create DynamoDB Client [De-Duplication Store, Batch Buffer]
+    'dynamodb': lambda: boto3.client('dynamodb', region_name=OUR_REGION, config=get_client_config()),
+}
+
+def get_client(name: str):
+    """ Returns the per-container client, building it on the first use
+    Args:
+        name (str): One of 's3', 'ec2', 'ssm', 'dynamodb'
+    Returns:
+        botocore.client.BaseClient: The client
+    """
+    client = _CLIENTS.get(name)
+    if client is None:
+        client = _CLIENTS[name] = _CLIENT_FACTORIES[name]()
+    return client
+
+def set_client(name: str, client) -> None:
+    """ Replaces the per-container client (e.g. with a stubbed one)
+    Args:
+        name (str): One of 's3', 'ec2', 'ssm', 'dynamodb'
+        client (any): The client to use, None to rebuild on the next use
+    """
+    if client is None:
+        _CLIENTS.pop(name, None)
+    else:
+        _CLIENTS[name] = client
+
+class DedupStore:
+    """ Per-container in-memory store of the claimed S3-events
+        Base of the pluggable de-duplication stores
+    """
+    def __init__(self):
+        self.entries = {}   # dedup_key -> (state, expires_at)
+
+    def claim(self, dedup_key: str, ttl: int) -> bool:
+        """ Marks the key in-flight unless it is already in-flight or done
+        Returns:
+            bool: True if the caller owns the key, False for a duplicate
+        """
+        (state, expires_at) = self.entries.get(dedup_key, ('', 0))
+        if expires_at > time.time():
+            return False
+        self.entries[dedup_key] = ('in-flight', time.time() + ttl)
+        return True
+
+    def mark_done(self, dedup_key: str, ttl: int) -> None:
+        self.entries[dedup_key] = ('done', time.time() + ttl)
+
+    def release(self, dedup_key: str) -> None:
+        self.entries.pop(dedup_key, None)
+
+class SqliteDedupStore(DedupStore):
+    """ File-backed stand-in of the de-duplication store (tests, local runs)
+    """
+    def __init__(self, db_file: str):
+        self.conn = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS dedup ('
+                          'dedup_key TEXT PRIMARY KEY, state TEXT NOT NULL, expires_at REAL NOT NULL)')
+
+    def claim(self, dedup_key: str, ttl: int) -> bool:
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = self.conn.execute('SELECT expires_at FROM dedup WHERE dedup_key=?', (dedup_key,)).fetchone()
+            if row and row[0] > now:
+                return False
+            self.conn.execute('INSERT OR REPLACE INTO dedup VALUES (?, ?, ?)', (dedup_key, 'in-flight', now + ttl))
+            return True
+        finally:
+            self.conn.execute('COMMIT')
+
+    def mark_done(self, dedup_key: str, ttl: int) -> None:
+        self.conn.execute('INSERT OR REPLACE INTO dedup VALUES (?, ?, ?)', (dedup_key, 'done', time.time() + ttl))
+
+    def release(self, dedup_key: str) -> None:
+        self.conn.execute('DELETE FROM dedup WHERE dedup_key=?', (dedup_key,))
+
+class DynamoDedupStore(DedupStore):
+    """ DynamoDB de-duplication store shared by all Lambda containers
+        (enable the table TTL on the 'expires_at' attribute for the clean-up)
+    """
+    def __init__(self, table: str, client=None):
+        self.table = table
+        self.client = client if client else get_client('dynamodb')
 
-# Create SSM Client
-ssm_ec2_client = boto3.client('ssm')
+    def put(self, dedup_key: str, state: str, ttl: int, **conditions) -> None:
+        self.client.put_item(
+            TableName=self.table,
+            Item={  'dedup_key': {'S': dedup_key},
+                    'state': {'S': state},
+                    'expires_at': {'N': str(int(time.time() + ttl))}},
+            **conditions)
+
+    def claim(self, dedup_key: str, ttl: int) -> bool:
+        try:
+            self.put(dedup_key, 'in-flight', ttl,
+                ConditionExpression='attribute_not_exists(dedup_key) OR expires_at < :now',
+                ExpressionAttributeValues={':now': {'N': str(int(time.time()))}})
+            return True
+        except self.client.exceptions.ConditionalCheckFailedException:
+            return False
+
+    def mark_done(self, dedup_key: str, ttl: int) -> None:
+        self.put(dedup_key, 'done', ttl)
+
+    def release(self, dedup_key: str) -> None:
+        self.client.delete_item(TableName=self.table, Key={'dedup_key': {'S': dedup_key}})
+
+_DEDUP_STORE = []
+
+def get_dedup_store() -> DedupStore:
+    """ Returns the per-container de-duplication store chosen by the environment
+    """
+    if not _DEDUP_STORE:
+        if DEDUP_TABLE:
+            _DEDUP_STORE.append(DynamoDedupStore(DEDUP_TABLE))
+        elif DEDUP_SQLITE:
+            _DEDUP_STORE.append(SqliteDedupStore(DEDUP_SQLITE))
+        else:
+            _DEDUP_STORE.append(DedupStore())
+    return _DEDUP_STORE[0]
+
+def set_dedup_store(store: DedupStore) -> None:
+    _DEDUP_STORE[:] = [store] if store else []
+
+def get_dedup_lease() -> int:
+    """ The in-flight claim outlives this invocation (and the batch window of a buffered file) only by so much:
+        a killed or timed-out Lambda must not block the S3 object for the whole DEDUP_TTL
+    """
+    return int(DEDUP_LEASE + BATCH_WINDOW)
+
+def get_dedup_key(bucket: str, file_name: str, version: str) -> str:
+    return f'{bucket}/{file_name}/{version}'
+
+class BatchBuffer:
+    """ Per-container in-memory buffer of the request files waiting for the batch
+        Base of the pluggable batch buffers, an item is a dict of
+        item_key, added_at, bucket, file_name, dedup_key and request (the parsed file)
+    """
+    def __init__(self):
+        self.items = {}     # item_key -> item
+
+    def add(self, items: list[dict]) -> None:
+        for item in items:
+            self.items.setdefault(item['item_key'], item)
+
+    def pending(self) -> list[dict]:
+        return sorted(self.items.values(), key=lambda item: item['added_at'])
+
+    def take(self, item_keys: list[str]) -> list[dict]:
+        """ Removes the items atomically: concurrent flushes never get the same item
+        Returns:
+            list[dict]: The items still buffered, now owned by the caller
+        """
+        return [self.items.pop(key) for key in item_keys if key in self.items]
+
+class SqliteBatchBuffer(BatchBuffer):
+    """ File-backed stand-in of the batch buffer (tests, local runs)
+    """
+    def __init__(self, db_file: str):
+        self.conn = sqlite3.connect(db_file, timeout=30, isolation_level=None)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS batch ('
+                          'item_key TEXT PRIMARY KEY, added_at REAL NOT NULL, item TEXT NOT NULL)')
+
+    def add(self, items: list[dict]) -> None:
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            self.conn.executemany('INSERT OR IGNORE INTO batch VALUES (?, ?, ?)',
+                [(item['item_key'], item['added_at'], json.dumps(item)) for item in items])
+        finally:
+            self.conn.execute('COMMIT')
+
+    def pending(self) -> list[dict]:
+        return [json.loads(row[0]) for row in 
+                self.conn.execute('SELECT item FROM batch ORDER BY added_at')]
+
+    def take(self, item_keys: list[str]) -> list[dict]:
+        taken = []
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            for key in item_keys:
+                row = self.conn.execute('SELECT item FROM batch WHERE item_key=?', (key,)).fetchone()
+                if row:
+                    self.conn.execute('DELETE FROM batch WHERE item_key=?', (key,))
+                    taken.append(json.loads(row[0]))
+        finally:
+            self.conn.execute('COMMIT')
+        return taken
+
+class DynamoBatchBuffer(BatchBuffer):
+    """ DynamoDB batch buffer shared by all Lambda containers
+    """
+    def __init__(self, table: str, client=None):
+        self.table = table
+        self.client = client if client else get_client('dynamodb')
+
+    def add(self, items: list[dict]) -> None:
+        for item in items:
+            try:
+                self.client.put_item(
+                    TableName=self.table,
+                    Item={  'item_key': {'S': item['item_key']},
+                            'added_at': {'N': repr(item['added_at'])},
+                            'item': {'S': json.dumps(item)}},
+                    ConditionExpression='attribute_not_exists(item_key)')
+            except self.client.exceptions.ConditionalCheckFailedException:
+                pass    ### Already buffered
+
+    def pending(self) -> list[dict]:
+        items = []
+        for page in self.client.get_paginator('scan').paginate(
+                TableName=self.table, ConsistentRead=True):
+            items.extend(json.loads(entry['item']['S']) for entry in page.get('Items', []))
+        return sorted(items, key=lambda item: item['added_at'])
+
+    def take(self, item_keys: list[str]) -> list[dict]:
+        taken = []
+        for key in item_keys:
+            ### Only ONE of the concurrent deletes gets the old item back
+            response = self.client.delete_item(
+                TableName=self.table, Key={'item_key': {'S': key}}, ReturnValues='ALL_OLD')
+            if response.get('Attributes'):
+                taken.append(json.loads(response['Attributes']['item']['S']))
+        return taken
+
+_BATCH_BUFFER = []
+
+def get_batch_buffer() -> BatchBuffer:
+    """ Returns the per-container batch buffer chosen by the environment
+    """
+    if not _BATCH_BUFFER:
+        if BATCH_TABLE:
+            _BATCH_BUFFER.append(DynamoBatchBuffer(BATCH_TABLE))
+        elif BATCH_SQLITE:
+            _BATCH_BUFFER.append(SqliteBatchBuffer(BATCH_SQLITE))
+        else:
+            _BATCH_BUFFER.append(BatchBuffer())
+    return _BATCH_BUFFER[0]
+
+def set_batch_buffer(buffer: BatchBuffer) -> None:
+    _BATCH_BUFFER[:] = [buffer] if buffer else []
 
 def event_name_exists(event, context) -> bool:
     return ( # Shorthand for making sure that eventName is not a DUD
@@ -42,144 +352,819 @@ def event_name_exists(event, context) -> bool:
         and event['Records'][0] 
         and event['Records'][0]['eventName']
         )
+
+def get_event_records(event, event_prefix: str) -> list[tuple[str, str, str]]:
+    """ Walks ALL records of the S3 event (S3 may deliver several at once)
+    Args:
+        event (dict): The S3 notification event
+        event_prefix (str): The eventName prefix to select (e.g. 'ObjectCreated:')
+    Returns:
+        list[tuple[str, str, str]]: List of (bucket, key, versionId or eTag) in delivery order, duplicates dropped
+    """
+    records = []
+    for record in (event or {}).get('Records') or []:
+        if not (record and str(record.get('eventName', '')).startswith(event_prefix)):
+            continue
+        bucket = record['s3']['bucket']['name']
+        ### Keys arrive URL-encoded in the notification (e.g. spaces as '+')
+        file_name = unquote_plus(record['s3']['object']['key'])
+        version = record['s3']['object'].get('versionId') or record['s3']['object'].get('eTag', '')
+        if (bucket, file_name, version) not in records:
+            records.append((bucket, file_name, version))
+    return records
+
+def collapse_versions(entries: list, name_of=lambda entry: entry[1]) -> tuple[list, list]:
+    """ Keeps ONE version per S3 key, the last one (re-uploaded within the event or batch window):
+        the worker reads the current object by its key, so the older versions would run it twice
+    Args:
+        entries (list): The event records (bucket, key, version) or buffered items, oldest first
+        name_of (callable, optional): The S3 key of an entry. Defaults to the key of the event record.
+    Returns:
+        tuple[list, list]: (the latest entry of each key in the original order, the superseded ones)
+    """
+    latest = {}
+    for (index, entry) in enumerate(entries):
+        latest[name_of(entry)] = index
+    kept = [entry for (index, entry) in enumerate(entries) if latest[name_of(entry)] == index]
+    superseded = [entry for (index, entry) in enumerate(entries) if latest[name_of(entry)] != index]
+    return (kept, superseded)
         
-def s3_file_as_dict(file_name:str, bucket_name:str ) -> dict:
-    """ Parses the file content using ": " as separator 
+def bounded(value, limit:int = None) -> str:
+    """ Bounds the text going to the log (keeps head and tail)
+    Args:
+        value (any): Value to log
+        limit (int, optional): Max characters. Defaults to LOG_MAX_CHARS.
+    Returns:
+        str: The text of at most 'limit' characters (plus the cut marker)
+    """
+    text = value if isinstance(value, str) else str(value)
+    limit = limit if limit else LOG_MAX_CHARS
+    if len(text) <= limit:
+        return text
+    half = limit // 2
+    return f'{text[:half]} ...[{len(text) - 2*half} chars cut]... {text[-half:]}'
+
+class Metrics:
+    """ Per-phase timings emitted as ONE CloudWatch Embedded-Metric-Format JSON log line
+    """
+    def __init__(self, **properties):
+        self.started = time.perf_counter()
+        self.values = {}
+        self.properties = dict(properties)
+
+    def add(self, name: str, value: float) -> None:
+        self.values[name] = self.values.get(name, 0) + value
+
+    def mark(self, name: str) -> None:
+        """ Records the milliseconds elapsed since the metrics were started
+        """
+        self.values[name] = (time.perf_counter() - self.started) * 1000
+
+    @contextmanager
+    def phase(self, name: str):
+        """ Adds the milliseconds spent in the 'with' block to the metric
+        """
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.add(name, (time.perf_counter() - started) * 1000)
+
+    def emit(self, **properties) -> dict:
+        self.properties.update(properties)
+        line = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Service']],
+                    'Metrics': [{'Name': name, 'Unit': 'Milliseconds' if name.endswith('Ms') else 'Count'} 
+                                for name in self.values],
+                }],
+            },
+            'Service': METRICS_SERVICE,
+            **{name: round(value, 3) for (name, value) in self.values.items()},
+            **self.properties,
+        }
+        print(json.dumps(line, default=str))
+        return line
+
+def parse_request_content(content) -> dict:
+    """ Parses the file content with the dependency-free codec of ops_request,
         done as YAML package would eat much more time/memory
         and is a hustle to pull into the environment
+    Args:
+        content (str|bytes): The request-file content
+    Returns:
+        dict: The key-value pairs of the request-file, {} if malformed
+    """
+    try:
+        return parse_request(content)
+    except RequestFormatError as ex:
+        print(f'Malformed request-file: {ex}')
+        return {}
+
+def read_s3_request(file_name:str, bucket_name:str, 
+                    max_bytes:int = None, metrics:Metrics = None) -> tuple[dict, bytes]:
+    """ Reads the request-file from S3 ONCE, streaming at most max_bytes
     Args:
         file_name (str): File name in S3 bucket
         bucket_name (str): S3 bucket name
+        max_bytes (int, optional): The size cap of the file. Defaults to S3_MAX_REQUEST_BYTES.
+        metrics (Metrics, optional): Collects S3ReadMs and ParseMs. Defaults to None.
     Returns:
-        dict: _description_
-    """
-    file_dict={}
-    s3 = s3_client
-    data = s3.get_object(Bucket=bucket_name, Key=file_name)
-    if data:
-        content =  data['Body'].read().decode('utf-8')
-        lines = list(filter(None, content.split("\n", -1)))
-        for line in lines:
-            if line:
-                p = line.split(': ')
-                if len(p)==2:
-                    file_dict[p[0]]=p[1]
-    return file_dict
+        tuple[dict, bytes]: (parsed content, raw bytes), ({}, b'') if too big or missing
+    """
+    metrics = metrics if metrics else Metrics()
+    max_bytes = max_bytes if max_bytes else S3_MAX_REQUEST_BYTES
+    with metrics.phase('S3ReadMs'):
+        data = get_client('s3').get_object(Bucket=bucket_name, Key=file_name)
+        if not data:
+            return ({}, b'')
+        body = data['Body']
+        try:
+            if data.get('ContentLength', 0) > max_bytes:
+                print(f'Request-file {file_name} of {data["ContentLength"]} bytes is over {max_bytes} bytes limit')
+                return ({}, b'')
+            ### One more byte to detect the oversized file if the length was not reported
+            raw = body.read(max_bytes + 1)
+        finally:
+            body.close()
+    if len(raw) > max_bytes:
+        print(f'Request-file {file_name} is over {max_bytes} bytes limit')
+        return ({}, b'')
+    with metrics.phase('ParseMs'):
+        return (parse_request_content(raw), raw)
+
+def reject_request(file_name:str, bucket_name:str, errors:list[str]) -> bool:
+    """ Moves the invalid request-file out of the drop bucket into S3_REJECT_BUCKET,
+        so it neither reaches the worker nor counts as pending work
+    Args:
+        file_name (str): File name in S3 bucket
+        bucket_name (str): S3 bucket name
+        errors (list[str]): Why the file was rejected
+    Returns:
+        bool: True if moved, False if left in place (no S3_REJECT_BUCKET)
+    """
+    print(f'Request-file {file_name} rejected: {"; ".join(errors)}')
+    if not S3_REJECT_BUCKET:
+        return False
+    client = get_client('s3')
+    client.copy_object(Bucket=S3_REJECT_BUCKET, Key=file_name,
+                       CopySource={'Bucket': bucket_name, 'Key': file_name})
+    client.delete_object(Bucket=bucket_name, Key=file_name)
+    return True
+
+def s3_file_as_dict(file_name:str, bucket_name:str ) -> dict:
+    """ Parses the file content using ": " as separator 
+    Args:
+        file_name (str): File name in S3 bucket
+        bucket_name (str): S3 bucket name
+    Returns:
+        dict: The key-value pairs of the request-file
+    """
+    return read_s3_request(file_name, bucket_name)[0]
         
-def run_ec2_commands(file_name:str='X.test', file_dict:dict={}):
-    """ Run the commands on EC2 from Lambda
+def send_ec2_command(file_names:list[str], file_dicts:dict, client, 
+                     instance_ids:list[str], metrics:Metrics) -> str:
+    """ Sends the request files as ONE SSM command to the worker(s), does not wait for it
     Args:
-        file_name (str, optional): The file-name of the new S3-file that triggered event. Defaults to 'X.test'.
-        file_dict (str, optional): The dict of the file content. Defaults to {}.
+        file_names (list[str]): The file-names of the new S3-files
+        file_dicts (dict): The dict of file-name to the dict of the file content
+        client (SSM.Client): SSM client (real or stubbed)
+        instance_ids (list[str]): The worker(s) to run on
+        metrics (Metrics): Gets SsmSendMs and the keys/command_id/instance_id properties
+    Returns:
+        str: The SSM command ID
     """
     print(f'Run-Test\n{"="*64}')
-    ### Hand-parsed reference-file values
-    branch_name = file_dict["branch_name"] if 'branch_name' in file_dict.keys() else ''
-    cmd_file_name = file_dict["file"]  if 'file' in file_dict.keys() else ''
+    for file_name in file_names:
+        file_dict = file_dicts.get(file_name, {})
+        ### Hand-parsed reference-file values
+        branch_name = file_dict["branch_name"] if 'branch_name' in file_dict.keys() else ''
+        cmd_file_name = file_dict["file"]  if 'file' in file_dict.keys() else ''
+        ### The multi-user request lists its user files instead
+        cmd_file_name = cmd_file_name or ', '.join(file_dict.get('files', []))
+        print(f'{file_name=}\t{branch_name=}\t{cmd_file_name=}')
 
-    cmd_process_s3_file = " ".join(
+    s3_file_params = []
+    for file_name in file_names:
+        s3_file_params.extend(['-s3', file_name])
+    ### Every argument quoted: an S3 key is user data, never shell syntax
+    cmd_process_s3_file = " ".join(shlex.quote(arg) for arg in
                     [   'python',f'{WORK_DIR}/ops_common.py',
                         'process-s3-file', 
                         '-e', f'{WORK_DIR}/env-ec2-test.yaml', 
-                        '-s3', f'{file_name}'
-                    ]
+                    ] + s3_file_params
                 )      
-    client = ssm_ec2_client
-    response = client.send_command(
+    with metrics.phase('SsmSendMs'):
+        response = client.send_command(
       
-        InstanceIds=ec2_instances,
-        DocumentName='AWS-RunShellScript',
-        Parameters={            
-            'commands': [
-                ### 1. Run the S3-Bucket Handler
-                (f' runuser -l  ec2-user -c "{cmd_process_s3_file}"'),
-            ],
-            'workingDirectory': [WORK_DIR],
-            # 'id': ['BloSS@M-Test'],
-            ### !!! The script executes a long-running chunk of work !!! 
-            ### !!! Be super-careful playing with the timeout value !!! 
-            'executionTimeout':['99'] 
-        }
-    )
+            InstanceIds=instance_ids,
+            DocumentName='AWS-RunShellScript',
+            Parameters={            
+                'commands': [
+                    ### 1. Run the S3-Bucket Handler
+                    (f' runuser -l  ec2-user -c {shlex.quote(cmd_process_s3_file)}'),
+                ],
+                'workingDirectory': [WORK_DIR],
+                # 'id': ['BloSS@M-Test'],
+                ### !!! The script executes a long-running chunk of work !!! 
+                ### !!! Be super-careful playing with the timeout value !!! 
+                'executionTimeout':[SSM_EXEC_TIMEOUT] 
+            }
+        )
     command_id = response['Command']['CommandId']
-    tries = 0
-    output = 'False'
-    Statuses=[]
-    Contexts=[]
-    while tries < 100:
-        tries = tries + 1
+    metrics.properties.update({'keys': list(file_names), 'command_id': command_id, 'instance_id': instance_ids[0]})
+    return command_id
+
+def complete_ec2_commands(client, commands:dict, metrics:dict, 
+                          context=None, wait_mode:str=None) -> dict:
+    """ Waits for the SSM commands sent to the workers, ALL of them polled together
+    Args:
+        client (SSM.Client): SSM client (real or stubbed)
+        commands (dict): instance-id -> command-id
+        metrics (dict): instance-id -> Metrics of the command, emitted here
+        context (LambdaContext, optional): Lambda context bounding the polling. Defaults to None.
+        wait_mode (str, optional): 'async' or 'poll'. Defaults to SSM_WAIT_MODE.
+    Returns:
+        dict: instance-id -> (output, Statuses, Contexts, command_id)
+    """
+    results = {}
+    if (wait_mode or SSM_WAIT_MODE) == 'async':
+        ### Fire-and-forget: completion arrives to command_status_handler
+        for (instance_id, command_id) in commands.items():
+            print(f'Command {command_id} accepted, not waiting for completion')
+            metrics[instance_id].mark('DispatchMs')
+            metrics[instance_id].emit(status='Accepted')
+            results[instance_id] = ('Accepted', [], [], command_id)
+        return results
+
+    waits = wait_for_commands(client, commands, context, metrics=metrics)
+    for (instance_id, command_id) in commands.items():
+        (result, Statuses, Contexts) = waits[instance_id]
+        output = result['StandardOutputContent'] if result else 'False'
+        metrics[instance_id].mark('EndToEndMs')
+        metrics[instance_id].emit(status=result['Status'] if result else 'TimedOut', 
+                                  polls=len(Statuses), output_tail=bounded(output, 256))
+        results[instance_id] = (output, Statuses, Contexts, command_id)
+    print(f'{"="*64}')
+    return results
+
+def run_ec2_commands(file_names:list[str]=['X.test'], file_dicts:dict={}, 
+                     context=None, ssm_client=None, wait_mode:str=None,
+                     instance_ids:list[str]=None, metrics:Metrics=None):
+    """ Run the commands on EC2 from Lambda
+        All the S3-files of the event are coalesced into ONE SSM command,
+        so the EC2 worker processes the whole batch in a single session
+    Args:
+        file_names (list[str], optional): The file-names of the new S3-files that triggered event. Defaults to ['X.test'].
+        file_dicts (dict, optional): The dict of file-name to the dict of the file content. Defaults to {}.
+        context (LambdaContext, optional): Lambda context bounding the polling. Defaults to None.
+        ssm_client (SSM.Client, optional): SSM client (real or stubbed). Defaults to None.
+        wait_mode (str, optional): 'async' or 'poll'. Defaults to SSM_WAIT_MODE.
+        instance_ids (list[str], optional): The worker(s) to run on. Defaults to ec2_instances.
+        metrics (Metrics, optional): Started at the invocation start, emitted per command. Defaults to None.
+    Returns:
+        tuple: (output, Statuses, Contexts, command_id)
+    """
+    metrics = metrics if metrics else Metrics()
+    instance_ids = instance_ids if instance_ids else ec2_instances
+    client = ssm_client if ssm_client else get_client('ssm')
+    command_id = send_ec2_command(file_names, file_dicts, client, instance_ids, metrics)
+    return complete_ec2_commands(client, {instance_ids[0]: command_id}, 
+                                 {instance_ids[0]: metrics}, context, wait_mode)[instance_ids[0]]
+
+def wait_for_commands(client, commands: dict, context=None, 
+                      sleep=time.sleep, metrics:dict=None) -> dict:
+    """ Polls the SSM command invocations of several workers with ONE exponential backoff,
+        a slow worker does not hold back the status of the others
+        The wait is bounded by the Lambda remaining time (minus a safety margin),
+        or by SSM_POLL_MAX_WAIT seconds when there is no Lambda context
+    Args:
+        client (SSM.Client): SSM client (real or stubbed)
+        commands (dict): instance-id -> the SSM command ID to wait for
+        context (LambdaContext, optional): Lambda context. Defaults to None.
+        sleep (callable, optional): Sleep function. Defaults to time.sleep.
+        metrics (dict, optional): instance-id -> Metrics getting FirstStatusMs and WaitMs. Defaults to None.
+    Returns:
+        dict: instance-id -> (last invocation or None if still pending, Statuses, Contexts)
+    """
+    def remaining_seconds() -> float:
+        if context and hasattr(context, 'get_remaining_time_in_millis'):
+            return (context.get_remaining_time_in_millis() - SSM_POLL_SAFETY_MS) / 1000
+        return deadline - time.monotonic()
+
+    metrics = metrics if metrics else {}
+    started = time.perf_counter()
+    deadline = time.monotonic() + SSM_POLL_MAX_WAIT
+    delay = SSM_POLL_FIRST_DELAY
+    waits = {instance_id: (None, [], []) for instance_id in commands}
+    pending = dict(commands)
+    while pending and remaining_seconds() > 0:
+        sleep(min(delay, max(remaining_seconds(), 0)))  # some delay always required...
+        delay = min(delay * 2, SSM_POLL_MAX_DELAY)
+        for (instance_id, command_id) in list(pending.items()):
+            (result, Statuses, Contexts) = waits[instance_id]
+            try:
+                result = client.get_command_invocation(
+                    CommandId=command_id,
+                    InstanceId=instance_id,
+                )
+            except client.exceptions.InvocationDoesNotExist:
+                continue
+            if instance_id in metrics and not Statuses:
+                metrics[instance_id].mark('FirstStatusMs')
+            Statuses.append(f"{result['Status']=}")
+            Contexts.append(bounded(result['StandardOutputContent'], 256))
+            waits[instance_id] = (result, Statuses, Contexts)
+            if result['Status'] not in SSM_PENDING_STATUSES:
+                del pending[instance_id]
+                if instance_id in metrics:
+                    metrics[instance_id].add('WaitMs', (time.perf_counter() - started) * 1000)
+    for (instance_id, command_id) in pending.items():
+        print(f'Command {command_id} still pending, the Lambda time is over')
+        (result, Statuses, Contexts) = waits[instance_id]
+        waits[instance_id] = (None, Statuses, Contexts)
+        if instance_id in metrics:
+            metrics[instance_id].add('WaitMs', (time.perf_counter() - started) * 1000)
+    return waits
+
+def wait_for_command(client, command_id: str, instance_id: str, 
+                     context=None, sleep=time.sleep, metrics:Metrics=None) -> tuple[dict, list, list]:
+    """ Polls the SSM command invocation with exponential backoff (see wait_for_commands)
+    Returns:
+        tuple[dict, list, list]: (last invocation or None if still pending, Statuses, Contexts)
+    """
+    return wait_for_commands(client, {instance_id: command_id}, context, sleep,
+                             metrics={instance_id: metrics} if metrics else None)[instance_id]
+
+def command_status_handler(event, context, ssm_client=None):
+    """ Reports completion of the SSM command sent in the 'async' mode
+        Triggered by EventBridge rule on the SSM 
+        "EC2 Command Invocation Status-change Notification" events
+    Args:
+        event (dict): EventBridge event
+        context (LambdaContext): Lambda context
+        ssm_client (SSM.Client, optional): SSM client (real or stubbed). Defaults to None.
+    Returns:
+        dict: The command completion record
+    """
+    detail = (event or {}).get('detail') or {}
+    command_id = detail.get('command-id')
+    instance_id = detail.get('instance-id')
+    status = detail.get('status')
+    record = {
+        'command_id': command_id,
+        'instance_id': instance_id,
+        'status': status,
+        'output': None,
+    }
+    if command_id and instance_id and status not in SSM_PENDING_STATUSES:
+        client = ssm_client if ssm_client else get_client('ssm')
         try:
-            time.sleep(0.9)  # some delay always required...
-            
             result = client.get_command_invocation(
                 CommandId=command_id,
-                InstanceId=ec2_instances[0] ,
+                InstanceId=instance_id,
             )
-            # print(f"{result['Status']=}")
-            # print(f"{result['StandardOutputContent']=}")
-            Statuses.append(f"{result['Status']=}")
-            Contexts.append(f"{result['StandardOutputContent']=}")
-            if result['Status'] == 'InProgress':
-                continue
-            output = result['StandardOutputContent']
-            break
+            record['status'] = result['Status']
+            record['output'] = result['StandardOutputContent']
         except client.exceptions.InvocationDoesNotExist:
+            pass
+    metrics = Metrics(command_id=command_id, instance_id=instance_id)
+    try:
+        requested = datetime.fromisoformat(detail['requested-date-time'].replace('Z', '+00:00'))
+        finished = datetime.fromisoformat(event['time'].replace('Z', '+00:00'))
+        metrics.add('EndToEndMs', (finished - requested).total_seconds() * 1000)
+    except (KeyError, TypeError, ValueError):
+        pass
+    metrics.emit(status=record['status'], 
+                 output_tail=bounded(record['output'], 256) if record['output'] else None)
+    return record
+    
+class WorkerLifecycle:
+    """ Starts the EC2 worker on demand (gated by the SSM-agent readiness),
+        keeps it warm while requests are pending and stops it after the idle window
+    """
+    def __init__(self, ec2_client=None, ssm_client=None, s3_client=None, 
+                 sleep=time.sleep, now=time.time):
+        ### The missing clients come from get_client() on their first use only
+        self.clients = {'ec2': ec2_client, 'ssm': ssm_client, 's3': s3_client}
+        self.sleep = sleep
+        self.now = now
+
+    def get_service(self, name: str):
+        if not self.clients.get(name):
+            self.clients[name] = get_client(name)
+        return self.clients[name]
+
+    @property
+    def ec2(self):
+        return self.get_service('ec2')
+
+    @property
+    def ssm(self):
+        return self.get_service('ssm')
+
+    @property
+    def s3(self):
+        return self.get_service('s3')
+
+    def describe(self, instance_ids: list[str]) -> dict:
+        """ Returns:
+            dict: instance-id -> {'state': str, 'last_activity': float}
+        """
+        info = {}
+        response = self.ec2.describe_instances(InstanceIds=instance_ids)
+        for reservation in response.get('Reservations', []):
+            for instance in reservation.get('Instances', []):
+                tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+                info[instance['InstanceId']] = {
+                    'state': instance['State']['Name'],
+                    'last_activity': float(tags.get(WORKER_ACTIVITY_TAG, 0) or 0),
+                }
+        return info
+
+    def ssm_ready(self, instance_ids: list[str]) -> list[str]:
+        """ Returns:
+            list[str]: The instances with the SSM-agent online
+        """
+        response = self.ssm.describe_instance_information(
+            Filters=[{'Key': 'InstanceIds', 'Values': instance_ids}])
+        return [info['InstanceId'] for info in response.get('InstanceInformationList', [])
+                if info.get('PingStatus') == 'Online']
+
+    def ensure_ready(self, instance_ids: list[str], context=None) -> bool:
+        """ Starts the stopped instances and waits for the SSM-agent of ALL of them
+            The wait is bounded by WORKER_READY_TIMEOUT and by the Lambda remaining time
+        Returns:
+            bool: True if the SSM command can be dispatched
+        """
+        return len(self.wait_ready(instance_ids, context)) == len(instance_ids)
+
+    def wait_ready(self, instance_ids: list[str], context=None) -> list[str]:
+        """ Starts the stopped instances and waits for their SSM-agents together
+            The wait is bounded by WORKER_READY_TIMEOUT and by the Lambda remaining time
+        Returns:
+            list[str]: The instances the SSM command can be dispatched to, all of them unless out of time
+        """
+        deadline = self.now() + WORKER_READY_TIMEOUT
+        if context and hasattr(context, 'get_remaining_time_in_millis'):
+            deadline = min(deadline, 
+                    self.now() + (context.get_remaining_time_in_millis() - SSM_POLL_SAFETY_MS) / 1000)
+        delay = 1.0
+        while True:
+            states = self.describe(instance_ids)
+            to_start = [id for id, info in states.items() if info['state'] == 'stopped']
+            if to_start:
+                print(f'Starting the worker(s): {to_start}')
+                self.ec2.start_instances(InstanceIds=to_start)
+            running = [id for id, info in states.items() if info['state'] == 'running']
+            ready = self.ssm_ready(running) if running else []
+            if len(ready) == len(instance_ids):
+                return ready
+            if self.now() + delay > deadline:
+                print(f'Worker(s) not ready in time: {states}')
+                return ready
+            self.sleep(delay)
+            delay = min(delay * 2, 8)
+
+    def touch(self, instance_ids: list[str]) -> None:
+        """ Records the dispatch time, the idle window counts from it
+        """
+        self.ec2.create_tags(Resources=instance_ids, 
+                             Tags=[{'Key': WORKER_ACTIVITY_TAG, 'Value': str(int(self.now()))}])
+
+    def inflight_commands(self, instance_id: str, limit: int = 1) -> int:
+        """ Returns:
+            int: Number (up to 'limit' per status) of the pending and in-progress SSM commands
+        """
+        inflight = 0
+        for status in ('Pending', 'InProgress'):
+            response = self.ssm.list_commands(InstanceId=instance_id, MaxResults=limit,
+                            Filters=[{'key': 'Status', 'value': status}])
+            inflight += len(response.get('Commands', []))
+        return inflight
+
+    def pending_requests(self, instance_ids: list[str], bucket: str = None) -> int:
+        """ Queue depth: not-yet-consumed request files + buffered files + not-finished SSM commands
+        """
+        pending = len(get_batch_buffer().pending()) if BATCH_WINDOW > 0 else 0
+        if bucket:
+            pending += self.s3.list_objects_v2(Bucket=bucket, MaxKeys=1).get('KeyCount', 0)
+        for instance_id in instance_ids:
+            pending += self.inflight_commands(instance_id)
+        return pending
+
+    def stop_if_idle(self, instance_ids: list[str], bucket: str = None) -> list[str]:
+        """ Stops the running instances idle for WORKER_IDLE_WINDOW with nothing pending
+        Returns:
+            list[str]: The stopped instances
+        """
+        states = self.describe(instance_ids)
+        idle = [id for id, info in states.items() 
+                if info['state'] == 'running' 
+                and self.now() - info['last_activity'] >= WORKER_IDLE_WINDOW]
+        if not idle or self.pending_requests(idle, bucket):
+            return []
+        print(f'Stopping the idle worker(s): {idle}')
+        self.ec2.stop_instances(InstanceIds=idle)
+        return idle
+
+class HashRing:
+    """ Consistent hashing of the request files to the workers,
+        so the same member/branch lands on the same worker while the worker list is stable
+    """
+    def __init__(self, instance_ids: list[str], vnodes: int = SHARD_VNODES):
+        self.instance_ids = list(instance_ids)
+        self.points = sorted(
+            (self.hash(f'{instance_id}#{vnode}'), instance_id)
+            for instance_id in self.instance_ids for vnode in range(vnodes))
+        self.hashes = [point for (point, _) in self.points]
+
+    @staticmethod
+    def hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+    def walk(self, key: str):
+        """ Yields the distinct workers clockwise from the key position
+        """
+        start = bisect.bisect(self.hashes, self.hash(key))
+        seen = set()
+        for index in range(len(self.points)):
+            instance_id = self.points[(start + index) % len(self.points)][1]
+            if instance_id not in seen:
+                seen.add(instance_id)
+                yield instance_id
+
+    def route(self, key: str, loads: dict, capacity: int) -> str:
+        """ Consistent hashing with bounded loads: skips the workers at capacity
+        Args:
+            key (str): The shard key
+            loads (dict): instance-id -> in-flight work (updated by the caller)
+            capacity (int): Max in-flight work per worker
+        Returns:
+            str: The worker to send the key to
+        """
+        fallback = None
+        for instance_id in self.walk(key):
+            fallback = fallback if fallback else instance_id
+            if loads.get(instance_id, 0) < capacity:
+                return instance_id
+        return fallback
+
+def route_requests(file_names: list[str], file_dicts: dict, 
+                   instance_ids: list[str], lifecycle: WorkerLifecycle = None) -> dict:
+    """ Splits the request files between the workers
+    Args:
+        file_names (list[str]): The request files
+        file_dicts (dict): file-name -> parsed request-file
+        instance_ids (list[str]): The workers
+        lifecycle (WorkerLifecycle, optional): Source of the in-flight SSM commands per worker. Defaults to None.
+    Returns:
+        dict: instance-id -> list of the request files
+    """
+    if len(instance_ids) == 1:
+        return {instance_ids[0]: list(file_names)}
+    loads = {instance_id: (lifecycle.inflight_commands(instance_id, 50) if lifecycle else 0)
+             for instance_id in instance_ids}
+    capacity = math.ceil(SHARD_LOAD_FACTOR * (sum(loads.values()) + len(file_names)) / len(instance_ids))
+    ring = HashRing(instance_ids)
+    routes = {}
+    for file_name in file_names:
+        key = file_dicts.get(file_name, {}).get(SHARD_KEY) or file_name
+        instance_id = ring.route(key, loads, capacity)
+        loads[instance_id] += 1
+        routes.setdefault(instance_id, []).append(file_name)
+    return routes
+
+class DispatchError(RuntimeError):
+    """ Some request files did not reach their worker,
+        the others were dispatched and must NOT be run again
+    """
+    def __init__(self, message: str, pending: list[str]):
+        super().__init__(message)
+        self.pending = list(pending)
+
+def dispatch_requests(file_names: list[str], file_dicts: dict, 
+                      context=None, metrics: Metrics = None) -> tuple[dict, dict]:
+    """ Routes the request files to the workers and runs ONE SSM command per worker
+        Every shard is sent before any of them is waited for, then all are polled together
+    Args:
+        file_names (list[str]): The valid request files
+        file_dicts (dict): file-name -> parsed request-file
+        context (LambdaContext, optional): Lambda context bounding the waits. Defaults to None.
+        metrics (Metrics, optional): The invocation metrics, end-to-end counts from its start. Defaults to None.
+    Raises:
+        DispatchError: With the files of the workers not ready or not reached, the other shards were sent
+    Returns:
+        tuple[dict, dict]: (instance-id -> files, instance-id -> run_ec2_commands result)
+    """
+    metrics = metrics if metrics else Metrics()
+    lifecycle = WorkerLifecycle()
+    routes = route_requests(file_names, file_dicts, ec2_instances, lifecycle)
+    ### The workers must be up with SSM-agent online BEFORE the dispatch, all started and awaited at once
+    ready = lifecycle.wait_ready(list(routes), context)
+    client = get_client('ssm')
+    commands = {}
+    command_metrics = {}
+    pending = []
+    for (instance_id, instance_files) in routes.items():
+        if instance_id not in ready:
+            print(f'EC2 worker {instance_id} not ready, its files are left for the retry')
+            pending.extend(instance_files)
             continue
+        command_metrics[instance_id] = Metrics(request_id=metrics.properties.get('request_id'))
+        command_metrics[instance_id].started = metrics.started   ### End-to-end counts from the invocation start
+        try:
+            commands[instance_id] = send_ec2_command(instance_files, file_dicts, client, 
+                                                     [instance_id], command_metrics[instance_id])
+        except Exception as ex:
+            print(f'EC2 worker {instance_id} not reached, its files are left for the retry: {ex}')
+            pending.extend(instance_files)
+            del command_metrics[instance_id]
+    try:
+        if commands:
+            lifecycle.touch(list(commands))
+        test_results = complete_ec2_commands(client, commands, command_metrics, context)
+    except Exception as ex:
+        ### The sent shards are running, only the unsent files are left for the retry
+        raise DispatchError(f'Dispatch not completed: {ex}', pending) from ex
+    if pending:
+        raise DispatchError(f'{len(pending)} request file(s) not dispatched', pending)
+    return (routes, test_results)
+
+def flush_batch(context=None, metrics: Metrics = None) -> dict:
+    """ Dispatches the buffered request files once the batch window closed
+        (the oldest file waited BATCH_WINDOW seconds) or BATCH_MAX_FILES are buffered
+    Args:
+        context (LambdaContext, optional): Lambda context bounding the waits. Defaults to None.
+        metrics (Metrics, optional): The invocation metrics. Defaults to None.
+    Returns:
+        dict: The files, output and command_id per worker, {} if nothing was dispatched
+    """
+    buffer = get_batch_buffer()
+    items = buffer.pending()
+    if not items:
+        return {}
+    age = time.time() - items[0]['added_at']
+    if len(items) < BATCH_MAX_FILES and age < BATCH_WINDOW:
+        print(f'Batch of {len(items)} file(s) open for {BATCH_WINDOW - age:.1f}s more')
+        return {}
+    items = buffer.take([item['item_key'] for item in items])
+    if not items:
+        return {}   ### A concurrent invocation flushed them
+    (items, superseded) = collapse_versions(items, lambda item: item['file_name'])
+    for item in superseded:
+        print(f'Superseded version skipped: {item["item_key"]}')
+        if item['dedup_key']:
+            get_dedup_store().mark_done(item['dedup_key'], DEDUP_TTL)
+    file_names = [item['file_name'] for item in items]
+    file_dicts = {item['file_name']: item['request'] for item in items}
+    metrics = metrics if metrics else Metrics()
+    metrics.add('BatchFiles', len(items))
+    metrics.add('BatchAgeMs', round(age * 1000, 3))
+    try:
+        (routes, test_results) = dispatch_requests(file_names, file_dicts, context, metrics)
+    except DispatchError as ex:
+        ### Only the files not dispatched go back to the buffer, the sent ones are done
+        buffer.add([item for item in items if item['file_name'] in ex.pending])
+        for item in items:
+            if item['dedup_key'] and item['file_name'] not in ex.pending:
+                get_dedup_store().mark_done(item['dedup_key'], DEDUP_TTL)
+        raise
+    except Exception:
+        ### Back to the buffer, the next event or the scheduled tick retries them
+        buffer.add(items)
+        raise
+    for item in items:
+        if item['dedup_key']:
+            get_dedup_store().mark_done(item['dedup_key'], DEDUP_TTL)
+    return {
+        'files': routes,
+        'output': {id: bounded(result[0]) for (id, result) in test_results.items()},
+        'command_id': {id: result[3] for (id, result) in test_results.items()},
+    }
 
-    pprint(Statuses)
-    pprint(Contexts)
-    pprint(result)
-    print('\n\n')
-    print(f'{"="*64}')
-    return(output, Statuses, Contexts)
-    
 def lambda_handler(event, context):       
+    # CASE #0 - SSM Command Completion [async mode] routed here by EventBridge
+    if (event or {}).get('source') == 'aws.ssm':
+        return command_status_handler(event, context)
+    # CASE #0 - Scheduled tick [EventBridge schedule]:
+    #           flush the closed batch window, then the idle check of the worker(s)
+    if (event or {}).get('source') == 'aws.events':
+        flushed = flush_batch(context) if BATCH_WINDOW > 0 else {}
+        return {'flushed': flushed, 'stopped': WorkerLifecycle().stop_if_idle(ec2_instances, S3_DROP_BUCKET)}
+
     # CASE #1 - File(Object) Was Dropped Into the S3-Bucket 
     # Handle the Put/Post/COPY/Multipart-Upload-Complete. 
     # I.e. All ObjectCreated* Events:
-    if (    event_name_exists(event, context)
-            and event['Records'][0]['eventName'].startswith('ObjectCreated:')
-    ):
-        # Carve out the bucket and key
-        bucket = event['Records'][0]['s3']['bucket']['name']
-        file_name = event['Records'][0]['s3']['object']['key']
-        print(f'{"*"*60}')
-        file_content_dict = s3_file_as_dict(file_name, bucket)
-        print(f'File Content={file_content_dict}')
-        print(f'{"*"*60}')
-        print(f'{bucket=}')
-        print(f'{file_name=}')
+    created = get_event_records(event, 'ObjectCreated:')
+    ### The older versions of a re-uploaded key are covered by the dispatch of its latest one
+    (created, superseded) = collapse_versions(created)
+    for (bucket, file_name, version) in superseded:
+        print(f'Superseded version skipped: {get_dedup_key(bucket, file_name, version)}')
+        if DEDUP_TTL > 0:
+            get_dedup_store().mark_done(get_dedup_key(bucket, file_name, version), DEDUP_TTL)
+    dedup_keys = {}     # file-name -> dedup-key
+    if created and DEDUP_TTL > 0:
+        ### Skip the already-dispatched or in-flight files
+        store = get_dedup_store()
+        fresh = []
+        for (bucket, file_name, version) in created:
+            dedup_key = get_dedup_key(bucket, file_name, version)
+            if store.claim(dedup_key, get_dedup_lease()):
+                fresh.append((bucket, file_name, version))
+                dedup_keys[file_name] = dedup_key
+            else:
+                print(f'Duplicate event skipped: {dedup_key}')
+        if not fresh:
+            return {'statusCode': 200, 'body': json.dumps({'files': [], 'duplicates': len(created)})}
+        created = fresh
+    if created:
+        # Carve out the bucket and key of EVERY record
+        file_names = []
+        file_dicts = {}
+        metrics = Metrics(request_id=getattr(context, 'aws_request_id', None))
+        try:
+            print(f'{"*"*60}')
+            for (bucket, file_name, version) in created:
+                ## Get Object ONCE [Requires s3-Object Access-Rights]
+                (file_dicts[file_name], data) = read_s3_request(file_name, bucket, metrics=metrics)
+                file_names.append(file_name)
+                print(f'{bucket=}')
+                print(f'{file_name=}')
+                print(f'File Content={bounded(file_dicts[file_name])}')
+                print(f'File Bytes={len(data)}')
+            print(f'{"*"*60}')
+            ### Preflight: the invalid files never wake the worker up
+            rejected = {}
+            for (bucket, file_name, version) in created:
+                errors = validate_request(file_dicts[file_name])
+                if errors:
+                    reject_request(file_name, bucket, errors)
+                    rejected[file_name] = errors
+                    file_names.remove(file_name)
+                    del file_dicts[file_name]
+                    if file_name in dedup_keys:
+                        get_dedup_store().mark_done(dedup_keys.pop(file_name), DEDUP_TTL)
+            metrics.add('Files', len(file_names))
+            metrics.add('Rejected', len(rejected))
+            if not file_names:
+                metrics.emit(keys=file_names)
+                return {'statusCode': 200, 'body': json.dumps({'files': [], 'rejected': rejected})}
+
+            if BATCH_WINDOW > 0:
+                ### Buffer the files: their claims stay in-flight until the batch is dispatched
+                get_batch_buffer().add([
+                    {   'item_key': dedup_keys.get(file_name) or get_dedup_key(bucket, file_name, version),
+                        'added_at': time.time(),
+                        'bucket': bucket,
+                        'file_name': file_name,
+                        'dedup_key': dedup_keys.get(file_name, ''),
+                        'request': file_dicts[file_name]}
+                    for (bucket, file_name, version) in created if file_name in file_dicts])
+                result = flush_batch(context, metrics)
+                metrics.emit(keys=file_names)
+                return {'statusCode': 200, 'body': json.dumps({**result, 'buffered': file_names, 'rejected': rejected})}
 
-        test_result = run_ec2_commands(file_name, file_content_dict)
+            metrics.emit(keys=file_names)
+            (routes, test_results) = dispatch_requests(file_names, file_dicts, context, metrics)
+        except DispatchError as ex:
+            ### Let the S3 retry dispatch again only the files that did not reach a worker
+            for (file_name, dedup_key) in dedup_keys.items():
+                if file_name in ex.pending:
+                    get_dedup_store().release(dedup_key)
+                else:
+                    get_dedup_store().mark_done(dedup_key, DEDUP_TTL)
+            raise
+        except Exception:
+            ### Let the S3 retry (or a replay) dispatch these files again
+            for dedup_key in dedup_keys.values():
+                get_dedup_store().release(dedup_key)
+            raise
+        for dedup_key in dedup_keys.values():
+            get_dedup_store().mark_done(dedup_key, DEDUP_TTL)
 
         print(f'{"*"*60}')
-        
-        print('\n\tEvent=\n')
-        pprint(event)
-        print('\n\tContext=\n')
-        pprint(context)
-        
-        response = None
-        ## Get Object [Requires s3-Object Access-Rights]
-        response = s3_client.get_object(Bucket = bucket, Key = file_name)
-    
-    
-        ## Pull The Data
-        data = response['Body'].read().decode('utf-8')
-        print(data)
-        ec2_client.start_instances(InstanceIds=ec2_instances)
-        return 
-        {
+        print(f'Event Records={len(event["Records"])}\tRequest-ID={getattr(context, "aws_request_id", None)}')
+
+        return {
             'statusCode': 200,
-            'body': json.dumps(f'\n\t{bucket=},\n\t{file_name=}\n\t{event}\n{response}')
+            'body': json.dumps({
+                'files': routes,
+                'output': {id: bounded(result[0]) for (id, result) in test_results.items()},
+                'command_id': {id: result[3] for (id, result) in test_results.items()},
+                'rejected': rejected,
+                })
         }
         
     # CASE #2 - - File(Object) Was DELETED from S3-Bucket     
     # Reacting to "eventName": "ObjectRemoved:Delete"
-    elif (  event_name_exists(event, context)
-            and event['Records'][0]['eventName'].startswith('ObjectCreated:')
-        ):
-        ec2_client.stop_instances(InstanceIds=ec2_instances)
+    # The worker consumed (moved) the request file: stop it only if idle
+    elif get_event_records(event, 'ObjectRemoved:'):
+        removed = get_event_records(event, 'ObjectRemoved:')
+        WorkerLifecycle().stop_if_idle(ec2_instances, removed[0][0])
 
     # This is a weirdly impossible case by the configuration, 
     # but we should log this "Loch-Ness Monster", just in case
@@ -0,0 +1,307 @@
+# =================================================================================
+# Tests of the request-file routing, de-duplication and batching of the Blossom-S3-Watcher:
+#   python -m pytest -q test_blossom_s3_watcher.py
+# ops_request.py is deployed next to the watcher, here it is taken from the EC2 ops
+import importlib.util
+import os
+import sys
+import threading
+
+import pytest
+
+#==================================================================================
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'ec2', 'ops', 'src'))
+spec = importlib.util.spec_from_file_location('blossom_s3_watcher', os.path.join(HERE, 'blossom-s3-watcher.py'))
+watcher = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(watcher)
+
+WORKERS = ['i-0aaa', 'i-0bbb', 'i-0ccc']
+KEYS = [f'account-request-{index}' for index in range(300)]
+### -------------------------------------------------------------------------------
+
+
+class FakeLifecycle:
+    """ The in-flight SSM commands per worker, instead of the SSM API
+    """
+    def __init__(self, loads: dict):
+        self.loads = loads
+
+    def inflight_commands(self, instance_id: str, limit: int = 1) -> int:
+        return min(self.loads.get(instance_id, 0), limit)
+### -------------------------------------------------------------------------------
+
+
+def test_walk_yields_every_worker_once():
+    ring = watcher.HashRing(WORKERS)
+    for key in KEYS[:20]:
+        assert sorted(ring.walk(key)) == sorted(WORKERS)
+### -------------------------------------------------------------------------------
+
+
+def test_route_is_stable():
+    first = watcher.HashRing(WORKERS)
+    second = watcher.HashRing(list(reversed(WORKERS)))
+    for key in KEYS:
+        assert first.route(key, {}, 1) == second.route(key, {}, 1) == next(first.walk(key))
+### -------------------------------------------------------------------------------
+
+
+def test_route_spreads_the_keys():
+    ring = watcher.HashRing(WORKERS)
+    counts = {instance_id: 0 for instance_id in WORKERS}
+    for key in KEYS:
+        counts[ring.route(key, {}, 1)] += 1
+    assert min(counts.values()) > len(KEYS) / len(WORKERS) / 2
+### -------------------------------------------------------------------------------
+
+
+def test_removed_worker_moves_only_its_keys():
+    before = watcher.HashRing(WORKERS)
+    after = watcher.HashRing(WORKERS[:-1])
+    for key in KEYS:
+        owner = before.route(key, {}, 1)
+        if owner != WORKERS[-1]:
+            assert after.route(key, {}, 1) == owner
+### -------------------------------------------------------------------------------
+
+
+def test_route_skips_the_full_workers():
+    ring = watcher.HashRing(WORKERS)
+    key = KEYS[0]
+    order = list(ring.walk(key))
+    assert ring.route(key, {order[0]: 2}, 2) == order[1]
+    assert ring.route(key, {order[0]: 2, order[1]: 2}, 2) == order[2]
+    ### Every worker full: the first one on the ring
+    assert ring.route(key, {instance_id: 2 for instance_id in WORKERS}, 2) == order[0]
+### -------------------------------------------------------------------------------
+
+
+def test_route_requests_single_worker():
+    assert watcher.route_requests(['a', 'b'], {}, WORKERS[:1]) == {WORKERS[0]: ['a', 'b']}
+### -------------------------------------------------------------------------------
+
+
+def test_route_requests_by_shard_key():
+    ring = watcher.HashRing(WORKERS)
+    ### A branch whose worker differs from the one of the file name
+    branch = next(key for key in KEYS if ring.route(key, {}, 1) != ring.route('a.yaml', {}, 1))
+    routes = watcher.route_requests(['a.yaml'], {'a.yaml': {watcher.SHARD_KEY: branch}}, WORKERS)
+    assert routes == {ring.route(branch, {}, 1): ['a.yaml']}
+### -------------------------------------------------------------------------------
+
+
+def test_route_requests_bounds_the_loads():
+    file_names = [f'request-{index}.yaml' for index in range(6)]
+    file_dicts = {name: {watcher.SHARD_KEY: 'account-request'} for name in file_names}
+    routes = watcher.route_requests(file_names, file_dicts, WORKERS)
+    assert sorted(name for names in routes.values() for name in names) == sorted(file_names)
+    ### The same branch, yet no worker gets more than the load factor over the average
+    assert max(len(names) for names in routes.values()) == 3
+    assert routes[watcher.HashRing(WORKERS).route('account-request', {}, 1)] == file_names[:3]
+### -------------------------------------------------------------------------------
+
+
+def test_route_requests_without_shard_key():
+    routes = watcher.route_requests(['a.yaml'], {}, WORKERS)
+    assert routes == {watcher.HashRing(WORKERS).route('a.yaml', {}, 1): ['a.yaml']}
+### -------------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize('busy', WORKERS)
+def test_route_requests_avoids_the_busy_worker(busy):
+    file_names = [f'request-{index}.yaml' for index in range(3)]
+    lifecycle = FakeLifecycle({busy: 50})
+    routes = watcher.route_requests(file_names, {}, WORKERS, lifecycle)
+    assert busy not in routes
+    assert sum(len(names) for names in routes.values()) == len(file_names)
+### -------------------------------------------------------------------------------
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def dedup(request, tmp_path):
+    if request.param == 'memory':
+        return watcher.DedupStore()
+    return watcher.SqliteDedupStore(str(tmp_path / 'dedup.db'))
+### -------------------------------------------------------------------------------
+
+
+def test_dedup_claim_release_done(dedup, monkeypatch):
+    now = [1_700_000_000.0]
+    monkeypatch.setattr(watcher.time, 'time', lambda: now[0])
+    key = watcher.get_dedup_key('blossom-bucket', 'requests/jdoe.yaml', 'v1')
+    assert dedup.claim(key, watcher.get_dedup_lease())
+    assert not dedup.claim(key, 60)
+    ### A failed dispatch releases the key for the retry of S3
+    dedup.release(key)
+    assert dedup.claim(key, 60)
+    ### The lease of a killed invocation runs out
+    now[0] += 61
+    assert dedup.claim(key, 60)
+    dedup.mark_done(key, 3600)
+    now[0] += 3599
+    assert not dedup.claim(key, 60)
+    now[0] += 2
+    assert dedup.claim(key, 60)
+### -------------------------------------------------------------------------------
+
+
+def test_dedup_lease_covers_the_batch_window():
+    assert watcher.get_dedup_lease() == int(watcher.DEDUP_LEASE + watcher.BATCH_WINDOW)
+    assert watcher.get_dedup_lease() < watcher.DEDUP_TTL
+### -------------------------------------------------------------------------------
+
+
+def make_item(file_name: str, added_at: float, version: str = 'v1') -> dict:
+    dedup_key = watcher.get_dedup_key('blossom-bucket', file_name, version)
+    return {'item_key': dedup_key, 'added_at': added_at, 'bucket': 'blossom-bucket', 'file_name': file_name,
+            'dedup_key': dedup_key, 'request': {'branch_name': file_name, 'issue_number': '1', 'file': 'a.yaml'}}
+### -------------------------------------------------------------------------------
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def buffer(request, tmp_path):
+    return watcher.BatchBuffer() if request.param == 'memory' else watcher.SqliteBatchBuffer(str(tmp_path / 'batch.db'))
+### -------------------------------------------------------------------------------
+
+
+def test_buffer_add_pending_take(buffer):
+    (first, second) = (make_item('b.yaml', 2.0), make_item('a.yaml', 1.0))
+    buffer.add([first, second])
+    ### The S3 retry of a buffered file does not add it twice
+    buffer.add([dict(first, added_at=3.0)])
+    assert buffer.pending() == [second, first]
+    assert buffer.take([first['item_key'], 'unknown']) == [first]
+    assert buffer.take([first['item_key']]) == []
+    assert buffer.pending() == [second]
+### -------------------------------------------------------------------------------
+
+
+def test_sqlite_buffer_concurrent_take(tmp_path):
+    db_file = str(tmp_path / 'batch.db')
+    items = [make_item(f'request-{index}.yaml', float(index)) for index in range(50)]
+    watcher.SqliteBatchBuffer(db_file).add(items)
+    keys = [item['item_key'] for item in items]
+    taken = [[], []]
+
+    def take(slot: int) -> None:
+        taken[slot] = watcher.SqliteBatchBuffer(db_file).take(keys)
+
+    threads = [threading.Thread(target=take, args=(slot,)) for slot in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    ### Every item goes to exactly one of the flushes
+    assert sorted(item['item_key'] for item in taken[0] + taken[1]) == sorted(keys)
+    assert watcher.SqliteBatchBuffer(db_file).pending() == []
+### -------------------------------------------------------------------------------
+
+
+class Batch:
+    """ The buffer, the dedup store and the dispatches of flush_batch
+    """
+    def __init__(self, buffer: watcher.BatchBuffer, monkeypatch, failure: Exception = None):
+        self.buffer = buffer
+        self.dedup = watcher.DedupStore()
+        self.failure = failure
+        self.dispatched = []
+        watcher.set_batch_buffer(buffer)
+        watcher.set_dedup_store(self.dedup)
+        monkeypatch.setattr(watcher, 'dispatch_requests', self.dispatch_requests)
+
+    def dispatch_requests(self, file_names, file_dicts, context=None, metrics=None):
+        self.dispatched.append(list(file_names))
+        if self.failure:
+            raise self.failure
+        return ({'i-0aaa': list(file_names)}, {'i-0aaa': ('ok', 'Success', {}, 'cmd-1')})
+
+    def get_state(self, item: dict) -> str:
+        return self.dedup.entries.get(item['dedup_key'], ('', 0))[0]
+### -------------------------------------------------------------------------------
+
+
+@pytest.fixture
+def batch_env(monkeypatch):
+    monkeypatch.setattr(watcher, 'BATCH_WINDOW', 30.0)
+    monkeypatch.setattr(watcher, 'BATCH_MAX_FILES', 3)
+    yield monkeypatch
+    watcher.set_batch_buffer(None)
+    watcher.set_dedup_store(None)
+### -------------------------------------------------------------------------------
+
+
+def test_flush_batch_window_open(buffer, batch_env):
+    batch = Batch(buffer, batch_env)
+    assert watcher.flush_batch() == {}
+    buffer.add([make_item('a.yaml', watcher.time.time() - 10)])
+    assert watcher.flush_batch() == {}
+    assert batch.dispatched == [] and len(buffer.pending()) == 1
+### -------------------------------------------------------------------------------
+
+
+def test_flush_batch_window_closed(buffer, batch_env):
+    batch = Batch(buffer, batch_env)
+    now = watcher.time.time()
+    items = [make_item('a.yaml', now - 31), make_item('b.yaml', now - 1),
+             make_item('a.yaml', now, version='v2')]
+    buffer.add(items)
+    result = watcher.flush_batch()
+    ### One version per key: the latest
+    assert batch.dispatched == [['b.yaml', 'a.yaml']]
+    assert result == {'files': {'i-0aaa': ['b.yaml', 'a.yaml']}, 'output': {'i-0aaa': 'ok'},
+                      'command_id': {'i-0aaa': 'cmd-1'}}
+    assert buffer.pending() == []
+    assert [batch.get_state(item) for item in items] == ['done'] * 3
+### -------------------------------------------------------------------------------
+
+
+def test_flush_batch_max_files(buffer, batch_env):
+    batch = Batch(buffer, batch_env)
+    now = watcher.time.time()
+    buffer.add([make_item(f'{name}.yaml', now) for name in ('a', 'b')])
+    assert watcher.flush_batch() == {}
+    buffer.add([make_item('c.yaml', now)])
+    assert watcher.flush_batch()['files'] == {'i-0aaa': ['a.yaml', 'b.yaml', 'c.yaml']}
+    assert batch.dispatched == [['a.yaml', 'b.yaml', 'c.yaml']]
+### -------------------------------------------------------------------------------
+
+
+def test_flush_batch_rebuffers_the_pending(buffer, batch_env):
+    batch = Batch(buffer, batch_env, watcher.DispatchError('Worker i-0bbb not ready', ['b.yaml']))
+    items = [make_item(f'{name}.yaml', watcher.time.time()) for name in ('a', 'b', 'c')]
+    buffer.add(items)
+    with pytest.raises(watcher.DispatchError):
+        watcher.flush_batch()
+    ### Only the file not dispatched is retried, the sent ones are done
+    assert [item['file_name'] for item in buffer.pending()] == ['b.yaml']
+    assert [batch.get_state(item) for item in items] == ['done', '', 'done']
+### -------------------------------------------------------------------------------
+
+
+def test_flush_batch_rebuffers_on_failure(buffer, batch_env):
+    batch = Batch(buffer, batch_env, RuntimeError('SSM throttled'))
+    items = [make_item(f'{name}.yaml', watcher.time.time()) for name in ('a', 'b', 'c')]
+    buffer.add(items)
+    with pytest.raises(RuntimeError):
+        watcher.flush_batch()
+    assert sorted(item['file_name'] for item in buffer.pending()) == ['a.yaml', 'b.yaml', 'c.yaml']
+    assert [batch.get_state(item) for item in items] == [''] * 3
+### -------------------------------------------------------------------------------
+
+
+def test_flush_batch_taken_by_a_concurrent_flush(buffer, batch_env):
+    batch = Batch(buffer, batch_env)
+    buffer.add([make_item(f'{name}.yaml', watcher.time.time()) for name in ('a', 'b', 'c')])
+    take = buffer.take
+
+    def take_after_the_other(item_keys: list[str]) -> list[dict]:
+        ### The other invocation takes the items between the read and the take of this one
+        take(item_keys)
+        return take(item_keys)
+
+    batch_env.setattr(buffer, 'take', take_after_the_other)
+    assert watcher.flush_batch() == {}
+    assert batch.dispatched == []
+### -------------------------------------------------------------------------------
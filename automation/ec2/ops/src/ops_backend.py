@@ -0,0 +1,513 @@
+# =================================================================================
+# Pluggable backends of the CommandRunner commands, keyed on CommandEC2.cmd_key():
+#   cli   - every command is a subprocess (the aws CLI pays a Python+botocore start each time)
+#   boto3 - the aws CLI commands run in-process on pooled, long-lived boto3 clients
+#   stub  - canned answers for the tests and dry-runs
+#   fabric-ca-rest - the fabric-ca-client commands run in-process on keep-alive REST sessions
+# The in-process answers mimic the aws CLI: JSON stdout, the CLI error text and
+# the CLI return codes (254 service error, 255 client error, 1 for 'aws s3' commands),
+# those of fabric-ca-client its text output and 'Error: ...' with the return code 1
+import http.client
+import json
+import os
+import shlex
+import threading
+import urllib.parse
+
+# Spec+PIP ------------------------------------------------------------------------
+try:
+    import boto3
+    from botocore.config import Config
+    from botocore.exceptions import BotoCoreError, ClientError
+except ImportError:     ### Optional: the CLI backend does not need it
+    boto3 = None
+
+# Local ---------------------------------------------------------------------------
+import ops_fabric_ca
+from ops_fabric_ca import CaCredentials, FabricCaClient, FabricCaError, format_ca_identity
+from ops_yaml import EnvConfig, InfoBoard
+#==================================================================================
+
+
+def parse_cli_options(command: list[str]) -> dict:
+    """ Collects the '--option value [value ...]' of the aws CLI command
+    Args:
+        command (list[str]): The aws CLI command
+    Returns:
+        dict: option -> list of its values (the last occurrence of the option wins)
+    """
+    options = {}
+    name = None
+    for token in command:
+        if token.startswith('--'):
+            name = token[2:]
+            options[name] = []
+        elif name:
+            options[name].append(token)
+    return options
+### -------------------------------------------------------------------------------
+
+
+def get_cli_flag(command: list[str], flag: str) -> str:
+    """ The value of the short '-f value' flag of the command, '' if missing
+    """
+    if flag in command and command.index(flag) + 1 < len(command):
+        return command[command.index(flag) + 1]
+    return ''
+### -------------------------------------------------------------------------------
+
+
+def parse_ca_attributes(values: list[str]) -> list[tuple[str, str, bool]]:
+    """ Parses the fabric-ca-client 'name=value[:ecert],...' attributes (quoted as the commands pass them)
+    Returns:
+        list[tuple[str, str, bool]]: [(name, value, ecert), ...]
+    """
+    attributes = []
+    for value in values:
+        for attribute in value.strip().strip("'\"").split(','):
+            (name, _, attr_value) = attribute.partition('=')
+            ecert = attr_value.endswith(':ecert')
+            if ecert:
+                attr_value = attr_value[:-len(':ecert')]
+            if name.strip():
+                attributes.append((name.strip(), attr_value, ecert))
+    return attributes
+### -------------------------------------------------------------------------------
+
+
+def parse_cli_attributes(values: list[str]) -> list[dict]:
+    """ Parses the CLI shorthand 'Name=k,Value="v"' attributes (several may share one token)
+    Returns:
+        list[dict]: [{'Name': k, 'Value': v}, ...]
+    """
+    attributes = []
+    for value in values:
+        for shorthand in shlex.split(value):
+            (name, _, attr_value) = shorthand.partition(',Value=')
+            attributes.append({'Name': name.partition('=')[2], 'Value': attr_value})
+    return attributes
+### -------------------------------------------------------------------------------
+
+
+def as_cli_json(response: dict) -> str:
+    """ The aws CLI '--output json' rendering of the boto3 response
+    """
+    response = {k: v for (k, v) in response.items() if k != 'ResponseMetadata'}
+    return json.dumps(response, indent=4, default=lambda value: value.isoformat()
+                      if hasattr(value, 'isoformat') else str(value)) + '\n'
+### -------------------------------------------------------------------------------
+#==================================================================================
+
+
+class CommandBackend(object):
+    """ Base of the command backends: handles nothing, i.e. everything runs as a subprocess
+    """
+    name = 'cli'
+
+    def supports(self, command_key: str) -> bool:
+        return False
+    # -----------------------------------------------------------------------------
+
+    def execute(self, command_key: str, command: list[str]) -> tuple[str, str, int]:
+        """ Runs the command in-process
+        Args:
+            command_key (str): The CommandEC2 key (e.g. 'IDP_READ_USER')
+            command (list[str]): The CLI command, source of the parameters
+        Returns:
+            tuple[str, str, int]: (stdOut, stdErr, OS-ReturnCode) as the CLI would return
+        """
+        raise NotImplementedError(command_key)
+    # -----------------------------------------------------------------------------
+
+    def get_name(self, command_key: str) -> str:
+        """ The name of the backend running the command (recorded with its timing)
+        """
+        return self.name
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class Boto3Backend(CommandBackend):
+    """ In-process aws CLI: Cognito, S3 and SSM commands on pooled boto3 clients
+    """
+    name = 'boto3'
+
+    def __init__(self, region: str = None, max_pool: int = 10) -> None:
+        super().__init__()
+        self.region = region if region else None
+        self.config = Config(   max_pool_connections=max_pool,
+                                tcp_keepalive=True,
+                                retries={'mode': 'standard', 'max_attempts': 3})
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.handlers = {
+            'IDP_CREATE_USER': self.idp_create_user,
+            'IDP_READ_USER': self.idp_read_user,
+            'IDP_UPDATE_USER': self.idp_update_user,
+            'IDP_DELETE_USER': self.idp_delete_user,
+            'IDP_LIST_USERS': self.idp_list_users,
+            'S3_FILE_EXISTS': self.s3_head_object,
+            'S3_MOVE_FILE': self.s3_move_file,
+            'SSM_READ_PARAMS': self.ssm_get_parameters,
+            'SSM_DELETE_PARAMS': self.ssm_delete_parameters,
+            'SSM_PUT_CERT': self.ssm_put_parameter,
+            'SSM_PUT_MSPID': self.ssm_put_parameter,
+            'SSM_PUT_PK': self.ssm_put_parameter,
+            'SSM_PUT_ROLES': self.ssm_put_parameter,
+        }
+    # -----------------------------------------------------------------------------
+
+    def get_client(self, service: str):
+        ### boto3 clients are thread-safe, the session building them is not
+        with self.lock:
+            if service not in self.clients:
+                session = boto3.session.Session(region_name=self.region)
+                self.clients[service] = session.client(service, config=self.config)
+            return self.clients[service]
+    # -----------------------------------------------------------------------------
+
+    def supports(self, command_key: str) -> bool:
+        return command_key in self.handlers
+    # -----------------------------------------------------------------------------
+
+    def execute(self, command_key: str, command: list[str]) -> tuple[str, str, int]:
+        try:
+            return self.handlers[command_key](command)
+        except ClientError as ex:
+            error = ex.response.get('Error', {})
+            return ('', (f"\nAn error occurred ({error.get('Code', 'Unknown')}) when calling "
+                         f"the {ex.operation_name} operation: {error.get('Message', '')}\n"), 254)
+        except (BotoCoreError, OSError, ValueError, KeyError, IndexError) as ex:
+            return ('', f'\n{ex}\n', 255)
+    # -----------------------------------------------------------------------------
+
+    def idp_create_user(self, command: list[str]) -> tuple[str, str, int]:
+        options = parse_cli_options(command)
+        params = {  'UserPoolId': options['user-pool-id'][0],
+                    'Username': options['username'][0],
+                    'UserAttributes': parse_cli_attributes(options.get('user-attributes', []))}
+        if options.get('temporary-password'):
+            ### As-is, like the CLI: the same password whatever the backend
+            params['TemporaryPassword'] = options['temporary-password'][0]
+        response = self.get_client('cognito-idp').admin_create_user(**params)
+        return (as_cli_json(response), '', 0)
+    # -----------------------------------------------------------------------------
+
+    def idp_read_user(self, command: list[str]) -> tuple[str, str, int]:
+        options = parse_cli_options(command)
+        response = self.get_client('cognito-idp').admin_get_user(
+                        UserPoolId=options['user-pool-id'][0],
+                        Username=options['username'][0])
+        return (as_cli_json(response), '', 0)
+    # -----------------------------------------------------------------------------
+
+    def idp_update_user(self, command: list[str]) -> tuple[str, str, int]:
+        options = parse_cli_options(command)
+        response = self.get_client('cognito-idp').admin_update_user_attributes(
+                        UserPoolId=options['user-pool-id'][0],
+                        Username=options['username'][0],
+                        UserAttributes=parse_cli_attributes(options.get('user-attributes', [])))
+        return (as_cli_json(response), '', 0)
+    # -----------------------------------------------------------------------------
+
+    def idp_delete_user(self, command: list[str]) -> tuple[str, str, int]:
+        options = parse_cli_options(command)
+        self.get_client('cognito-idp').admin_delete_user(
+                        UserPoolId=options['user-pool-id'][0],
+                        Username=options['username'][0])
+        return ('', '', 0)
+    # -----------------------------------------------------------------------------
+
+    def idp_list_users(self, command: list[str]) -> tuple[str, str, int]:
+        ### The CLI paginates to the end unless --max-items: one 'Users' list of all the pages
+        options = parse_cli_options(command)
+        params = {'UserPoolId': options['user-pool-id'][0]}
+        if options.get('filter'):
+            params['Filter'] = options['filter'][0]
+        paginator = self.get_client('cognito-idp').get_paginator('list_users')
+        users = [user for page in paginator.paginate(**params) for user in page.get('Users', [])]
+        return (as_cli_json({'Users': users}), '', 0)
+    # -----------------------------------------------------------------------------
+
+    def ssm_get_parameters(self, command: list[str]) -> tuple[str, str, int]:
+        options = parse_cli_options(command)
+        response = self.get_client('ssm').get_parameters(
+                        Names=options['names'],
+                        WithDecryption='with-decryption' in options)
+        return (as_cli_json(response), '', 0)
+    # -----------------------------------------------------------------------------
+
+    def ssm_delete_parameters(self, command: list[str]) -> tuple[str, str, int]:
+        options = parse_cli_options(command)
+        response = self.get_client('ssm').delete_parameters(Names=options['names'])
+        return (as_cli_json(response), '', 0)
+    # -----------------------------------------------------------------------------
+
+    def ssm_put_parameter(self, command: list[str]) -> tuple[str, str, int]:
+        options = parse_cli_options(command)
+        value = options['value'][0]
+        if value.startswith('file://'):
+            ### As the CLI does: the value is the content of the file
+            with open(value[len('file://'):], encoding='utf-8') as stream:
+                value = stream.read()
+        response = self.get_client('ssm').put_parameter(
+                        Name=options['name'][0],
+                        Value=value,
+                        Type=options['type'][0],
+                        Overwrite='overwrite' in options)
+        return (as_cli_json(response), '', 0)
+    # -----------------------------------------------------------------------------
+
+    def s3_head_object(self, command: list[str]) -> tuple[str, str, int]:
+        options = parse_cli_options(command)
+        response = self.get_client('s3').head_object(
+                        Bucket=options['bucket'][0],
+                        Key=options['key'][0])
+        return (as_cli_json(response), '', 0)
+    # -----------------------------------------------------------------------------
+
+    def s3_move_file(self, command: list[str]) -> tuple[str, str, int]:
+        ### aws s3 mv s3://<bucket>/<key> <local-file>
+        (source, target) = [token for token in command[3:] if not token.startswith('--')][:2]
+        (bucket, _, key) = source[len('s3://'):].partition('/')
+        if os.path.dirname(target):
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+        client = self.get_client('s3')
+        try:
+            client.download_file(bucket, key, target)
+            client.delete_object(Bucket=bucket, Key=key)
+        except ClientError as ex:
+            ### The high-level 'aws s3' commands report the failures as 'fatal error' with code 1
+            error = ex.response.get('Error', {})
+            return ('', (f"fatal error: An error occurred ({error.get('Code', 'Unknown')}) when calling "
+                         f"the {ex.operation_name} operation: {error.get('Message', '')}\n"), 1)
+        return (f'move: {source} to {target}\n', '', 0)
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class StubBackend(CommandBackend):
+    """ Canned answers for the tests: command-key -> (stdOut, stdErr, code) or callable(command)
+    """
+    name = 'stub'
+
+    def __init__(self, responses: dict = None) -> None:
+        super().__init__()
+        self.responses = dict(responses) if responses else {}
+        self.calls = []
+    # -----------------------------------------------------------------------------
+
+    def supports(self, command_key: str) -> bool:
+        return command_key in self.responses
+    # -----------------------------------------------------------------------------
+
+    def execute(self, command_key: str, command: list[str]) -> tuple[str, str, int]:
+        self.calls.append((command_key, list(command)))
+        response = self.responses[command_key]
+        return response(command) if callable(response) else response
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+class FabricCaBackend(CommandBackend):
+    """ In-process fabric-ca-client: identity lookup, register and enroll on keep-alive REST sessions
+    """
+    name = 'fabric-ca-rest'
+
+    def __init__(self, ca_url: str, msp_dir: str, tls_cert: str = None, ca_name: str = '') -> None:
+        super().__init__()
+        self.ca_url = ca_url
+        self.msp_dir = msp_dir
+        self.tls_cert = tls_cert if tls_cert else None
+        self.ca_name = ca_name
+        self.clients = {}
+        self.registrars = {}
+        self.lock = threading.Lock()
+        self.handlers = {
+            'AMB_READ_USER': self.amb_read_user,
+            'AMB_LIST_USERS': self.amb_list_users,
+            'AMB_REGISTER_USER': self.amb_register_user,
+            'AMB_ENROLL_USER': self.amb_enroll_user,
+            'AMB_UPDATE_USER': self.amb_update_user,
+            'AMB_REMOVE_USER': self.amb_remove_user,
+        }
+    # -----------------------------------------------------------------------------
+
+    def get_client(self, url: str, tls_cert: str = None) -> FabricCaClient:
+        """ The client of the CA the URL points at (its userinfo aside), one per CA and TLS root
+        """
+        parts = urllib.parse.urlsplit(url if '://' in url else f'https://{url}')
+        tls_cert = tls_cert if tls_cert else self.tls_cert
+        key = (parts.scheme, parts.hostname, parts.port, tls_cert)
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = FabricCaClient(url, tls_cert, self.ca_name)
+            return self.clients[key]
+    # -----------------------------------------------------------------------------
+
+    def get_registrar(self, msp_dir: str = None) -> CaCredentials:
+        ### Read once: the registrar signs every lookup and register
+        msp_dir = msp_dir if msp_dir else self.msp_dir
+        with self.lock:
+            if msp_dir not in self.registrars:
+                self.registrars[msp_dir] = CaCredentials.from_msp(msp_dir)
+            return self.registrars[msp_dir]
+    # -----------------------------------------------------------------------------
+
+    def supports(self, command_key: str) -> bool:
+        return command_key in self.handlers
+    # -----------------------------------------------------------------------------
+
+    def execute(self, command_key: str, command: list[str]) -> tuple[str, str, int]:
+        try:
+            return self.handlers[command_key](command)
+        except FabricCaError as ex:
+            return ('', f'Error: Response from server: {ex}\n', 1)
+        except (OSError, http.client.HTTPException) as ex:
+            return ('', f'Error: Request to the CA failed: {ex}\n', 1)
+        except (ValueError, KeyError, IndexError) as ex:
+            return ('', f'Error: {ex}\n', 1)
+    # -----------------------------------------------------------------------------
+
+    def get_command_client(self, command: list[str]) -> FabricCaClient:
+        options = parse_cli_options(command)
+        tls_cert = options['tls.certfiles'][0] if options.get('tls.certfiles') else None
+        return self.get_client(get_cli_flag(command, '-u') or self.ca_url, tls_cert)
+    # -----------------------------------------------------------------------------
+
+    def amb_read_user(self, command: list[str]) -> tuple[str, str, int]:
+        ### fabric-ca-client identity list --id <ID> --tls.certfiles <PEM>
+        options = parse_cli_options(command)
+        registrar = self.get_registrar(options['mspdir'][0] if options.get('mspdir') else None)
+        identity = self.get_command_client(command).get_identity(registrar, options['id'][0])
+        return (format_ca_identity(identity), '', 0)
+    # -----------------------------------------------------------------------------
+
+    def amb_list_users(self, command: list[str]) -> tuple[str, str, int]:
+        ### fabric-ca-client identity list --tls.certfiles <PEM>
+        options = parse_cli_options(command)
+        registrar = self.get_registrar(options['mspdir'][0] if options.get('mspdir') else None)
+        identities = self.get_command_client(command).get_identities(registrar)
+        return (''.join(format_ca_identity(identity) for identity in identities), '', 0)
+    # -----------------------------------------------------------------------------
+
+    def amb_register_user(self, command: list[str]) -> tuple[str, str, int]:
+        ### fabric-ca-client register -u <CA_URL> --mspdir <REGISTRAR> --id.name .. --id.secret .. --id.type .. --id.attrs ..
+        options = parse_cli_options(command)
+        registrar = self.get_registrar(options['mspdir'][0] if options.get('mspdir') else None)
+        attributes = [{'name': name, 'value': value, 'ecert': ecert}
+                      for (name, value, ecert) in parse_ca_attributes(options.get('id.attrs', []))]
+        secret = self.get_command_client(command).register(
+                        registrar,
+                        options['id.name'][0],
+                        secret=options['id.secret'][0] if options.get('id.secret') else '',
+                        identity_type=options['id.type'][0] if options.get('id.type') else 'client',
+                        affiliation=options['id.affiliation'][0] if options.get('id.affiliation') else '',
+                        attrs=attributes,
+                        max_enrollments=int(options['id.maxenrollments'][0]) if options.get('id.maxenrollments') else 0)
+        return (f'Password: {secret}\n', '', 0)
+    # -----------------------------------------------------------------------------
+
+    def amb_enroll_user(self, command: list[str]) -> tuple[str, str, int]:
+        ### fabric-ca-client enroll -u https://<ID>:<SECRET>@<CA_HOST>:<PORT> -M <MSP_DIR> --enrollment.attrs ..
+        options = parse_cli_options(command)
+        parts = urllib.parse.urlsplit(get_cli_flag(command, '-u'))
+        if not parts.username:
+            raise ValueError('The enrollment URL has no <ID>:<SECRET>@')
+        ### The CLI sends the requested attributes as required ones (no ':opt' suffix)
+        attr_reqs = [{'name': name, 'optional': False}
+                     for (name, _, _) in parse_ca_attributes(options.get('enrollment.attrs', []))]
+        cert_file = self.get_command_client(command).enroll(
+                        urllib.parse.unquote(parts.username),
+                        urllib.parse.unquote(parts.password or ''),
+                        get_cli_flag(command, '-M') or 'msp',
+                        attr_reqs)
+        return ('', f'Stored client certificate at {cert_file}\n', 0)
+    # -----------------------------------------------------------------------------
+
+    def amb_update_user(self, command: list[str]) -> tuple[str, str, int]:
+        ### fabric-ca-client identity modify <ID> --attrs 'blossom.role=..' --tls.certfiles <PEM>
+        options = parse_cli_options(command)
+        registrar = self.get_registrar(options['mspdir'][0] if options.get('mspdir') else None)
+        attributes = [{'name': name, 'value': value, 'ecert': ecert}
+                      for (name, value, ecert) in parse_ca_attributes(options.get('attrs', []))]
+        identity = self.get_command_client(command).modify_identity(registrar, command[3], attributes)
+        return (f'Successfully modified identity - {format_ca_identity(identity)}', '', 0)
+    # -----------------------------------------------------------------------------
+
+    def amb_remove_user(self, command: list[str]) -> tuple[str, str, int]:
+        ### fabric-ca-client identity remove <ID> [--force] --tls.certfiles <PEM>
+        options = parse_cli_options(command)
+        registrar = self.get_registrar(options['mspdir'][0] if options.get('mspdir') else None)
+        identity = self.get_command_client(command).remove_identity(registrar, command[3], '--force' in command)
+        return (f'Successfully removed identity - {format_ca_identity(identity)}', '', 0)
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class CompositeBackend(CommandBackend):
+    """ Routes each command to the first of the backends supporting it
+    """
+    name = 'composite'
+
+    def __init__(self, backends: list[CommandBackend]) -> None:
+        super().__init__()
+        self.backends = [backend for backend in backends if backend]
+    # -----------------------------------------------------------------------------
+
+    def get_backend_of(self, command_key: str) -> CommandBackend:
+        return next((backend for backend in self.backends if backend.supports(command_key)), None)
+    # -----------------------------------------------------------------------------
+
+    def supports(self, command_key: str) -> bool:
+        return self.get_backend_of(command_key) is not None
+    # -----------------------------------------------------------------------------
+
+    def execute(self, command_key: str, command: list[str]) -> tuple[str, str, int]:
+        return self.get_backend_of(command_key).execute(command_key, command)
+    # -----------------------------------------------------------------------------
+
+    def get_name(self, command_key: str) -> str:
+        backend = self.get_backend_of(command_key)
+        return backend.get_name(command_key) if backend else CommandBackend.name
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+_BACKEND = []
+
+
+def get_backend() -> CommandBackend:
+    if not _BACKEND:
+        _BACKEND.append(CommandBackend())
+    return _BACKEND[0]
+### -------------------------------------------------------------------------------
+
+
+def set_backend(backend: CommandBackend) -> None:
+    _BACKEND[:] = [backend] if backend else []
+### -------------------------------------------------------------------------------
+
+
+def make_backend(envInfo: EnvConfig) -> CommandBackend:
+    """ Builds the backend named by env/bat/command-backend (cli|boto3|stub),
+        the Fabric-CA commands go to the one of env/bat/ca-backend (cli|fabric-ca-rest)
+    """
+    backend = CommandBackend()
+    name = envInfo.get_bat_command_backend()
+    if name == Boto3Backend.name:
+        if boto3:
+            backend = Boto3Backend(envInfo.get_aws_region(), envInfo.get_bat_max_parallel() * 2)
+        else:
+            InfoBoard.pin_warning('boto3 is not installed: the aws CLI runs the commands')
+    elif name == StubBackend.name:
+        return StubBackend()
+
+    if envInfo.get_bat_ca_backend() == FabricCaBackend.name:
+        if ops_fabric_ca.is_available():
+            return CompositeBackend([FabricCaBackend(envInfo.get_amb_ca_url(),
+                                                     envInfo.get_amb_msp_dir(),
+                                                     envInfo.get_amb_tls_cert(),
+                                                     envInfo.get_amb_ca_name()),
+                                     backend])
+        InfoBoard.pin_warning('cryptography is not installed: fabric-ca-client runs the Fabric-CA commands')
+    return backend
+### -------------------------------------------------------------------------------
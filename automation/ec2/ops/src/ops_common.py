@@ -1,13 +1,22 @@
+import asyncio
+import hashlib
 import json
 import logging
 import os
+import re
+import shutil
 import subprocess
 import sys
+import threading
+import time
 import traceback
 import xml.dom.minidom
 
 # From ----------------------------------------------------------------------------
-from datetime import datetime
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timezone
 from enum import Enum, unique
 from io import StringIO
 from pprint import pprint
@@ -17,6 +26,26 @@ from uuid import UUID, uuid4
 import click
 import yaml
 
+try:
+    import fcntl
+except ImportError:     ### POSIX only: the locks hold within the run only elsewhere
+    fcntl = None
+
+import ops_fabric_ca
+from ops_backend import get_backend, get_cli_flag, make_backend, parse_cli_options, set_backend
+from ops_fabric_ca import format_ca_identity, get_msp_files, parse_ca_identities, read_msp_enrollment
+from ops_limits import get_guard, make_guards, set_guards
+from ops_store import (
+    CaIdentityStore,
+    CommandTimer,
+    DedupStore,
+    EnrollmentStore,
+    JournalStore,
+    MemoStore,
+    SsmParamStore,
+    TimingStore,
+    get_file_md5,
+)
 from ops_xsl import XmlFragmentOps
 
 # Local ---------------------------------------------------------------------------
@@ -43,7 +72,405 @@ def is_uuid_valid(uuid_to_test, version=4) -> bool:
     return str(uuid_obj) == uuid_to_test
 #==================================================================================
 
+class MeasuredPopen(subprocess.Popen):
+    """ Popen reaping the child with wait4, so the resource usage is the child's own
+        (the RUSAGE_CHILDREN delta mixes the concurrently running commands)
+    """
+    rusage = None
+
+    def _try_wait(self, wait_flags):
+        if not hasattr(os, 'wait4'):
+            return super()._try_wait(wait_flags)
+        try:
+            (pid, sts, rusage) = os.wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            ### Reaped elsewhere (e.g. SIGCHLD ignored), as the Popen itself does
+            return (self.pid, 0)
+        if pid == self.pid:
+            self.rusage = rusage
+        return (pid, sts)
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+class BoundedText(str):
+    """ The head and tail of a long output, knowing the size of the whole
+    """
+    total_lines: int = 0
+    total_bytes: int = 0
+    skipped: int = 0
+#==================================================================================
+
+class BoundedCapture(object):
+    """ Head + tail ring buffer of the output lines, the whole output only if kept
+    """
+
+    def __init__(self, head: int = 20, tail: int = 50, keep_all: bool = False) -> None:
+        super().__init__()
+        self.head = []
+        self.head_max = head
+        self.tail = deque(maxlen=tail)
+        self.all = [] if keep_all else None
+        self.total_lines = 0
+        self.total_bytes = 0
+    # -----------------------------------------------------------------------------
+
+    def add(self, line: str) -> None:
+        self.total_lines += 1
+        self.total_bytes += len(line.encode('utf-8', 'replace'))
+        if self.all is not None:
+            self.all.append(line)
+        if len(self.head) < self.head_max:
+            self.head.append(line)
+        else:
+            self.tail.append(line)
+    # -----------------------------------------------------------------------------
+
+    def get_text(self) -> str:
+        """ Returns:
+            str: The whole output if kept, BoundedText of the head and tail otherwise
+        """
+        if self.all is not None:
+            return ''.join(self.all)
+        skipped = self.total_lines - len(self.head) - len(self.tail)
+        text = BoundedText(''.join(self.head)
+                           + (f'... [{skipped} line(s) skipped] ...\n' if skipped > 0 else '')
+                           + ''.join(self.tail))
+        (text.total_lines, text.total_bytes, text.skipped) = (self.total_lines, self.total_bytes, skipped)
+        return text
+    # -----------------------------------------------------------------------------
+
+    @classmethod
+    def bound(cls, text, head: int = 20, tail: int = 50):
+        """ The head and tail of the text for the logs, anything else as-is
+        """
+        if not isinstance(text, str) or isinstance(text, BoundedText) or text.count('\n') <= head + tail:
+            return text
+        capture = cls(head, tail)
+        for line in text.splitlines(keepends=True):
+            capture.add(line)
+        return capture.get_text()
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+class CommandMemo(object):
+    """ Memoization of the read-only commands, keyed on the exact command vector:
+        per-run dict, plus the optional TTL MemoStore shared across the runs
+    """
+    ### The 'user does not exist' answers are as good to remember as the found users
+    ABSENT_MARKERS = ('UserNotFoundException', 'User does not exist', 'Error Code: 63')
+
+    def __init__(self, store: MemoStore = None, ttl: int = 0) -> None:
+        super().__init__()
+        self.store = store if store and ttl > 0 else None
+        self.ttl = ttl
+        self.entries = dict()   ### memo-key -> (family, identity, (stdOut, stdErr, OS-ReturnCode))
+        self.lock = threading.Lock()
+    # -----------------------------------------------------------------------------
+
+    def get_memo_key(self, command: list) -> str:
+        return json.dumps(command)
+    # -----------------------------------------------------------------------------
+
+    def is_cacheable(self, result: tuple) -> bool:
+        (out, err, code) = result
+        return code == 0 or any(marker in str(err) for marker in self.ABSENT_MARKERS)
+    # -----------------------------------------------------------------------------
+
+    def get(self, command: list) -> tuple:
+        memo_key = self.get_memo_key(command)
+        with self.lock:
+            if memo_key in self.entries:
+                return self.entries[memo_key][2]
+        return self.store.get(memo_key) if self.store else None
+    # -----------------------------------------------------------------------------
+
+    def put(self, family: str, identity: str, command: list, result: tuple) -> None:
+        if not self.is_cacheable(result):
+            return
+        memo_key = self.get_memo_key(command)
+        with self.lock:
+            self.entries[memo_key] = (family, identity, result)
+        if self.store:
+            self.store.put(memo_key, family, identity, result, self.ttl)
+    # -----------------------------------------------------------------------------
+
+    def invalidate(self, family: str, identity: str) -> None:
+        """ Forgets every read of the identity in the family (e.g. IDP/jdoe)
+        """
+        with self.lock:
+            for memo_key in [key for (key, entry) in self.entries.items() 
+                             if entry[0] == family and entry[1] == identity]:
+                del self.entries[memo_key]
+        if self.store:
+            self.store.invalidate(family, identity)
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+class CaIdentityIndex(object):
+    """ The Fabric-CA identities of one bulk 'identity list': id -> identity for O(1) existence/role queries
+        Fetched once per run, or once per TTL with the CaIdentityStore shared across the runs
+    """
+    ROLE_ATTR = 'blossom.role'
+    NOT_FOUND = 'Error: Response from server: Error Code: 63 - Failed to get User: sql: no rows in result set\n'
+
+    def __init__(self, store: CaIdentityStore = None, ttl: int = 0) -> None:
+        super().__init__()
+        self.store = store if store and ttl > 0 else None
+        self.ttl = ttl
+        self.identities = None  ### id -> identity (REST shape), None until fetched
+        self.failed = False     ### The bulk list failed: the per-user lookups it is for this run
+        self.stale = set()      ### Changed since the fetch: only the per-user lookup knows them
+        self.lock = threading.Lock()
+    # -----------------------------------------------------------------------------
+
+    def load(self, fetch: callable) -> bool:
+        """ Fetches the identities once (the TTL store first)
+        Args:
+            fetch (callable): Runs the bulk 'identity list', returns (stdOut, stdErr, OS-ReturnCode)
+        Returns:
+            bool: True if the index answers the lookups
+        """
+        with self.lock:
+            if self.identities is not None or self.failed:
+                return self.identities is not None
+            identities = self.store.load(self.ttl) if self.store else None
+            if identities is None:
+                (out, err, code) = fetch()[:3]
+                identities = parse_ca_identities(out) if code == 0 else {}
+                if not identities:
+                    ### Even an empty CA lists its registrar: a failed or unparsable list answers nothing
+                    self.failed = True
+                    InfoBoard.pin_warning(f'Fabric-CA identity list failed with code {code}: {err}\n'
+                                          f'The identities are looked up one by one')
+                    return False
+                if self.store:
+                    self.store.save(identities)
+            self.identities = identities
+            return True
+    # -----------------------------------------------------------------------------
+
+    def knows(self, identity_id: str) -> bool:
+        return self.identities is not None and identity_id not in self.stale
+    # -----------------------------------------------------------------------------
+
+    def get(self, identity_id: str) -> dict:
+        """ Returns:
+            dict: The identity (id, type, affiliation, max_enrollments, attrs), None if absent or unknown
+        """
+        return self.identities.get(identity_id) if self.knows(identity_id) else None
+    # -----------------------------------------------------------------------------
+
+    def get_read_result(self, identity_id: str) -> tuple:
+        """ The AMB_READ_USER answer out of the index
+        Returns:
+            tuple: (stdOut, stdErr, OS-ReturnCode) as fabric-ca-client gives, None if the index does not know
+        """
+        if not self.knows(identity_id):
+            return None
+        identity = self.identities.get(identity_id)
+        return (format_ca_identity(identity), '', 0) if identity else ('', self.NOT_FOUND, 1)
+    # -----------------------------------------------------------------------------
+
+    def invalidate(self, identity_id: str) -> None:
+        """ The identity changed (registered, removed, ...): the lookup asks the CA again,
+            the next run fetches a fresh list
+        """
+        with self.lock:
+            self.stale.add(identity_id)
+        if self.store:
+            self.store.expire()
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+class EnrollmentIndex(object):
+    """ The enrolled Fabric client identities of amb/clients-dir (role, certificate serial and expiry, MSP files),
+        recorded by the enrollments: who is enrolled and until when is a query, not a walk of the MSP directories
+    """
+
+    def __init__(self, store: EnrollmentStore = None, clients_dir: str = '') -> None:
+        super().__init__()
+        ### The certificates need the cryptography package: no index without it
+        self.store = store if store and ops_fabric_ca.is_available() else None
+        self.clients_dir = clients_dir
+    # -----------------------------------------------------------------------------
+
+    def read(self, msp_dir: str) -> dict:
+        enrollment = read_msp_enrollment(msp_dir)
+        ### <clients-dir>/<id>/msp as AMB_ENROLL_USER writes it
+        enrollment['identity'] = os.path.basename(os.path.dirname(os.path.normpath(msp_dir)))
+        enrollment['role'] = enrollment['attrs'].get(CaIdentityIndex.ROLE_ATTR, '')
+        return enrollment
+    # -----------------------------------------------------------------------------
+
+    def index(self, msp_dir: str) -> dict:
+        """ Records the enrollment the MSP directory holds now
+        Returns:
+            dict: The enrollment indexed, None if not
+        """
+        if not (self.store and msp_dir):
+            return None
+        try:
+            enrollment = self.read(msp_dir)
+        except (OSError, ValueError) as ex:
+            InfoBoard.pin_warning(f'The enrollment of {msp_dir} is not indexed: {ex}')
+            return None
+        self.store.record(enrollment)
+        return enrollment
+    # -----------------------------------------------------------------------------
+
+    def forget(self, identity_id: str) -> None:
+        if self.store and identity_id:
+            self.store.forget(identity_id)
+    # -----------------------------------------------------------------------------
+
+    def get(self, identity_id: str) -> dict:
+        return self.store.get(identity_id) if self.store else None
+    # -----------------------------------------------------------------------------
+
+    def get_expiring(self, before: float = None) -> list[dict]:
+        return self.store.get_expiring(before) if self.store else []
+    # -----------------------------------------------------------------------------
+
+    def rebuild(self) -> tuple[int, list[str]]:
+        """ Indexes every <clients-dir>/<id>/msp anew (e.g. the enrollments made before the index)
+        Returns:
+            tuple[int, list[str]]: (the enrollments indexed, the MSP directories not readable with the error)
+        """
+        (enrollments, failed) = ([], [])
+        names = sorted(os.listdir(self.clients_dir)) if os.path.isdir(self.clients_dir) else []
+        for msp_dir in [os.path.join(self.clients_dir, name, 'msp') for name in names]:
+            if not os.path.isdir(msp_dir):
+                continue
+            try:
+                enrollments.append(self.read(msp_dir))
+            except (OSError, ValueError) as ex:
+                failed.append(f'{msp_dir}: {ex}')
+        self.store.replace(enrollments)
+        return (len(enrollments), failed)
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+class StepJournal(object):
+    """ The completed steps of one request and their outputs (e.g. the Cognito UUID),
+        durable with the JournalStore: a retry of the request resumes after them
+    """
+
+    def __init__(self, store: JournalStore = None, request_key: str = '') -> None:
+        super().__init__()
+        self.store = store if store and request_key else None
+        self.request_key = request_key
+        self.steps = self.store.load(request_key) if self.store else {}
+        if self.steps:
+            InfoBoard.pin_info(f'Resuming {request_key} after the step(s):\n\t' + '\n\t'.join(self.steps))
+    # -----------------------------------------------------------------------------
+
+    @staticmethod
+    def get_journal_key(s3_file: str, rec_file: str) -> str:
+        ### The content, not the S3 version: the retry finds the REC-file moved already
+        return f'{s3_file}/{get_file_md5(rec_file)}'
+    # -----------------------------------------------------------------------------
+
+    def is_done(self, step: str) -> bool:
+        return step in self.steps
+    # -----------------------------------------------------------------------------
+
+    def get(self, step: str) -> dict:
+        return self.steps.get(step)
+    # -----------------------------------------------------------------------------
+
+    def done(self, step: str, output: dict = None) -> None:
+        self.steps[step] = output or {}
+        if self.store:
+            self.store.record(self.request_key, step, self.steps[step])
+    # -----------------------------------------------------------------------------
+
+    def forget(self, steps: list[str]) -> None:
+        for step in steps:
+            self.steps.pop(step, None)
+        if self.store:
+            self.store.forget(self.request_key, steps)
+    # -----------------------------------------------------------------------------
+
+    def clear(self) -> None:
+        ### The request completed: nothing to resume
+        self.steps = {}
+        if self.store:
+            self.store.forget(self.request_key)
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+class LockTable(object):
+    """ Named locks of the identities ('user:<id>') and the SSP files ('ssp:<repo>#<branch>:<ssp>'),
+        held across the threads of the run and, with the lock-dir, across the concurrent runs (flock of a file per name)
+    """
+
+    def __init__(self, lock_dir: str = None) -> None:
+        super().__init__()
+        self.lock_dir = lock_dir if lock_dir and fcntl else None
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+        self.locks = {}     ### name -> threading.Lock of the run
+        self.lock = threading.Lock()
+    # -----------------------------------------------------------------------------
+
+    def get_lock_file(self, name: str) -> str:
+        ### Readable, the hash keeps the names apart that read the same
+        return os.path.join(self.lock_dir, re.sub(r'[^A-Za-z0-9._-]+', '_', name)[:80] 
+                            + f'-{hashlib.md5(name.encode("utf-8")).hexdigest()[:8]}.lock')
+    # -----------------------------------------------------------------------------
+
+    @contextmanager
+    def hold_one(self, name: str):
+        with self.lock:
+            lock = self.locks.setdefault(name, threading.Lock())
+        if not lock.acquire(blocking=False):
+            APP.debug(f'Waiting for the lock of {name}')
+            lock.acquire()
+        try:
+            if not self.lock_dir:
+                yield
+                return
+            with open(self.get_lock_file(name), 'a') as stream:
+                try:
+                    fcntl.flock(stream, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    APP.debug(f'Waiting for the lock of {name} held by another run')
+                    fcntl.flock(stream, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(stream, fcntl.LOCK_UN)
+        finally:
+            lock.release()
+    # -----------------------------------------------------------------------------
+
+    @contextmanager
+    def hold(self, names: list[str]):
+        """ Takes the locks in the name order (the holders of several never deadlock), releases them at exit
+        """
+        with ExitStack() as stack:
+            for name in sorted(set(name for name in names if name)):
+                stack.enter_context(self.hold_one(name))
+            yield
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
 class CommandRunner(object):
+    ### Run-scope memo of the read-only commands, process-s3-file adds the TTL store
+    MEMO: CommandMemo = CommandMemo()
+    ### Timings of the commands, process-s3-file adds the store
+    TIMER: CommandTimer = CommandTimer()
+    ### The bulk-fetched Fabric-CA identities answering AMB_READ_USER, process-s3-file adds the TTL store
+    CA_INDEX: CaIdentityIndex = CaIdentityIndex()
+    ### The identity and SSP locks of the concurrent requests, process-s3-file adds the lock-dir
+    LOCKS: LockTable = LockTable()
+    ### The enrolled client identities, process-s3-file adds the store
+    ENROLLMENTS: EnrollmentIndex = EnrollmentIndex()
+    ### Streamed, nobody parses their (possibly long, progress-like) output: only its head/tail is kept
+    STREAMED_COMMANDS = ('DEB_PRINT_ENV', 'GIT_CLONE_REPO', 'GIT_PULL_ALL', 'GIT_PUSH_CHANGES')
+    ### Lines of the output kept for the logs
+    LOG_HEAD_LINES = 20
+    LOG_TAIL_LINES = 50
 
     def __init__(self) -> None:
         super().__init__()
@@ -68,6 +495,184 @@ class CommandRunner(object):
         return ' '.join(command)    
     # -----------------------------------------------------------------------------
 
+    def get_command_id(self, command: list):
+        """ Returns:
+            CommandEC2: The ID of the command in self.commands, None for an ad-hoc command
+        """
+        for (command_id, known) in (self.commands or {}).items():
+            if known is command:
+                return command_id
+        return None
+    # -----------------------------------------------------------------------------
+
+    def get_command_key(self, command: list) -> str:
+        """ The CommandEC2 key of the command, the backends are keyed on it
+        Returns:
+            str: e.g. 'IDP_READ_USER', None for an ad-hoc command
+        """
+        command_id = self.get_command_id(command)
+        return command_id.cmd_key() if command_id else None
+    # -----------------------------------------------------------------------------
+
+    def get_timing_kind(self, command: list) -> str:
+        ### The CommandEC2 key, the program name of the ad-hoc commands
+        return self.get_command_key(command) or os.path.basename(command[0])
+    # -----------------------------------------------------------------------------
+
+    def is_streamed(self, command: list) -> bool:
+        return self.get_command_key(command) in self.STREAMED_COMMANDS
+    # -----------------------------------------------------------------------------
+
+    def run_process(self, 
+                    command: list[str], 
+                    on_line: callable = None, 
+                    keep_all: bool = True) -> tuple[str, str, int, object]:
+        """ Runs the command as a subprocess, collecting the child resource usage
+        Args:
+            command (list): Command list[str] as required by Python subprocess module
+            on_line (callable, optional): Streaming: called with (stream-name, line) as the lines arrive. Defaults to None.
+            keep_all (bool, optional): Keeps the whole output, only its head and tail otherwise. Defaults to True.
+        Returns:
+            tuple[str, str, int, object]: (stdOut, stdErr, OS-ReturnCode, resource.struct_rusage or None)
+        """
+        if keep_all and not on_line:
+            with MeasuredPopen(command, encoding='utf-8', errors='replace',
+                               stdout=subprocess.PIPE, 
+                               stderr=subprocess.PIPE, 
+                               stdin=subprocess.PIPE) as proc:
+                (out, err) = proc.communicate()
+            return (out, err, proc.returncode, proc.rusage)
+
+        ### Streaming: the output is read as it comes, never held whole unless kept
+        captures = {name: BoundedCapture(self.LOG_HEAD_LINES, self.LOG_TAIL_LINES, keep_all)
+                    for name in ('stdout', 'stderr')}
+        lock = threading.Lock()
+        def pump(name: str, pipe) -> None:
+            nonlocal on_line
+            for line in pipe:
+                captures[name].add(line)
+                if not on_line:
+                    continue
+                with lock:  ### One line at a time, whatever stream it comes from
+                    try:
+                        on_line(name, line)
+                    except Exception as ex:
+                        ### Keep draining the pipe: a stuck pipe would block the child
+                        APP.debug(f'Line callback of {self.get_command_text(command)} failed: {ex}')
+                        on_line = None
+        with MeasuredPopen(command, encoding='utf-8', errors='replace', bufsize=1,
+                           stdout=subprocess.PIPE, 
+                           stderr=subprocess.PIPE, 
+                           stdin=subprocess.DEVNULL) as proc:
+            readers = [threading.Thread(target=pump, args=(name, pipe), daemon=True)
+                       for (name, pipe) in (('stdout', proc.stdout), ('stderr', proc.stderr))]
+            for reader in readers:
+                reader.start()
+            for reader in readers:
+                reader.join()
+            proc.wait()
+        return (captures['stdout'].get_text(), captures['stderr'].get_text(), proc.returncode, proc.rusage)
+    # -----------------------------------------------------------------------------
+
+    @staticmethod
+    def json_events(on_event: callable) -> callable:
+        """ Adapts the JSON-event callback (stream-name, dict) to the line callback of run_process:
+            the lines holding a JSON object become events, the rest is ignored
+        """
+        def on_line(name: str, line: str) -> None:
+            text = line.strip()
+            if text.startswith('{') and text.endswith('}'):
+                try:
+                    event = json.loads(text)
+                except ValueError:
+                    return
+                on_event(name, event)
+        return on_line
+    # -----------------------------------------------------------------------------
+
+    def run_guarded(self, command: list, run: callable) -> tuple:
+        """ Runs the Cognito/Fabric-CA command within the limits of its service
+            (rate limit, jittered retry of the throttled calls, circuit breaker)
+        Args:
+            command (list): The command (locates the service)
+            run (callable): Runs the command, returns (stdOut, stdErr, OS-ReturnCode, ...)
+        """
+        command_key = self.get_command_key(command)
+        guard = get_guard(CommandEC2[command_key].get_family()) if command_key else None
+        return guard.call(run) if guard else run()
+    # -----------------------------------------------------------------------------
+
+    def run_plain(self, command: list) -> tuple[str, str, int]:
+        """ Runs the command (backend or subprocess, guarded and timed) without touching the runner state
+            nor the memo, e.g. a fetch on behalf of another command
+        Returns:
+            tuple[str, str, int]: (stdOut, stdErr, OS-ReturnCode)
+        """
+        command_key = self.get_command_key(command)
+        (usage, backend) = (None, 'cli')
+        start = time.perf_counter()
+        try:
+            if command_key and get_backend().supports(command_key):
+                backend = get_backend().get_name(command_key)
+                (out, err, code) = self.run_guarded(command, lambda: get_backend().execute(command_key, command))[:3]
+            else:
+                (out, err, code, usage) = self.run_guarded(command, lambda: self.run_process(command))
+        except Exception as ex:
+            return (None, f"Command \n\t{command}\nFailed with exception: \n\t{ex}", f"-101")
+        self.TIMER.record(self.get_timing_kind(command), backend,
+                          (time.perf_counter() - start) * 1000, code, out, usage)
+        return (out, err, code)
+    # -----------------------------------------------------------------------------
+
+    def get_identity(self, command: list) -> str:
+        """ The identity the command reads or changes: --username, --id or --id.name value,
+            the <ID> of 'fabric-ca-client identity modify|remove <ID>'
+        """
+        if command[1:3] in (['identity', 'modify'], ['identity', 'remove']) and len(command) > 3:
+            return command[3]
+        options = parse_cli_options(command)
+        for name in ('username', 'id', 'id.name'):
+            if options.get(name):
+                return options[name][0]
+        return ''
+    # -----------------------------------------------------------------------------
+
+    def recall(self, command: list) -> tuple:
+        """ Returns:
+            tuple: The memoized (stdOut, stdErr, OS-ReturnCode) of the read-only command, None otherwise
+        """
+        command_id = self.get_command_id(command)
+        if command_id == CommandEC2.AMB_READ_USER and CommandEC2.AMB_LIST_USERS in self.commands:
+            ### One bulk list per run instead of an 'identity list --id' per user
+            index = CommandRunner.CA_INDEX
+            if index.load(lambda: self.run_plain(self.commands[CommandEC2.AMB_LIST_USERS])):
+                result = index.get_read_result(self.get_identity(command))
+                if result:
+                    return result
+        if command_id and command_id.is_read_only():
+            return CommandRunner.MEMO.get(command)
+        return None
+    # -----------------------------------------------------------------------------
+
+    def memoize(self, command: list, result: tuple) -> None:
+        """ Remembers the read-only result, or forgets the reads of the identity 
+            the successful mutating command just changed (and (re)indexes or forgets its enrollment)
+        """
+        command_id = self.get_command_id(command)
+        if not command_id:
+            return
+        if command_id.is_read_only():
+            CommandRunner.MEMO.put(command_id.get_family(), self.get_identity(command), command, result)
+        elif command_id.is_mutating() and result[2] == 0:
+            CommandRunner.MEMO.invalidate(command_id.get_family(), self.get_identity(command))
+            if command_id.get_family() == 'AMB' and self.get_identity(command):
+                CommandRunner.CA_INDEX.invalidate(self.get_identity(command))
+            if command_id == CommandEC2.AMB_ENROLL_USER:
+                CommandRunner.ENROLLMENTS.index(get_cli_flag(command, '-M'))
+            elif command_id == CommandEC2.AMB_REMOVE_USER:
+                CommandRunner.ENROLLMENTS.forget(self.get_identity(command))
+    # -----------------------------------------------------------------------------
+
     def get_newly_created_cognito_uuid_from_json(self, json_str:str) -> str : # | None ( Only Works in Python 3.11+)     
         APP.debug(f'Parsing JSON:\n{str(json.dumps(json_str, indent=2))}')
         try:
@@ -129,10 +734,13 @@ class CommandRunner(object):
     def execute_command(self, 
                         command:list[str], 
                         output_extractor: callable = None, 
-                        quiet_mode:bool = False) -> tuple[str, str, int]:
+                        quiet_mode:bool = False,
+                        on_line: callable = None) -> tuple[str, str, int]:
         """ Runs the command provided as param
         Args:
             command (list): Command list[str] as required by Python subprocess module
+            on_line (callable, optional): Streams the output lines as (stream-name, line) - see json_events.
+                The output of the STREAMED_COMMANDS is kept as head/tail only unless the extractor needs it.
         Returns:
             tuple[str, str, str]: Tuple consisting of: (stdOut, stdErr, OS-ReturnCode)
         """
@@ -144,30 +752,44 @@ class CommandRunner(object):
         self.reset_status()
         self.result = None
         proc = None
-        if command and isinstance(command, list) and len(command)>0:
+        usage = None
+        backend = 'cli'
+        start = time.perf_counter()
+        command_key = self.get_command_key(command)
+        memoized = self.recall(command)
+        if memoized:
+            ### The read-only answer of this run (or of the TTL cache)
+            (self.result, self.error, self.code) = memoized
+        elif command_key and get_backend().supports(command_key):
+            ### In-process backend (e.g. boto3) instead of the CLI subprocess
+            backend = get_backend().get_name(command_key)
+            (self.result, self.error, self.code) = self.run_guarded(
+                        command, lambda: get_backend().execute(command_key, command))[:3]
+        elif command and isinstance(command, list) and len(command)>0:
             try:
-                proc = subprocess.run(command, encoding='utf-8', 
-                                    stdout=subprocess.PIPE, 
-                                    stderr=subprocess.PIPE, 
-                                    stdin=subprocess.PIPE)
+                keep_all = bool(output_extractor) or not self.is_streamed(command)
+                proc = self.run_guarded(command, lambda: self.run_process(command, on_line, keep_all))
                 ### If called needs post-processing of output
                 ### (e.g. YAML/JSON parsing of the output)
                 if output_extractor and callable(output_extractor) :
-                    self.result = output_extractor(proc.stdout)
+                    self.result = output_extractor(proc[0])
                 else:
-                    self.result = proc.stdout
+                    self.result = proc[0]
             except Exception as ex:
                 self.error = f"Command \n\t{command}\nFailed with exception: \n\t{ex}"
                 self.code = f"-101"
             finally:
                 # Finalize information gathering
                 if proc:
-                    self.result=proc.stdout
-                    self.error=proc.stderr
-                    self.code=proc.returncode
+                    (self.result, self.error, self.code, usage) = proc
         else:
             self.error = f"No Command!!!"
             self.code = f"-1010"
+        if not memoized:
+            self.memoize(command, (self.result, self.error, self.code))
+            if command:
+                self.TIMER.record(self.get_timing_kind(command), backend, 
+                                  (time.perf_counter() - start) * 1000, self.code, self.result, usage)
 
         # if APP.CLI_DEBUG_MODE=='debug' or APP.CMD_ONLY_PRINT:
         #     InfoBoard.pin_info(f'Command: {self.get_command_text(command)}\n{self.result=}\n{self.error=}\n{self.code=}')
@@ -177,10 +799,13 @@ class CommandRunner(object):
     # -----------------------------------------------------------------------------
 
     def report_command_status(self, command, quiet_mode = False, depth:int =5):
+        ### The logs get the head/tail of the long outputs only
+        result = BoundedCapture.bound(self.result, self.LOG_HEAD_LINES, self.LOG_TAIL_LINES)
+        error = BoundedCapture.bound(self.error, self.LOG_HEAD_LINES, self.LOG_TAIL_LINES)
         if self.error and self.code!=0:
-            InfoBoard.pin_error(f'Command: {self.get_command_text(command)}\n{self.result=}\n{self.error=}\n{self.code=}\n', depth=depth)
+            InfoBoard.pin_error(f'Command: {self.get_command_text(command)}\n{result=}\n{error=}\n{self.code=}\n', depth=depth)
         elif not quiet_mode:
-            InfoBoard.cmd_status(self.get_command_text(command),str(self.result), str(self.error), self.code, stack_depth=depth)
+            InfoBoard.cmd_status(self.get_command_text(command),str(result), str(error), self.code, stack_depth=depth)
     # -----------------------------------------------------------------------------
 
     def execute_batch(self, commands:list) -> tuple[dict, list]:
@@ -217,7 +842,159 @@ class CommandRunner(object):
         return (results_out, results_special)
     # -----------------------------------------------------------------------------
 
-    def execute_batch_by_ids(self, command_ids:list) :
+    def split_command(self, command) -> tuple[list, callable]:
+        """ Unpacks the regular command or the (command, output-extractor) tuple
+        """
+        if (    isinstance(command, tuple)
+            and len(command) == 2 
+            and isinstance(command[0], list) 
+            and callable(command[1]) ):
+            return (command[0], command[1])
+        return (command, None)
+    # -----------------------------------------------------------------------------
+
+    def get_max_parallel(self) -> int:
+        return APP.ENV_CONFIG.get_bat_max_parallel() if APP.ENV_CONFIG else 4
+    # -----------------------------------------------------------------------------
+
+    async def run_command_async(self, 
+                        command: list[str], 
+                        output_extractor: callable = None) -> tuple[str, str, int, any]:
+        """ Runs ONE command without touching the runner state (safe to run concurrently)
+        Args:
+            command (list): Command list[str] as for Python subprocess module
+            output_extractor (callable, optional): Post-processing of the stdOut. Defaults to None.
+        Returns:
+            tuple[str, str, int, any]: (stdOut, stdErr, OS-ReturnCode, extracted result)
+        """
+        if not (command and isinstance(command, list) and len(command)>0):
+            return (None, f"No Command!!!", f"-1010", None)
+        command_key = self.get_command_key(command)
+        ### The first AMB_READ_USER loads the whole CA index (a subprocess): keep it off the event loop
+        memoized = await asyncio.to_thread(self.recall, command)
+        (usage, backend) = (None, 'cli')
+        start = time.perf_counter()
+        try:
+            if memoized:
+                (out, err, code) = memoized
+            elif command_key and get_backend().supports(command_key):
+                ### The in-process backends block: keep them off the event loop
+                backend = get_backend().get_name(command_key)
+                (out, err, code) = (await asyncio.to_thread(
+                        self.run_guarded, command, lambda: get_backend().execute(command_key, command)))[:3]
+            else:
+                ### A thread per running child: wait4 gives its own CPU/RSS (the loop watcher does not)
+                keep_all = bool(output_extractor) or not self.is_streamed(command)
+                (out, err, code, usage) = await asyncio.to_thread(
+                        self.run_guarded, command, lambda: self.run_process(command, keep_all=keep_all))
+        except Exception as ex:
+            return (None, f"Command \n\t{command}\nFailed with exception: \n\t{ex}", f"-101", None)
+        if not memoized:
+            self.TIMER.record(self.get_timing_kind(command), backend, 
+                              (time.perf_counter() - start) * 1000, code, out, usage)
+        extracted = out
+        if output_extractor and callable(output_extractor):
+            try:
+                extracted = output_extractor(out)
+            except Exception as ex:
+                return (out, f"Output of \n\t{command}\nFailed to parse: \n\t{ex}", f"-103", None)
+        return (out, err, code, extracted)
+    # -----------------------------------------------------------------------------
+
+    async def run_graph_async(self, 
+                        commands: dict, 
+                        depends: dict, 
+                        max_parallel: int) -> dict:
+        """ Runs every command once ALL its dependencies succeeded, 
+            at most max_parallel commands at a time
+        Returns:
+            dict: key -> (stdOut, stdErr, OS-ReturnCode, extracted result)
+        """
+        gate = asyncio.Semaphore(max(1, max_parallel))
+        tasks = {}
+
+        async def run_node(key):
+            for dependency in depends.get(key, []):
+                (_, _, code, _) = await tasks[dependency]
+                if code != 0:
+                    ### Nothing to build on: skip instead of running against a broken state
+                    return ('', f'Skipped: {dependency} failed with code {code}', f'-102', None)
+            (command, extractor) = self.split_command(commands[key])
+            async with gate:
+                return await self.run_command_async(command, extractor)
+
+        for key in commands.keys():
+            tasks[key] = asyncio.ensure_future(run_node(key))
+        return dict(zip(tasks.keys(), await asyncio.gather(*tasks.values())))
+    # -----------------------------------------------------------------------------
+
+    def execute_batch_concurrent(self, 
+                        commands: dict, 
+                        depends: dict = None, 
+                        max_parallel: int = None) -> tuple[dict, list]:
+        """ Runs the independent commands of the batch concurrently
+        Args:
+            commands (dict): key -> command (list[str] or (list[str], output-extractor) tuple)
+            depends (dict, optional): key -> list of the keys that must succeed first. Defaults to None (all independent).
+            max_parallel (int, optional): Cap of the running commands. Defaults to env/bat/max-parallel.
+        Returns:
+            tuple[dict, list]: (key -> (stdOut, stdErr, OS-ReturnCode, command-text), 
+                                extracted results of the successful tuple-commands in the batch order)
+        """
+        if APP.CMD_ONLY_PRINT or APP.CLI_DEBUG_MODE:
+            self.print_commands(commands={key: self.split_command(command)[0] 
+                                          for (key, command) in commands.items()})
+        if APP.CMD_ONLY_PRINT: ### Safety breaker for print-debugging
+            return 
+        
+        depends = depends if depends else {}
+        unknown = [dependency for (key, keys) in depends.items() 
+                   for dependency in keys if dependency not in commands or key not in commands]
+        if unknown or self.has_dependency_cycle(depends):
+            InfoBoard.pin_error(f"Error! Broken dependencies {depends} of the batch {list(commands.keys())}")
+            return 
+        outcomes = asyncio.run(self.run_graph_async(
+                        commands, depends, max_parallel if max_parallel else self.get_max_parallel()))
+
+        results_special = []
+        results_out = {}
+        for (key, command) in commands.items():
+            ### Report in the batch order, as the sequential batch does
+            (command, extractor) = self.split_command(command)
+            (self.out, self.error, self.code, extracted) = outcomes[key]
+            self.result = self.out
+            self.memoize(command, (self.out, self.error, self.code))
+            self.report_command_status(command, depth=6)
+            results_out[key] = (self.out, self.error, self.code, self.get_command_text(command or []),)
+            if extractor and not self.error and extracted:
+                results_special.append(extracted)
+        return (results_out, results_special)
+    # -----------------------------------------------------------------------------
+
+    @staticmethod
+    def has_dependency_cycle(depends: dict) -> bool:
+        visiting, done = set(), set()
+        def visit(key) -> bool:
+            if key in done:
+                return False
+            if key in visiting:
+                return True
+            visiting.add(key)
+            if any(visit(dependency) for dependency in depends.get(key, [])):
+                return True
+            visiting.discard(key)
+            done.add(key)
+            return False
+        return any(visit(key) for key in list(depends.keys()))
+    # -----------------------------------------------------------------------------
+
+    def execute_batch_by_ids(self, command_ids:list, depends: dict = None) :
+        """ Runs the commands by their IDs: one after another, 
+            or concurrently along the dependencies if these are given
+        Args:
+            command_ids (list): The CommandEC2 IDs of self.commands
+            depends (dict, optional): CommandEC2 -> list of the CommandEC2 to succeed first. Defaults to None.
+        """
         if APP.CMD_ONLY_PRINT or APP.CLI_DEBUG_MODE:
             self.print_commands_by_ids(command_ids)
         if APP.CMD_ONLY_PRINT: ### Safety breaker for print-debugging
@@ -230,6 +1007,11 @@ class CommandRunner(object):
                 InfoBoard.pin_error(f"Error! Command-ID: {command_id} is not found")
             else:
                 commands.append(self.commands[command_id])
+        if depends is not None:
+            return self.execute_batch_concurrent(
+                        {command_id: self.commands[command_id] 
+                         for command_id in command_ids if command_id in commands_keys},
+                        depends)
         return self.execute_batch(commands)
     # -----------------------------------------------------------------------------
     def print_commands(self, prefix: str = '', commands: dict = None) -> None:
@@ -279,6 +1061,7 @@ class CommandEC2(Enum):
     IDP_READ_USER = 2
     IDP_UPDATE_USER = 3
     IDP_DELETE_USER = 4
+    IDP_LIST_USERS = 5
 
 
     # S3 Commands
@@ -297,6 +1080,8 @@ class CommandEC2(Enum):
     AMB_DEACTIVATE_USER = 33
     AMB_REMOVE_USER = 34
     AMB_READ_USER = 35
+    AMB_LIST_USERS = 36
+    AMB_UPDATE_USER = 37
 
     # SYS Commands
     SYS_REMOVE_GIT_DIR = 41
@@ -309,11 +1094,17 @@ class CommandEC2(Enum):
     GIT_COMMIT_CHANGES = 54
     GIT_PUSH_CHANGES = 55
     GIT_CHECKOUT_BRANCH = 56
+    GIT_READ_STATE = 57
+    GIT_FETCH_BRANCH = 58
+    GIT_RESET_BRANCH = 59
 
     # SSM Commands
     SSM_PUT_CERT = 60
     SSM_PUT_MSPID = 61
     SSM_PUT_PK = 62
+    SSM_PUT_ROLES = 63
+    SSM_READ_PARAMS = 64
+    SSM_DELETE_PARAMS = 65
 
     # GIT Commands
     DEB_PRINT_ENV = 70
@@ -321,11 +1112,43 @@ class CommandEC2(Enum):
     def cmd_key(self) -> str:
         return self.name
 
+    def get_family(self) -> str:
+        return self.name.split('_')[0]
+
+    def is_read_only(self) -> bool:
+        return self in (CommandEC2.IDP_READ_USER, CommandEC2.IDP_LIST_USERS, 
+                        CommandEC2.AMB_READ_USER, CommandEC2.AMB_LIST_USERS, CommandEC2.SSP_READ_USER)
+
+    def is_mutating(self) -> bool:
+        ### Changes the state the read-only commands of the same family look at
+        return self.get_family() in ('IDP', 'AMB', 'SSP') and not self.is_read_only()
+
     def __str__(self) -> str:
         return self.name
 
     # -----------------------------------------------------------------------------
 #==================================================================================
+class BatchRunner(CommandRunner):
+    """ Runs the commands of other runners (e.g. of many UserOperations) as one concurrent batch:
+        the commands are adopted with their CommandEC2, so the backends, limits and memo apply
+    """
+
+    def __init__(self, commands: dict = None) -> None:
+        super().__init__()
+        self.command_ids = {}   ### id(command) -> CommandEC2 of the commands of the other runners
+        self.commands = commands if commands else dict()
+    # -----------------------------------------------------------------------------
+
+    def get_command_id(self, command: list):
+        return self.command_ids.get(id(command)) or super().get_command_id(command)
+    # -----------------------------------------------------------------------------
+
+    def adopt(self, command_id: CommandEC2, command: list) -> list:
+        ### Keyed on the identity of the list: the owning runner keeps it alive
+        self.command_ids[id(command)] = command_id
+        return command
+    # -----------------------------------------------------------------------------
+#==================================================================================
 class RepoOperations(CommandRunner):
     def __init__(   self, 
                     reqInfo: RequestConfig,
@@ -345,16 +1168,91 @@ class RepoOperations(CommandRunner):
             CommandEC2.DEB_PRINT_ENV ,             
             CommandEC2.SYS_REMOVE_GIT_DIR,
             CommandEC2.GIT_CLONE_REPO,
-            CommandEC2.GIT_PULL_ALL,
             CommandEC2.GIT_CHECKOUT_BRANCH,
+            CommandEC2.GIT_PULL_ALL,
             ]
     # -----------------------------------------------------------------------------+
-    def get_finish_git_repo_commands(self,):
-        return [
-                CommandEC2.GIT_ADD_CHANGES,
-                CommandEC2.GIT_COMMIT_CHANGES,
-                CommandEC2.GIT_PUSH_CHANGES,
-            ]
+    def get_init_git_repo_dependencies(self,):
+        ### DEB_PRINT_ENV is independent, the rest is a chain in the same repo-dir
+        ### (the fresh clone has the branch already, the pull just tops up the tracking branch)
+        return {
+            CommandEC2.GIT_CLONE_REPO: [CommandEC2.SYS_REMOVE_GIT_DIR],
+            CommandEC2.GIT_CHECKOUT_BRANCH: [CommandEC2.GIT_CLONE_REPO],
+            CommandEC2.GIT_PULL_ALL: [CommandEC2.GIT_CHECKOUT_BRANCH],
+            }
+    # -----------------------------------------------------------------------------+
+    def get_finish_git_repo_commands(self, remove_parties: bool = False, insert_parties: bool = True):
+        ### The removal (self.remove_file) goes first: an updated party is removed, then inserted anew
+        return (
+                ([CommandEC2.SSP_DELETE_USER] if remove_parties else []) 
+                + ([CommandEC2.SSP_CREATE_USER] if insert_parties else []) 
+                + [ CommandEC2.GIT_ADD_CHANGES,
+                    CommandEC2.GIT_COMMIT_CHANGES,
+                    CommandEC2.GIT_PUSH_CHANGES, ]
+            )
+    # -----------------------------------------------------------------------------+
+    def get_finish_git_repo_dependencies(self, remove_parties: bool = False, insert_parties: bool = True):
+        ### One transform of ALL the parties of the request, then a single commit: a chain
+        steps = self.get_finish_git_repo_commands(remove_parties, insert_parties)
+        return {later: [earlier] for (earlier, later) in zip(steps, steps[1:])}
+    # -----------------------------------------------------------------------------+
+    def get_repo_state(self,) -> dict:
+        """ Returns:
+            dict: {branch, head, dirty (the SSP changed)} of the repo-dir, None if it is no repo
+        """
+        (out, err, code) = self.execute_command(self.commands[CommandEC2.GIT_READ_STATE], quiet_mode=True)
+        if code != 0 or not out:
+            return None
+        state = {'branch': '', 'head': '', 'dirty': False, 'behind': 0}
+        for line in out.splitlines():
+            if line.startswith('# branch.head '):
+                state['branch'] = line[len('# branch.head '):].strip()
+            elif line.startswith('# branch.oid '):
+                state['head'] = line[len('# branch.oid '):].strip()
+            elif line.startswith('# branch.ab '):
+                ### '+<ahead> -<behind>' of the last fetched origin branch
+                state['behind'] = abs(int(line.split()[-1]))
+            elif line and not line.startswith('#'):
+                state['dirty'] = True
+        return state
+    # -----------------------------------------------------------------------------+
+    def get_ssp_lock_name(self,) -> str:
+        return f'ssp:{self.envInfo.get_git_repo()}#{self.userReq.get_branch_name()}:{self.ssp_xml}'
+    # -----------------------------------------------------------------------------+
+    def sync_repo(self, journal: StepJournal) -> bool:
+        """ Under the SSP lock: brings the repo-dir to the origin branch if another request pushed to it
+            since the clone, dropping the transform/commit of the request (the finish chain runs again)
+        Returns:
+            bool: False if the origin branch could not be read or reached
+        """
+        (out, err, code) = self.execute_command(self.commands[CommandEC2.GIT_FETCH_BRANCH])
+        state = self.get_repo_state() if code == 0 else None
+        if not state:
+            return False
+        if state['behind'] == 0:
+            return True
+        InfoBoard.pin_info(f'{self.userReq.get_branch_name()} moved {state["behind"]} commit(s) since the clone: '
+                           f'the SSP is updated again on top of them')
+        (out, err, code) = self.execute_command(self.commands[CommandEC2.GIT_RESET_BRANCH])
+        if code != 0:
+            return False
+        journal.forget([command_id.cmd_key() for command_id in self.get_finish_git_repo_commands(True, True)])
+        journal.done('GIT_INIT', self.get_repo_state())
+        return True
+    # -----------------------------------------------------------------------------+
+    def is_resumable(self, journal: StepJournal) -> bool:
+        """ The repo-dir is as the journaled steps left it (no other request used it since):
+            same branch and HEAD, the SSP changed only if transformed and not committed yet
+        """
+        if not (journal.is_done('GIT_INIT') and os.path.isdir(os.path.join(self.envInfo.get_git_repo_dir(), '.git'))):
+            return False
+        expected = journal.get('GIT_COMMIT_CHANGES') or journal.get('GIT_INIT')
+        state = self.get_repo_state()
+        return bool(state 
+                    and state['branch'] == expected.get('branch') 
+                    and state['head'] == expected.get('head')
+                    and state['dirty'] == (journal.is_done('SSP_CREATE_USER') 
+                                           and not journal.is_done('GIT_COMMIT_CHANGES')))
     # -----------------------------------------------------------------------------+
 
     def init_commands(self, ) -> dict:
@@ -395,6 +1293,29 @@ class RepoOperations(CommandRunner):
                 'cp', os.path.join(REPO_PATH, CMD_FILE) , USER_DIR]
         ### Preserve the cmd_file for further use
         self.cmd_file = os.path.join(USER_DIR, CMD_FILE)        
+        ### SSP XML Update: the party fragment of ALL the users of the request
+        self.party_file = os.path.join(USER_DIR, self.userReq.get_party_xml_file())
+        self.commands[CommandEC2.SSP_CREATE_USER] = [
+                sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ops_xsl.py'),
+                'insert-party',
+                '-s', os.path.join(REPO_PATH, self.ssp_xml),
+                '-u', self.party_file,
+                '-c', os.path.join(REPO_PATH, self.ssp_xml),
+                '-x', self.envInfo.get_bat_trans_config(), ]
+        ### SSP XML Update: the party UUIDs to remove, one per line
+        self.remove_file = self.party_file.replace('-party-frag.xml', '-party-remove.txt')
+        self.commands[CommandEC2.SSP_DELETE_USER] = [
+                sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ops_xsl.py'),
+                'remove-party',
+                '-s', os.path.join(REPO_PATH, self.ssp_xml),
+                '-u', self.remove_file,
+                '-c', os.path.join(REPO_PATH, self.ssp_xml), ]
+        if self.TIMER.store:
+            ### The Saxon transforms time themselves into the same store
+            for command_id in (CommandEC2.SSP_CREATE_USER, CommandEC2.SSP_DELETE_USER):
+                self.commands[command_id].extend([
+                    '-t', self.TIMER.store.db_file,
+                    '-r', self.TIMER.request_id, ])
         ### Add SSP to change-set
         self.commands[CommandEC2.GIT_ADD_CHANGES] = [
                 'git', '-C', f'{REPO_PATH}', 
@@ -410,6 +1331,20 @@ class RepoOperations(CommandRunner):
                 'git', '-C', f'{REPO_PATH}', 
                 'push', '--set-upstream','origin',f'{self.userReq.get_branch_name()}', 
                 ]  
+        ### The origin branch as it is now: another request may have pushed since the clone
+        self.commands[CommandEC2.GIT_FETCH_BRANCH] = [
+                'git', '-C', f'{REPO_PATH}', 
+                'fetch', 'origin', f'{self.userReq.get_branch_name()}', 
+                ]  
+        self.commands[CommandEC2.GIT_RESET_BRANCH] = [
+                'git', '-C', f'{REPO_PATH}', 
+                'reset', '--hard', f'origin/{self.userReq.get_branch_name()}', 
+                ]  
+        ### Branch, HEAD and the SSP change in one go: the journal resumes on the same state only
+        self.commands[CommandEC2.GIT_READ_STATE] = [
+                'git', '-C', f'{REPO_PATH}', 
+                'status', '--porcelain=v2', '--branch', '--', f'{self.ssp_xml}', 
+                ]  
         return self.commands
     
     # -----------------------------------------------------------------------------
@@ -474,6 +1409,25 @@ class UserOperations(CommandRunner):
                 CommandEC2.AMB_ENROLL_USER,
             ]
     # -----------------------------------------------------------------------------+
+    def get_read_user_commands(self,):
+        ### Independent read-only lookups: safe to run concurrently
+        read_ids = [CommandEC2.IDP_READ_USER]
+        if AuthRoles.is_fabric_role(self.userInfo.get_role()):
+            read_ids.append(CommandEC2.AMB_READ_USER)
+        return read_ids
+    # -----------------------------------------------------------------------------+
+    def prefetch_user_reads(self, command_ids: list) -> None:
+        """ Runs the read-only lookups (Cognito, Fabric-CA) concurrently,
+            the later reads are answered from the memo
+        Args:
+            command_ids (list): The CommandEC2 IDs of the reads
+        """
+        self.execute_batch_by_ids(command_ids, depends={})
+    # -----------------------------------------------------------------------------+
+    def get_identity(self, command: list) -> str:
+        ### Every command of the instance is about its one user
+        return self.userInfo.get_user_id()
+    # -----------------------------------------------------------------------------+
 
 
     def init_commands(self, ) -> dict:
@@ -497,6 +1451,11 @@ class UserOperations(CommandRunner):
         commands[CommandEC2.IDP_CREATE_USER].append('--user-attributes') 
         commands[CommandEC2.IDP_CREATE_USER].extend(self.get_user_attributes_as_idp_list()) 
         # aws cognito-idp admin-delete-user --user-pool-id us-east-1_wioSQKwya --username z-test-27
+        commands[CommandEC2.IDP_DELETE_USER] = [
+                'aws', 'cognito-idp', 'admin-delete-user', 
+                '--user-pool-id',   f'{self.envInfo.get_aws_idp_pool()}',   # !!! ENV Configuration Derived !!! 
+                '--username',       f'{self.userInfo.get_user_id()}',         # !!! USER Configuration Derived !!! 
+                ]
         commands[CommandEC2.IDP_READ_USER] = [
                 'aws', 'cognito-idp', 'admin-get-user', 
                 '--user-pool-id',   f'{self.envInfo.get_aws_idp_pool()}',   # !!! ENV Configuration Derived !!! 
@@ -534,15 +1493,17 @@ class UserOperations(CommandRunner):
                     '-s', self.userInfo.get_ssp_path(),
                     '-u', self.get_party_path(),
                 ]
-        ###
-        commands[CommandEC2.SSM_PUT_CERT]  = [
-
-                ]
+        ### The enrollment material of the user: env/aws/ssm-values
+        commands.update(self.init_ssm_commands())
 
         commands[CommandEC2.AMB_READ_USER] = ['fabric-ca-client', 
                 'identity', 'list', 
                 '--id', self.userInfo.get_user_id(),  
                 '--tls.certfiles', self.envInfo.get_amb_tls_cert()]
+        ### Every identity at once: the CA_INDEX answers the AMB_READ_USER out of it
+        commands[CommandEC2.AMB_LIST_USERS] = ['fabric-ca-client', 
+                'identity', 'list', 
+                '--tls.certfiles', self.envInfo.get_amb_tls_cert()]
         ### ./fabric-ca-client register -d 
         ### --id.name org1admin --id.secret org1-adminpw 
         ### -u https://example.com:7054 
@@ -566,12 +1527,68 @@ class UserOperations(CommandRunner):
                 '-u', (f'https://{self.userInfo.get_user_id()}:{self.envInfo.get_amb_default_secret()}'
                        f'{self.envInfo.get_amb_enroll_url()}'
                        ), 
-                '-M', os.path.join( self.envInfo.get_amb_clients_dir() , self.userInfo.get_user_id(), 'msp'),
+                '-M', self.get_msp_dir(),
                 '--tls.certfiles',  f'{self.envInfo.get_amb_tls_cert()}',
                 '--enrollment.attrs', f"'blossom.role={self.userInfo.get_role().strip()}'",
                 ]
+        ### The role changed: the other attributes stay as registered
+        commands[CommandEC2.AMB_UPDATE_USER] = [
+                'fabric-ca-client', 'identity', 'modify', self.userInfo.get_user_id(),
+                '--attrs', f"'blossom.role={self.userInfo.get_role().strip()}'",
+                '--tls.certfiles',  f'{self.envInfo.get_amb_tls_cert()}',
+                ]
+        ### The CA must allow it (cfg.identities.allowremove), the issued certificates are revoked
+        commands[CommandEC2.AMB_REMOVE_USER] = [
+                'fabric-ca-client', 'identity', 'remove', self.userInfo.get_user_id(),
+                '--tls.certfiles',  f'{self.envInfo.get_amb_tls_cert()}',
+                ]
         return commands
     # ---------------------------------------------------------------------------------
+    def init_ssm_commands(self, ) -> dict:
+        """ The SSM puts of the enrollment material, the keystore key as of now (a re-enroll adds a new one)
+        """
+        if not self.envInfo.get_aws_ssm_prefix():
+            ### No SSM entries without the prefix
+            return {}
+        enrollment = CommandRunner.ENROLLMENTS.get(self.userInfo.get_user_id())
+        try:
+            (cert_file, key_file) = ((enrollment['cert_file'], enrollment['key_file']) if enrollment
+                                     else get_msp_files(self.get_msp_dir()))
+        except (OSError, ValueError):
+            ### Not enrolled (yet): the files the enroll writes
+            (cert_file, key_file) = (os.path.join(self.get_msp_dir(), 'signcerts', 'cert.pem'),
+                                     os.path.join(self.get_msp_dir(), 'keystore', '<SKI>_sk'))
+        values = {
+            'pk':       (CommandEC2.SSM_PUT_PK,     f'file://{key_file}',                   'SecureString'),
+            'cert':     (CommandEC2.SSM_PUT_CERT,   f'file://{cert_file}',                  'String'),
+            'mspid':    (CommandEC2.SSM_PUT_MSPID,  self.envInfo.get_amb_msp_id(),          'String'),
+            'roles':    (CommandEC2.SSM_PUT_ROLES,  self.userInfo.get_role().strip(),       'String'),
+        }
+        ### aws ssm put-parameter --name /nist/blossom/dev/user/z-test-27/cert 
+        ###     --value file://<clients-dir>/z-test-27/msp/signcerts/cert.pem --type String --overwrite
+        return {command_id: [
+                    'aws', 'ssm', 'put-parameter',
+                    '--name',   self.get_ssm_name(value),
+                    '--value',  value_arg,      # file:// - the CLI reads the file, the key stays off the command line
+                    '--type',   value_type,
+                    '--overwrite',
+                    '--output', 'json']
+                for (value, (command_id, value_arg, value_type)) in values.items()
+                if value in self.envInfo.get_aws_ssm_values()}
+    # ---------------------------------------------------------------------------------
+    def get_ssm_name(self, value: str) -> str:
+        return f'{self.envInfo.get_aws_ssm_prefix()}{self.userInfo.get_user_id()}/{value}'
+    # ---------------------------------------------------------------------------------
+    def get_ssm_names(self, ) -> list[str]:
+        """ The SSM entries the user may have got (whatever env/aws/ssm-values is now), [] without the prefix
+        """
+        if not self.envInfo.get_aws_ssm_prefix():
+            return []
+        return [self.get_ssm_name(value) for value in SsmPublisher.VALUES]
+    # ---------------------------------------------------------------------------------
+    def get_msp_dir(self) -> str:
+        return os.path.join(self.envInfo.get_amb_clients_dir(), self.userInfo.get_user_id(), 'msp')
+    # ---------------------------------------------------------------------------------
     def get_idp_user(self, ) -> tuple[str, str]:
         user_uuid = ''
         user_name = ''
@@ -581,6 +1598,7 @@ class UserOperations(CommandRunner):
         #     '--username',       f'{self.userInfo.get_user_id()}',         # !!! USER Configuration Derived !!! 
         #     '--output', 'json']
         (maybe_json, err, code) = self.execute_command(read_user_cmd)
+        (maybe_json, err) = (maybe_json or '', err or '')
 
         if maybe_json.strip().startswith('{'):
             APP.debug(f"Before pulling user uuid in get_idp_user {user_uuid=}")
@@ -605,6 +1623,10 @@ class UserOperations(CommandRunner):
 
         APP.debug(f"in create_idp_user {existing_user_uuid=}")
 
+        if not existing_user_uuid and not self.MEMO.is_cacheable((self.result, self.error, self.code)):
+            ### ❌❌❌ Neither found nor absent (e.g. throttled, circuit open): creating would be a guess
+            InfoBoard.pin_error(f'Cognito lookup of {self.userInfo.get_user_id()} failed: {self.error}')
+            return (user_name, '')
         if not existing_user_uuid:
             create_idp_user_cmd = self.commands[CommandEC2.IDP_CREATE_USER]
             (maybe_json, err, code) = self.execute_command(create_idp_user_cmd)
@@ -614,6 +1636,10 @@ class UserOperations(CommandRunner):
         return (user_name, existing_user_uuid if existing_user_uuid else  new_user_uuid)
     # ---------------------------------------------------------------------------------+
     def create_fabric_user(self,) -> tuple[str, str]:
+        """ Registers and enrolls the user in the Fabric-CA unless it is registered already
+        Returns:
+            tuple[str, str]: ('', error) - the error is empty if the user is (or already was) enrolled
+        """
         ### VErify that the user doesn't yet exist
         read_amb_user_cmd = self.commands[CommandEC2.AMB_READ_USER] 
         (maybe_amb_user, error, code) = self.execute_command(read_amb_user_cmd )
@@ -628,10 +1654,17 @@ class UserOperations(CommandRunner):
                 ### Register AMB User
                 register_user = self.commands[CommandEC2.AMB_REGISTER_USER]
                 (maybe_amb_user, error, code) = self.execute_command(register_user )
+                if code!=0:
+                    return ('', f'Fabric-CA register failed with code {code}: {error}')
                 ### Enroll AMB User
                 enroll_user = self.commands[CommandEC2.AMB_ENROLL_USER]
                 (maybe_amb_user, error, code) = self.execute_command(enroll_user )
+                if code!=0:
+                    return ('', f'Fabric-CA enroll failed with code {code}: {error}')
                 ## APP.debug(f'Ready to Run Commands:\n{self.get_command_text(register_user)}\n{self.get_command_text(enroll_user)}')
+            else:
+                ### ❌❌❌ Neither found nor absent (e.g. throttled, circuit open)
+                return ('', f'Fabric-CA lookup failed with code {code}: {error}')
         else:
             ### This is name already registered or enrolled case - User EXISTS in AMB            
             APP.debug(f"Command: {self.get_command_text(read_amb_user_cmd)}\n"
@@ -640,11 +1673,24 @@ class UserOperations(CommandRunner):
 
         return('', '')        
     # ---------------------------------------------------------------------------------+
-    def create_ssm_entries(self, ) -> None:
+    def create_ssm_entries(self, publisher: 'SsmPublisher' = None) -> str:
+        """ Publishes the enrollment material of the (enrolled) user to SSM
+        Args:
+            publisher (SsmPublisher, optional): Queues the puts with those of the other users. Defaults to None (published now).
+        Returns:
+            str: The error, empty if published (or queued)
+        """
+        if publisher:
+            publisher.add(self)
+            return ''
+        return SsmPublisher(self.envInfo).add(self).publish().get(self.userInfo.get_user_id(), '')
+    # ---------------------------------------------------------------------------------+
+    def create_read_ssm_entries(self, ) -> None:
         pass
     # ---------------------------------------------------------------------------------+
-    def compose_create_party_fragment_file(self, party_uuid: str) -> str: 
-
+    def get_create_party_xml(self, party_uuid: str) -> str: 
+        """ The party and responsible-party of the user for the SSP insert-fragment
+        """
         first, middle, last = self.userInfo.get_split_names(self.userInfo.get_name())
         short_name = (  f'<short-name>{first}-{last[0]}</short-name>' 
                         if first and last 
@@ -657,9 +1703,8 @@ class UserOperations(CommandRunner):
 
         ## Should we add default organization UUID to ENV-File to allow membership to flow and be preserved?
         # member = f"<member-of-organization>8aed7ffd-5158-445d-8d7c-eec5cf240cba</member-of-organization>"
-        draft_xml = (
-        f"""<insert  xmlns="http://csrc.nist.gov/ns/oscal/1.0">
-            
+        return (
+        f"""
             <!-- The Actual Party -->
             <party uuid="{party_uuid}" type="person">
                 <email-address>{self.userInfo.get_email()}</email-address>
@@ -673,59 +1718,127 @@ class UserOperations(CommandRunner):
             <responsible-party role-id="{self.userInfo.get_role_enum()}">
                 <party-uuid>{party_uuid}</party-uuid>
             </responsible-party>
-
-        </insert>"""
+        """
         )
-        pretty_xml = XmlFragmentOps.prettify_xml(draft_xml)
-
-        self.create_fragment_file = os.path.join(
-            self.envInfo.get_bat_user_dir(), 
-            self.userReq.get_party_xml_file())
-                
-        with open(self.create_fragment_file, 'w', encoding='utf-8') as xml_file:
-            xml_file.write(pretty_xml)
+    # ---------------------------------------------------------------------------------+
+    def compose_create_party_fragment_file(self, party_uuid: str) -> str: 
+        self.create_fragment_file = write_party_fragment_file(
+            [self.get_create_party_xml(party_uuid)],
+            os.path.join(
+                self.envInfo.get_bat_user_dir(), 
+                self.userReq.get_party_xml_file()))
         return self.create_fragment_file
     # ---------------------------------------------------------------------------------+
-    def get_amb_user(self, ) -> tuple[str, str]:
-        user_uuid = ''
-        user_name = ''
-        read_user_cmd = self.commands[CommandEC2.AMB_READ_USER]
-        ### ['fabric-ca-client', 
-        ###         'identity', 'list', 
-        ###         '--id', self.userInfo.get_user_id(),  
-        ###         '--tls.certfiles', self.envInfo.get_amb_tls_cert()]
-        (maybe_amb_guts, err, code) = self.execute_command(read_user_cmd)
-        ### Name: AOrt, 
-        # Type: client, 
-        # Affiliation: NIST, 
-        # Max Enrollments: 6, 
-        # Attributes: [
-        # {     Name:blossom.role 
-        #       Value:Authorizing Official 
-        #       ECert:false} 
-        # {     Name:hf.EnrollmentID
-        #       Value:AOrt 
-        #       ECert:true} 
-        # {     Name:hf.Type 
-        #       Value:client 
-        #       ECert:true} 
-        # {     Name:hf.Affiliation 
-        #       Value:NIST 
-        #       ECert:true}]
-        if maybe_amb_guts.strip().startswith('{'):
-            APP.debug(f"Before pulling user uuid in get_idp_user {user_uuid=}")
-            user_uuid = self.get_preexisting_cognito_uuid_from_json(maybe_json.strip())
-            user_name = self.userInfo.get_user_id()
-            APP.debug(f"After querying user {user_name} uuid in get_idp_user {user_uuid=}")
+#======================================================================================
 
-        elif (  code==254 
-                or 'User does not exist' in err 
-                or 'UserNotFoundException' in err):
-            APP.debug(f"User {self.userInfo.get_name()}/{self.userInfo.get_user_id()} does not exist")
+class SsmPublisher(BatchRunner):
+    """ Publishes the enrollment material of many users as ONE concurrent batch of SSM puts
+        (within env/bat/max-parallel and the ssm limits), the unchanged values skipped:
+        the SsmParamStore keeps the version + hash of every value published, a value older than
+        env/bat/ssm-ttl is trusted only while SSM still has that version (one get-parameters per 10 names)
+    """
+    READ_NAMES = 10     ### The most names of one get-parameters call
+    DELETE_NAMES = 10   ### The most names of one delete-parameters call
+    VALUES = ('pk', 'cert', 'mspid', 'roles')
 
-        APP.debug(f"in create_idp_user {user_uuid=}")
-        return (user_name, user_uuid)
-    # ---------------------------------------------------------------------------------
+    def __init__(self, envInfo: EnvConfig) -> None:
+        super().__init__()
+        self.envInfo = envInfo
+        self.store = SsmParamStore(envInfo.get_bat_state_db())
+        self.ttl = envInfo.get_bat_ssm_ttl()
+        self.users = {}     ### user -> parameter name -> put command
+    # -----------------------------------------------------------------------------
+
+    def add(self, user_ops: UserOperations) -> 'SsmPublisher':
+        ### The commands as of now: the keystore key of the latest enroll
+        ssm_commands = user_ops.init_ssm_commands()
+        user_ops.commands.update(ssm_commands)
+        self.users[user_ops.userInfo.get_user_id()] = {
+                    parse_cli_options(command)['name'][0]: self.adopt(command_id, command)
+                    for (command_id, command) in ssm_commands.items()}
+        return self
+    # -----------------------------------------------------------------------------
+
+    @staticmethod
+    def get_delete_commands(runner: BatchRunner, names: list[str]) -> dict:
+        """ Returns:
+            dict: batch key -> delete-parameters command (adopted by the runner) of up to DELETE_NAMES names
+        """
+        return {f'{CommandEC2.SSM_DELETE_PARAMS.cmd_key()}/{index}': runner.adopt(CommandEC2.SSM_DELETE_PARAMS, 
+                    ['aws', 'ssm', 'delete-parameters', '--names', *names[index:index + SsmPublisher.DELETE_NAMES], 
+                     '--output', 'json'])
+                for index in range(0, len(names), SsmPublisher.DELETE_NAMES)}
+    # -----------------------------------------------------------------------------
+
+    def get_read_command(self, names: list[str]) -> list[str]:
+        ### The versions only: no decryption, the values never leave SSM
+        return self.adopt(CommandEC2.SSM_READ_PARAMS, ['aws', 'ssm', 'get-parameters', '--names', *names, '--output', 'json'])
+    # -----------------------------------------------------------------------------
+
+    @staticmethod
+    def get_value_hash(command: list[str]) -> str:
+        value = parse_cli_options(command)['value'][0]
+        if value.startswith('file://'):
+            with open(value[len('file://'):], 'rb') as stream:
+                return hashlib.sha256(stream.read()).hexdigest()
+        return hashlib.sha256(value.encode('utf-8')).hexdigest()
+    # -----------------------------------------------------------------------------
+
+    def get_changed(self, hashes: dict) -> list[str]:
+        """ The parameters to put: new, changed or replaced in SSM since they were published
+        Args:
+            hashes (dict): parameter name -> hash of the value to publish
+        """
+        known = self.store.load(list(hashes))
+        same = {name for (name, value_hash) in hashes.items() if name in known and known[name][1] == value_hash}
+        stale = [name for name in same if known[name][2] + self.ttl <= time.time()]
+        if stale:
+            outcome = self.execute_batch_concurrent({
+                            f'{CommandEC2.SSM_READ_PARAMS.cmd_key()}/{index}': 
+                                self.get_read_command(stale[index:index + self.READ_NAMES])
+                            for index in range(0, len(stale), self.READ_NAMES)})
+            versions = {}
+            for (out, err, code, text) in (outcome[0] if outcome else {}).values():
+                if code == 0:
+                    versions.update({parameter['Name']: parameter['Version'] 
+                                     for parameter in json.loads(out).get('Parameters', [])})
+            for name in stale:
+                if versions.get(name) == known[name][0]:
+                    self.store.save(name, known[name][0], hashes[name])
+                else:
+                    ### Replaced, deleted or not read: put anew
+                    same.discard(name)
+        return [name for name in hashes if name not in same]
+    # -----------------------------------------------------------------------------
+
+    def publish(self, ) -> dict:
+        """ Puts the changed values of all the users at once, the caller holds the user locks
+        Returns:
+            dict: user -> the error of its puts, empty if published (or unchanged)
+        """
+        errors = {user_id: [] for user_id in self.users}
+        puts = {name: (user_id, command) for (user_id, commands) in self.users.items() 
+                for (name, command) in commands.items()}
+        if APP.CMD_ONLY_PRINT:
+            self.execute_batch_concurrent({name: command for (name, (user_id, command)) in puts.items()})
+            return {user_id: '' for user_id in self.users}
+        hashes = {}
+        for (name, (user_id, command)) in puts.items():
+            try:
+                hashes[name] = self.get_value_hash(command)
+            except OSError as ex:
+                errors[user_id].append(f'No {name} value: {ex}')
+        changed = self.get_changed(hashes) if hashes else []
+        APP.debug(f'SSM parameters to put: {len(changed)} of {len(puts)}')
+        outcome = self.execute_batch_concurrent({name: puts[name][1] for name in changed}) if changed else None
+        for name in changed:
+            (out, err, code, text) = outcome[0][name] if outcome else ('', 'Not run', -1, '')
+            if code == 0:
+                self.store.save(name, json.loads(out).get('Version', 0), hashes[name])
+            else:
+                errors[puts[name][0]].append(f'{name} put failed with code {code}: {err}')
+        return {user_id: '; '.join(user_errors) for (user_id, user_errors) in errors.items()}
+    # -----------------------------------------------------------------------------
 #======================================================================================
 
 class S3Operations(CommandRunner):
@@ -768,6 +1881,23 @@ class S3Operations(CommandRunner):
         return err==0
     # -----------------------------------------------------------------------------
 
+    def get_version_tag(self) -> str:
+        """ Identifies the content of the S3 file for the de-duplication
+            The S3 VersionId/ETag is gone once the file is moved, and the ETag is no MD5 for
+            the multipart or SSE-KMS uploads: a duplicate run after the move must build the same key
+        Returns:
+            str: The MD5 of the moved REC-file, '' if it is not local
+        """
+        if self.rec_file and os.path.isfile(self.rec_file):
+            return get_file_md5(self.rec_file)
+        return ''
+    # -----------------------------------------------------------------------------
+
+    def get_dedup_key(self) -> str:
+        return DedupStore.get_dedup_key(
+                    self.envInfo.get_aws_s3_drop_name(), self.s3_file, self.get_version_tag())
+    # -----------------------------------------------------------------------------
+
     def s3_file_move(self) -> bool:
         stdOut, stdErr, err =  self.execute_command(
             self.commands[CommandEC2.S3_MOVE_FILE])
@@ -803,21 +1933,254 @@ def move_s3_file(   s3_ops: S3Operations,
             return None
     return None
 # ---------------------------------------------------------------------------------
+def write_party_fragment_file(party_xmls: list[str], fragment_file: str) -> str:
+    """ Writes the SSP insert-fragment of the parties (one transform inserts them all)
+    Args:
+        party_xmls (list[str]): The party + responsible-party XML of every user
+        fragment_file (str): Path-File of the fragment to write
+    Returns:
+        str: The fragment file written
+    """
+    draft_xml = (
+        '<insert  xmlns="http://csrc.nist.gov/ns/oscal/1.0">'
+        + ''.join(party_xmls)
+        + '</insert>')
+    pretty_xml = XmlFragmentOps.prettify_xml(draft_xml)
+    with open(fragment_file, 'w', encoding='utf-8') as xml_file:
+        xml_file.write(pretty_xml)
+    return fragment_file
+# ---------------------------------------------------------------------------------
+def write_party_remove_file(party_uuids: list[str], remove_file: str) -> str:
+    """ Writes the party UUIDs for the SSP removal transform, one per line
+    """
+    with open(remove_file, 'w') as stream:
+        stream.write(''.join(f'{party_uuid}\n' for party_uuid in party_uuids))
+    return remove_file
+# ---------------------------------------------------------------------------------
 def create_fabric_user(recInfo, userInfo, envInfo) -> str:
     return ''
 
 # ---------------------------------------------------------------------------------
-def dispatch_command(envInfo: EnvConfig, recInfo: RequestConfig) -> bool:
+USER_DONE = 'done'
+USER_SKIPPED = 'skipped'
+USER_FAILED = 'failed'
+# ---------------------------------------------------------------------------------
+def read_user_file(envInfo: EnvConfig, user_file_name: str) -> tuple[UserConfig, str]:
+    """ Reads the user-file out of the repo-dir
+    Returns:
+        tuple[UserConfig, str]: (the valid user-file or None, the error)
+    """
+    APP.debug(f'Concatenating:\n{user_file_name=}\nand\n{envInfo.get_git_repo_dir()=}')
+    user_file = os.path.join(envInfo.get_git_repo_dir(), user_file_name)
+    APP.debug(f'Working on {user_file=}')        
+    if not os.path.isfile(user_file):
+        return (None, f'The FILE {user_file} could not be found')
+    userInfo = UserConfig(user_file)
+    if not userInfo.is_valid():
+        return (None, '; '.join(userInfo.errors))
+    APP.debug(user_file)
+    APP.print_dir(userInfo)
+    return (userInfo, '')
+# ---------------------------------------------------------------------------------
+def dispatch_user_command(envInfo: EnvConfig, recInfo: RequestConfig, user_file_name: str,
+                          journal: StepJournal = None, ssm: SsmPublisher = None) -> tuple[str, str, str]:
+    """ Runs the Cognito/Fabric-CA work of one user-file of the request
+    Args:
+        envInfo (EnvConfig): The AWS-EC2 environment configuration
+        recInfo (RequestConfig): The request listing the user-file
+        user_file_name (str): Repo-relative Path-File of the user-file
+        journal (StepJournal, optional): Skips the Cognito/Fabric-CA steps the request completed before. Defaults to None.
+        ssm (SsmPublisher, optional): Queues the SSM puts with those of the other users. Defaults to None (published at once).
+    Returns:
+        tuple[str, str, str]: (USER_DONE|USER_SKIPPED|USER_FAILED, message, party XML to insert into SSP or '')
+    """
+    (userInfo, error) = read_user_file(envInfo, user_file_name)
+    if not userInfo:
+        return (USER_FAILED, error, '')
+    ### One request at a time per identity (Cognito user, Fabric-CA identity, SSM entries)
+    with CommandRunner.LOCKS.hold([f'user:{userInfo.get_user_id()}']):
+        return run_user_command(envInfo, recInfo, userInfo, journal, ssm)
+# ---------------------------------------------------------------------------------
+def run_user_command(envInfo: EnvConfig, recInfo: RequestConfig, userInfo: UserConfig,
+                     journal: StepJournal = None, ssm: SsmPublisher = None) -> tuple[str, str, str]:
+    """ Runs the command of the user-file, the identity locked
+    Returns:
+        tuple[str, str, str]: (USER_DONE|USER_SKIPPED|USER_FAILED, message, party XML to insert into SSP or '')
+    """
+    ### Read COMMAND from the user-command-file
+    user_ops = UserOperations(recInfo, userInfo, envInfo)
+    user_command = userInfo.get_command()
+    journal = journal if journal else StepJournal()
+    (idp_step, amb_step) = (f'IDP:{userInfo.get_user_id()}', f'AMB:{userInfo.get_user_id()}')
+    APP.debug(f'Executing User Command: {user_command}')
+    ### CREATING USER
+    if user_command=='create-user': 
+        ### Cognito and Fabric-CA lookups at once (of the steps still to do)
+        user_ops.prefetch_user_reads([command_id for command_id in user_ops.get_read_user_commands()
+                                      if not journal.is_done(f'{command_id.get_family()}:{userInfo.get_user_id()}')])
+        ### Create or Read (if Exists) User & Get UUID                
+        if journal.is_done(idp_step):
+            (user_name, cognito_user_uuid) = (journal.get(idp_step)['user'], journal.get(idp_step)['uuid'])
+        else:
+            (user_name, cognito_user_uuid) = user_ops.create_idp_user()
+            if is_uuid_valid(cognito_user_uuid):
+                journal.done(idp_step, {'user': user_name, 'uuid': cognito_user_uuid})
+        APP.debug(f'Created user: {user_name} with UUID: {cognito_user_uuid}')
+        ### Register User in AMB [if needed]
+        user_role = userInfo.get_role()
+
+        ### Create Fabric-User if Required
+        if AuthRoles.is_fabric_role( user_role ):
+            if not journal.is_done(amb_step):
+                (_, fabric_error) = user_ops.create_fabric_user()
+                if fabric_error:
+                    return (USER_FAILED, f'{userInfo.get_user_id()}: {fabric_error}', '')
+                journal.done(amb_step)
+            ### Create User SSM Entries [if needed]: a retry publishes again, the unchanged values are skipped
+            ssm_error = user_ops.create_ssm_entries(ssm)
+            if ssm_error:
+                return (USER_FAILED, f'{userInfo.get_user_id()}: SSM {ssm_error}', '')
+        elif AuthRoles.is_fabric_read_role( user_role ):
+            ### Create User SSM Entries [if read-rights are needed]
+            ### Map the user to read only service AMB-service role
+            user_ops.create_read_ssm_entries()
+
+        ### ❌❌❌ No SSP party without the Cognito UUID
+        if not is_uuid_valid(cognito_user_uuid):
+            return (USER_FAILED, f'No Cognito UUID for user {userInfo.get_user_id()}', '')
+        ### XML equivalent of User-File: the SSP is updated once for ALL the users
+        return (USER_DONE, f'{userInfo.get_user_id()} has UUID {cognito_user_uuid}',
+                user_ops.get_create_party_xml(cognito_user_uuid))
+    ### DELETING USER: dispatch_command runs all the deletions of the request at once (delete_users)
+    return (USER_FAILED, f'Unknown command {user_command} of {userInfo.get_user_id()}', '')
+# ---------------------------------------------------------------------------------
+def get_lookup_state(command_id: CommandEC2, outcome: tuple) -> str:
+    """ Returns:
+        str: 'present', 'absent' or 'failed' (e.g. throttled, circuit open) of the Cognito/Fabric-CA lookup
+    """
+    (out, err, code) = outcome[:3] if outcome else ('', 'Not run', -1)
+    if code == 0:
+        return 'present'
+    ### The aws CLI exits with 254 on every service error (e.g. throttled): only the not-found answer is absent
+    if command_id == CommandEC2.IDP_READ_USER and any(marker in (err or '') 
+                                                      for marker in ('UserNotFoundException', 'User does not exist')):
+        return 'absent'
+    if command_id == CommandEC2.AMB_READ_USER and 'Error Code: 63' in (err or ''):
+        return 'absent'
+    return 'failed'
+# ---------------------------------------------------------------------------------
+def delete_users(envInfo: EnvConfig, recInfo: RequestConfig, userInfos: dict,
+                 journal: StepJournal = None) -> dict:
+    """ Offboards the users at once: the Cognito and Fabric-CA lookups of all of them as one concurrent batch,
+        then the Cognito deletes, the Fabric-CA identity removals (certificates revoked) and the deletes of their
+        SSM entries as another one, both within the service limits. The SSP parties go with the one transform of the request
+    Args:
+        envInfo (EnvConfig): The AWS-EC2 environment configuration
+        recInfo (RequestConfig): The request
+        userInfos (dict): key (e.g. the user-file) -> UserConfig of the delete-user command
+        journal (StepJournal, optional): Keeps the Cognito UUID once read: a retry finds the user deleted. Defaults to None.
+    Returns:
+        dict: key -> (USER_DONE|USER_SKIPPED|USER_FAILED, message, UUID of the party to remove or '')
+    """
+    journal = journal if journal else StepJournal()
+    user_ops = {key: UserOperations(recInfo, userInfo, envInfo) for (key, userInfo) in userInfos.items()}
+    ### The AMB_READ_USER answers come out of one bulk identity list
+    runner = BatchRunner({CommandEC2.AMB_LIST_USERS: next(iter(user_ops.values())).commands[CommandEC2.AMB_LIST_USERS]})
+    read_ids = [CommandEC2.IDP_READ_USER, CommandEC2.AMB_READ_USER]
+    delete_ids = {CommandEC2.IDP_READ_USER: CommandEC2.IDP_DELETE_USER, 
+                  CommandEC2.AMB_READ_USER: CommandEC2.AMB_REMOVE_USER}
+    ### One request at a time per identity (all of them: the batch runs them side by side)
+    with CommandRunner.LOCKS.hold([f'user:{userInfo.get_user_id()}' for userInfo in userInfos.values()]):
+        ### Whatever the role of the file: the identity may be left from an earlier role
+        reads = {f'{key}/{command_id.cmd_key()}': runner.adopt(command_id, ops.commands[command_id])
+                 for (key, ops) in user_ops.items() for command_id in read_ids}
+        outcome = runner.execute_batch_concurrent(reads)
+        if not outcome:
+            ### Print-only: the deletions of every user
+            runner.execute_batch_concurrent({**{f'{key}/{delete_ids[command_id].cmd_key()}': ops.commands[delete_ids[command_id]]
+                                                for (key, ops) in user_ops.items() for command_id in read_ids},
+                                             **SsmPublisher.get_delete_commands(runner, 
+                                                    [name for ops in user_ops.values() for name in ops.get_ssm_names()])})
+            return {key: (USER_SKIPPED, 'Commands printed only', '') for key in user_ops}
+        (results, deletes) = ({}, {})
+        for (key, ops) in user_ops.items():
+            (user_id, del_step) = (ops.userInfo.get_user_id(), f'DEL:{ops.userInfo.get_user_id()}')
+            states = {command_id: get_lookup_state(command_id, outcome[0].get(f'{key}/{command_id.cmd_key()}'))
+                      for command_id in read_ids}
+            idp_out = outcome[0][f'{key}/{CommandEC2.IDP_READ_USER.cmd_key()}'][0]
+            party_uuid = (ops.get_preexisting_cognito_uuid_from_json(idp_out.strip()) 
+                          if states[CommandEC2.IDP_READ_USER] == 'present' else '')
+            party_uuid = party_uuid or (journal.get(del_step) or {}).get('uuid', '')
+            if is_uuid_valid(party_uuid):
+                journal.done(del_step, {'uuid': party_uuid})
+            failed = [command_id.get_family() for (command_id, state) in states.items() if state == 'failed']
+            if failed:
+                results[key] = (USER_FAILED, f'{user_id}: {", ".join(failed)} lookup failed', '')
+                continue
+            present = [command_id for (command_id, state) in states.items() if state == 'present']
+            if not (present or party_uuid):
+                results[key] = (USER_SKIPPED, f'{user_id} is in neither Cognito nor the Fabric-CA', '')
+                continue
+            results[key] = (USER_DONE, f'{user_id} removed from: ' + ', '.join(
+                                ['SSP'] * bool(party_uuid) + [command_id.get_family() for command_id in present]),
+                            party_uuid)
+            deletes.update({f'{key}/{delete_ids[command_id].cmd_key()}': 
+                            runner.adopt(delete_ids[command_id], ops.commands[delete_ids[command_id]])
+                            for command_id in present})
+        ### The SSM entries (the private key first of all) go too, also of the users found in neither service:
+        ### an earlier attempt may have removed the identities and left the entries
+        ssm_keys = {name: key for (key, ops) in user_ops.items() if results[key][0] != USER_FAILED 
+                    for name in ops.get_ssm_names()}
+        ssm_deletes = SsmPublisher.get_delete_commands(runner, list(ssm_keys))
+        deletes.update(ssm_deletes)
+        outcome = runner.execute_batch_concurrent(deletes) if deletes else ({}, [])
+    ssm_errors = {}
+    for (batch_key, command) in ssm_deletes.items():
+        (out, err, code, text) = (outcome[0] if outcome else {}).get(batch_key, ('', 'Not run', -1, ''))
+        names = parse_cli_options(command)['names']
+        if code == 0:
+            ### Deleted (or never there): the next publish of the same name puts it anew
+            SsmParamStore(envInfo.get_bat_state_db()).forget(names)
+            continue
+        for key in dict.fromkeys(ssm_keys[name] for name in names):
+            ssm_errors.setdefault(key, []).append(f'{CommandEC2.SSM_DELETE_PARAMS.cmd_key()} failed with code {code}: {err}')
+    for (key, ops) in user_ops.items():
+        errors = [f'{batch_key.split("/")[-1]} failed with code {code}: {err}'
+                  for (batch_key, (out, err, code, text)) in (outcome[0] if outcome else {}).items() 
+                  if batch_key.startswith(f'{key}/') and code != 0] + ssm_errors.get(key, [])
+        if errors:
+            results[key] = (USER_FAILED, f'{ops.userInfo.get_user_id()}: ' + '; '.join(errors), '')
+    return results
+# ---------------------------------------------------------------------------------
+def report_user_statuses(statuses: dict) -> None:
+    """ Per-user outcome of the request
+    Args:
+        statuses (dict): user-file -> (USER_DONE|USER_SKIPPED|USER_FAILED, message)
+    """
+    InfoBoard.pin_info('Users of the request:\n' + '\n'.join(
+        f'\t{status:<8}{user_file}: {message}' for (user_file, (status, message)) in statuses.items()))
+    for (user_file, (status, message)) in statuses.items():
+        if status == USER_FAILED:
+            InfoBoard.pin_error(f'User-file {user_file} failed: {message}')
+# ---------------------------------------------------------------------------------
+def dispatch_command(envInfo: EnvConfig, recInfo: RequestConfig, journal: StepJournal = None) -> bool:
+    """ Runs the request: repo preparation, the users, then ONE SSP transform and ONE commit
+    Args:
+        envInfo (EnvConfig): The AWS-EC2 environment configuration
+        recInfo (RequestConfig): The request
+        journal (StepJournal, optional): Resumes after the steps a previous attempt completed. Defaults to None.
+    Returns:
+        bool: True if every user and the SSP update succeeded
+    """
 
-    ### Read UserConfig:
+    ### Read UserConfig(s):
     ###     Clean Repo-DIR
     ###     Clone Repo
     ###     Pull the branch from reqInfo
-    ###     Copy the User-Command File to Users-Dir
-    ###     Safely INIT the userInfo
+    ###     Safely INIT the userInfo of every user-file of the request
 
-    ### Determine Command ( Create|Read|Update|Delete|??? )
-    ### Dispatch the command execution
+    ### Determine Command ( Create|Read|Update|Delete|??? ) per user-file
+    ### Dispatch the command execution, then ONE SSP transform and ONE commit for all
     if not (envInfo and recInfo):
         if not envInfo:
             InfoBoard.pin_error(f'Missing valid Environment file')
@@ -825,115 +2188,346 @@ def dispatch_command(envInfo: EnvConfig, recInfo: RequestConfig) -> bool:
         if not recInfo:
             InfoBoard.pin_error(f'Missing valid Request file')
             return False
-    else:
-        ### Here we have 2 Required files and can try 
-        ### Using Git-User-File determine COMMAND and Dispatch
-        repo_ops = RepoOperations(recInfo, envInfo)
-        print('\n\n')
-        repo_ops.print_commands()
-
-        
-        ### Git-Repo Preparation logic
-        repo_ops.execute_batch_by_ids(repo_ops.get_init_git_repo_commands())
-        user_ops = None
-        APP.debug(f'Concatenating:\n{recInfo.get_cmd_file_name()=}\nand\n{envInfo.get_git_repo_dir()=}')
-        user_file = os.path.join(envInfo.get_git_repo_dir(), recInfo.get_cmd_file_name())
-        APP.debug(f'Working on {user_file=}')        
-        if not os.path.isfile(user_file):
-            APP.debug(f'The FILE:\n{user_file=}\ncould not be found!!!')
-        if os.path.isfile(user_file):
-            userInfo = UserConfig(user_file)
-            APP.debug(user_file)
-            APP.print_dir(userInfo)
-
-            ### Alt-Implementation for Python <3.10
-            ### Read COMMAND from the user-command-file
-            user_ops = UserOperations(recInfo, userInfo, envInfo)
-            user_command = userInfo.get_command()
-            if user_ops:
-                APP.debug(f'Executing User Command: {user_command}')
-                ### CREATING USER
-                if user_command=='create-user': 
-                    ### Create or Read (if Exists) User & Get UUID                
-                    (user_name, cognito_user_uuid) = user_ops.create_idp_user()
-                    APP.debug(f'Created user: {user_name} with UUID: {cognito_user_uuid}')
-                    ### Register User in AMB [if needed]
-                    user_role = userInfo.get_role()
-
-                    ### Create Fabric-User if Required
-                    if AuthRoles.is_fabric_role( user_role ):
-                        user_ops.create_fabric_user()
-                        ### Create User SSM Entries [if needed]
-                        user_ops.create_ssm_entries()
-                    elif AuthRoles.is_fabric_read_role( user_role ):
-                        ### Create User SSM Entries [if read-rights are needed]
-                        ### Map the user to read only service AMB-service role
-                        user_ops.create_read_ssm_entries()
-                        pass
-
-                ### Update SSP-Document
-                if is_uuid_valid(cognito_user_uuid):
-                    ### Create XML equivalent of User-File
-                    user_ops.compose_create_party_fragment_file(cognito_user_uuid)
-                    ### Update SSP
-                    pass
-                    # user_xml = userInfo.get
-                ### DELETING USER
-                elif user_command=='delete-user': 
-                    ### Read User if Exists (Blow Otherwise) => Get UserID & UUID 
-                    ### Remove User from AMB [if needed]
-                    ### KILL User SSM Entries [if needed]
-                    ### Create XML equivalent of User-Delete-File
-                    ### Update SSP
-                    pass
-
-            """ Doesn't work in Python below 3.10
-            user_command = userInfo.get_command()
-            match user_command:
-                case 'create-user': 
-                    ### Create User & Get UUID                
-                    user_uuid = create_idp_user(recInfo, userInfo, envInfo)
-                    if AuthRoles.is_fabric_role( userInfo.get_role()):
-                        ### Create FAbric-User if Required
-                        create_fabric_user(recInfo, userInfo, envInfo)
-                    ### Update SSP
-                    if user_ops.is_uuid_valid(user_uuid):
-                        user_xml = userInfo.get
-                case 'delete-user':
-                    delete_user()
-                case 'update-user':
-                    pass
-            """
-
-        ### Git-Repo Finishing Logic [i.e. Add-Commit-Push]
-        if APP.CMD_ONLY_PRINT or APP.CLI_DEBUG_MODE:
-            repo_ops.print_commands_by_ids(repo_ops.get_finish_git_repo_commands())
-        if not APP.CMD_ONLY_PRINT:
-            # repo_ops.execute_batch_by_ids(repo_ops.get_finish_git_repo_commands())
-            pass
 
+    ### Here we have 2 Required files and can try 
+    ### Using Git-User-File(s) determine COMMAND and Dispatch
+    user_files = recInfo.get_cmd_file_names()
+    if not user_files:
+        InfoBoard.pin_error(f'No user-file in the Request file')
+        return False
+    repo_ops = RepoOperations(recInfo, envInfo)
+    journal = journal if journal else StepJournal()
+    finish_steps = [command_id.cmd_key() for command_id in repo_ops.get_finish_git_repo_commands(True, True)]
+    print('\n\n')
+    repo_ops.print_commands()
+
+    ### Git-Repo Preparation logic - once for all the users, kept on a resume as the last attempt left it
+    if not repo_ops.is_resumable(journal):
+        journal.forget(['GIT_INIT'] + finish_steps)
+        outcome = repo_ops.execute_batch_by_ids(repo_ops.get_init_git_repo_commands(),
+                                                repo_ops.get_init_git_repo_dependencies())
+        if outcome and all(code == 0 for (out, err, code, text) in outcome[0].values()):
+            journal.done('GIT_INIT', repo_ops.get_repo_state())
+
+    ### The delete-user files of the request at once (one concurrent batch), the others one by one
+    todo = [user_file_name for user_file_name in user_files if not journal.is_done(f'USER:{user_file_name}')]
+    todo_users = {user_file_name: read_user_file(envInfo, user_file_name)[0] for user_file_name in todo}
+    ### The request ran in the lane of its command: a user-file of another command is rejected
+    contradictions = {user_file_name: (f'{user_file_name}: {userInfo.get_command()} contradicts '
+                                       f'the {recInfo.get_declared_command()} of the request')
+                      for (user_file_name, userInfo) in todo_users.items()
+                      if userInfo and recInfo.get_declared_command() 
+                      and userInfo.get_command() != recInfo.get_declared_command()}
+    deletions = {user_file_name: userInfo for (user_file_name, userInfo) in todo_users.items()
+                 if userInfo and userInfo.get_command() == 'delete-user' and user_file_name not in contradictions}
+    try:
+        deleted = delete_users(envInfo, recInfo, deletions, journal) if deletions else {}
+    except Exception as ex:
+        APP.debug(traceback.format_exc())
+        deleted = {user_file_name: (USER_FAILED, f'{type(ex).__name__}: {ex}', '') for user_file_name in deletions}
+
+    ### One failed user must not stop the rest of the request
+    statuses = {}
+    party_xmls = {}
+    party_uuids = {}    ### The parties of the deleted users to remove
+    ssm = SsmPublisher(envInfo)
+    ssm_files = {}      ### user -> the user-file of its SSM entries
+    for user_file_name in user_files:
+        user_step = f'USER:{user_file_name}'
+        if journal.is_done(user_step):
+            ### Done by a previous attempt: its party (if not published yet) still goes into the SSP
+            (status, message, party_xml, party_uuid) = (journal.get(user_step)['status'], 
+                                            f"{journal.get(user_step)['message']} (journaled)",
+                                            journal.get(user_step)['party'],
+                                            journal.get(user_step).get('uuid', ''))
+        else:
+            if user_file_name in deleted:
+                (status, message, party_uuid) = deleted[user_file_name]
+                party_xml = ''
+            elif user_file_name in contradictions:
+                (status, message, party_xml, party_uuid) = (USER_FAILED, contradictions[user_file_name], '', '')
+            else:
+                try:
+                    queued = set(ssm.users)
+                    (status, message, party_xml) = dispatch_user_command(envInfo, recInfo, user_file_name, journal, ssm)
+                    ssm_files.update({user_id: user_file_name for user_id in ssm.users if user_id not in queued})
+                except Exception as ex:
+                    APP.debug(traceback.format_exc())
+                    (status, message, party_xml) = (USER_FAILED, f'{type(ex).__name__}: {ex}', '')
+                party_uuid = ''
+            if status != USER_FAILED:
+                journal.done(user_step, {'status': status, 'message': message, 'party': party_xml, 'uuid': party_uuid})
+        statuses[user_file_name] = (status, message)
+        if party_xml:
+            party_xmls[user_step] = party_xml
+        if party_uuid:
+            party_uuids[user_step] = party_uuid
+
+    ### The SSM entries of all the enrolled users as one batch: the user is done once they are published
+    try:
+        with CommandRunner.LOCKS.hold([f'user:{user_id}' for user_id in ssm.users]):
+            ssm_errors = ssm.publish()
+    except Exception as ex:
+        APP.debug(traceback.format_exc())
+        ssm_errors = {user_id: f'{type(ex).__name__}: {ex}' for user_id in ssm.users}
+    for (user_id, ssm_error) in ssm_errors.items():
+        if ssm_error and user_id in ssm_files:
+            ### Neither journaled nor in the SSP: the retry runs the user again
+            statuses[ssm_files[user_id]] = (USER_FAILED, f'{user_id}: SSM {ssm_error}')
+            journal.forget([f'USER:{ssm_files[user_id]}'])
+            party_xmls.pop(f'USER:{ssm_files[user_id]}', None)
+    report_user_statuses(statuses)
+    all_users_ok = all(status != USER_FAILED for (status, _) in statuses.values())
+
+    ### Git-Repo Finishing Logic [i.e. SSP-Transform-Add-Commit-Push] - once for all the users
+    if APP.CMD_ONLY_PRINT or APP.CLI_DEBUG_MODE:
+        repo_ops.print_commands_by_ids(repo_ops.get_finish_git_repo_commands(bool(party_uuids), bool(party_xmls)))
+    if not (party_xmls or party_uuids):
+        return all_users_ok
+    if APP.CMD_ONLY_PRINT or not envInfo.get_bat_publish():
+        if party_xmls:
+            write_party_fragment_file(list(party_xmls.values()), repo_ops.party_file)
+        if party_uuids:
+            write_party_remove_file(list(party_uuids.values()), repo_ops.remove_file)
+        return all_users_ok
+    ### One request at a time per SSP of the branch: transform, commit and push on top of the latest push
+    with CommandRunner.LOCKS.hold([repo_ops.get_ssp_lock_name()]):
+        return finish_command(repo_ops, journal, party_xmls, party_uuids) and all_users_ok
+# ---------------------------------------------------------------------------------
+def finish_command(repo_ops: RepoOperations, journal: StepJournal, party_xmls: dict, party_uuids: dict = None) -> bool:
+    """ The SSP transform(s), add, commit and push of the request, the SSP locked
+    Args:
+        repo_ops (RepoOperations): The repo of the request
+        journal (StepJournal): The steps done
+        party_xmls (dict): USER step -> party XML to insert
+        party_uuids (dict, optional): USER step -> UUID of the party to remove. Defaults to None.
+    Returns:
+        bool: True if the SSP update got pushed
+    """
+    party_uuids = party_uuids if party_uuids else {}
+    if not repo_ops.sync_repo(journal):
+        InfoBoard.pin_error(f'SSP update of the request failed at: {CommandEC2.GIT_FETCH_BRANCH.cmd_key()}')
+        return False
+    finish_ids = repo_ops.get_finish_git_repo_commands(bool(party_uuids), bool(party_xmls))
+    finish_steps = [command_id.cmd_key() for command_id in repo_ops.get_finish_git_repo_commands(True, True)]
+    ### Update SSP-Document: a single fragment inserting ALL the parties, a single list removing them
+    if party_xmls:
+        write_party_fragment_file(list(party_xmls.values()), repo_ops.party_file)
+    if party_uuids:
+        write_party_remove_file(list(party_uuids.values()), repo_ops.remove_file)
+    InfoBoard.pin_info(f'Parties to insert into SSP: {len(party_xmls)}, to remove: {len(party_uuids)}\n\t'
+                       f'{repo_ops.party_file}\n\t{repo_ops.remove_file}')
+    ### The chain resumes at its first step not journaled
+    remaining = [command_id for command_id in finish_ids if not journal.is_done(command_id.cmd_key())]
+    outcome = repo_ops.execute_batch_by_ids(remaining, 
+                        {later: earlier for (later, earlier) in 
+                         repo_ops.get_finish_git_repo_dependencies(bool(party_uuids), bool(party_xmls)).items()
+                         if later in remaining and all(command_id in remaining for command_id in earlier)})
+    for (command_id, (out, err, code, text)) in (outcome[0].items() if outcome else []):
+        if code == 0:
+            journal.done(command_id.cmd_key(), 
+                         repo_ops.get_repo_state() if command_id == CommandEC2.GIT_COMMIT_CHANGES else None)
+    failed_steps = ([str(key) for (key, (out, err, code, text)) in outcome[0].items() if code != 0]
+                    if outcome else ['all'])
+    if failed_steps:
+        InfoBoard.pin_error(f'SSP update of the request failed at: {", ".join(failed_steps)}')
+        return False
+    ### Published: a retry of the failed users starts a new transform and commit on top of this one
+    journal.done('GIT_INIT', repo_ops.get_repo_state())
+    journal.forget(finish_steps)
+    for user_step in set(party_xmls) | set(party_uuids):
+        journal.done(user_step, dict(journal.get(user_step), party='', uuid=''))
     return True
 # ---------------------------------------------------------------------------------
 # =================================================================================
 
 
+def stage_s3_file(s3_file: str, envInfo: EnvConfig, dedup: DedupStore = None) -> tuple[RequestConfig, str, bool]:
+    """ Moves a single S3 file of the batch and reads its request
+    Args:
+        s3_file (str): The name of the S3 file to move
+        envInfo (EnvConfig): The AWS-EC2 environment configuration
+        dedup (DedupStore, optional): Skips the already processed or in-flight files. Defaults to None.
+    Returns:
+        tuple[RequestConfig, str, bool]: (request to dispatch or None, its dedup-key, 
+                                          outcome of the file if there is nothing to dispatch)
+    """
+    CommandRunner.TIMER.request_id = s3_file  ### The timings of the commands are keyed on it
+    ### Init S3 operations and move the requirements file if needed
+    s3_ops = S3Operations(s3_file, envInfo)     ### Init the commands object for the S3-Ops
+    rec_file = move_s3_file(s3_ops)             ### Get moved file or existing and moved previously
+
+    ### ❌❌❌ BREAK EARLY if S3 file did not get moved locally
+    if not( rec_file and os.path.isfile(rec_file) ):
+        InfoBoard.pin_error(f'S3 File {s3_ops.s3_file_url} Not Moved') ### Show Error Message
+        return (None, '', False)
+
+    ### ⏭️⏭️⏭️ SKIP the repeated notification of the same file content
+    dedup_key = s3_ops.get_dedup_key()
+    if dedup and not dedup.claim(dedup_key, envInfo.get_bat_dedup_lease()):
+        InfoBoard.pin_info(f'\tSkipping {dedup_key}:\n\talready {dedup.get_state(dedup_key) or "processed"}')
+        return (None, dedup_key, True)
+    
+    ### ✅✅✅ Work with the local REC-file
+    InfoBoard.pin_info(f'\tLocal S3 File {s3_ops.s3_file_url}\n\tMoved to {s3_ops.rec_file}')
+    recInfo = RequestConfig(rec_file)
+    if not recInfo.is_valid():
+        ### ❌❌❌ The same content never gets valid: do NOT retry it
+        InfoBoard.pin_error(f'Invalid REC-file {rec_file}:\n\t' + '\n\t'.join(recInfo.errors))
+        if dedup:
+            dedup.mark_done(dedup_key, envInfo.get_bat_dedup_ttl())
+        return (None, dedup_key, False)
+    return (recInfo, dedup_key, True)
+# -----------------------------------------------------------------------------
+
+def run_request(s3_file: str, envInfo: EnvConfig, recInfo: RequestConfig, 
+                dedup: DedupStore = None, dedup_key: str = '') -> bool:
+    """ Dispatches the request of a staged S3 file in a repo-dir of its own
+    Args:
+        s3_file (str): The name of the S3 file
+        envInfo (EnvConfig): The AWS-EC2 environment configuration
+        recInfo (RequestConfig): The request of the file
+        dedup (DedupStore, optional): Marks the file done or releases it for the retry. Defaults to None.
+        dedup_key (str, optional): The key the file was claimed with. Defaults to ''.
+    Returns:
+        bool: True if the command of the REC-file was dispatched, False otherwise
+    """
+    CommandRunner.TIMER.request_id = s3_file  ### The timings of the commands are keyed on it
+    rec_file = recInfo.yaml_file
+    ### The retries of the file get the same repo-dir back: the journal resumes in it
+    requestEnv = envInfo.for_request(s3_file)
+    ### The steps a failed attempt of the same content completed (print-only runs do not journal)
+    journal = StepJournal(JournalStore(envInfo.get_bat_state_db()) if not APP.CMD_ONLY_PRINT else None,
+                          StepJournal.get_journal_key(s3_file, rec_file))
+    if not dispatch_command(requestEnv, recInfo, journal): ### Dispatch command processing
+        ### ❌❌❌ BREAK EARLY if failed to dispatch (the journal keeps the completed steps for the retry)
+        InfoBoard.pin_error(f'Failed to dispatch command from REC-file {rec_file}')
+        if dedup:
+            dedup.release(dedup_key)
+        return False
+    journal.clear()
+    if not APP.CMD_ONLY_PRINT:
+        ### A failed request keeps them: its retry resumes in the same clone with the same fragment files
+        shutil.rmtree(requestEnv.get_git_repo_dir(), ignore_errors=True)
+        shutil.rmtree(requestEnv.get_bat_user_dir(), ignore_errors=True)
+    InfoBoard.pin_info(f'Successfully dispatched command from REC-file {rec_file}')
+    if dedup:
+        dedup.mark_done(dedup_key, envInfo.get_bat_dedup_ttl())
+    return True
+# -----------------------------------------------------------------------------
+
+class RequestScheduler(object):
+    """ Runs the S3 files of the batch on a pool of workers: the requests wait in the lanes of their commands
+        (e.g. the deletions ahead of the creations), the identity and SSP locks serialize the ones touching the same
+    """
+
+    def __init__(self, envInfo: EnvConfig, dedup: DedupStore = None) -> None:
+        super().__init__()
+        self.envInfo = envInfo
+        self.dedup = dedup
+        self.workers = envInfo.get_bat_max_requests()
+        self.lanes = envInfo.get_bat_lanes()
+    # -----------------------------------------------------------------------------
+
+    def get_lane(self, recInfo: RequestConfig) -> int:
+        command = recInfo.get_command()
+        return self.lanes.index(command) if command in self.lanes else len(self.lanes)
+    # -----------------------------------------------------------------------------
+
+    def run(self, s3_files: list[str]) -> list[str]:
+        """ Stages every file, then runs the requests lane by lane (in the batch order within the lane)
+        Returns:
+            list[str]: The failed S3 files
+        """
+        failed = []
+        staged = []
+        for s3_file in s3_files:
+            (recInfo, dedup_key, outcome) = stage_s3_file(s3_file, self.envInfo, self.dedup)
+            if recInfo:
+                staged.append((self.get_lane(recInfo), len(staged), s3_file, recInfo, dedup_key))
+            elif not outcome:
+                failed.append(s3_file)
+        ### Sorted: the pool starts the requests in the order they were submitted
+        staged.sort(key=lambda entry: entry[:2])
+        InfoBoard.pin_info(f'Requests by lane ({self.workers} at once):\n' + '\n'.join(
+            f'\t{recInfo.get_command():<12}{s3_file}' for (_, _, s3_file, recInfo, _) in staged))
+        if self.workers == 1 or len(staged) < 2:
+            outcomes = [self.run_one(*entry[2:]) for entry in staged]
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='request') as pool:
+                outcomes = list(pool.map(lambda entry: self.run_one(*entry[2:]), staged))
+        return failed + [s3_file for ((_, _, s3_file, _, _), ok) in zip(staged, outcomes) if not ok]
+    # -----------------------------------------------------------------------------
+
+    def run_one(self, s3_file: str, recInfo: RequestConfig, dedup_key: str) -> bool:
+        try:
+            return run_request(s3_file, self.envInfo, recInfo, self.dedup, dedup_key)
+        except Exception as ex:
+            ### One failed request must not stop the others of the pool
+            APP.debug(traceback.format_exc())
+            InfoBoard.pin_error(f'Request {s3_file} failed: {type(ex).__name__}: {ex}')
+            if self.dedup:
+                self.dedup.release(dedup_key)
+            return False
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+def purge_request_dirs(envInfo: EnvConfig, seconds: float) -> int:
+    """ Removes the directories of the failed requests not retried within the time (their journal is purged too)
+    Returns:
+        int: The number of requests cleaned up
+    """
+    requests_dir = envInfo.get_bat_requests_dir() if envInfo.get_bat_user_dir() else ''
+    if not (requests_dir and os.path.isdir(requests_dir) and envInfo.get_git_repo_dir().rstrip('/')):
+        return 0
+    purged = 0
+    for request_name in os.listdir(requests_dir):
+        request_dir = os.path.join(requests_dir, request_name)
+        if os.path.isdir(request_dir) and os.path.getmtime(request_dir) < time.time() - seconds:
+            ### Only the repo-dir of a request dir for_request() made: never a sibling of the repo-dir by chance
+            shutil.rmtree(envInfo.get_request_repo_dir(request_name), ignore_errors=True)
+            shutil.rmtree(request_dir, ignore_errors=True)
+            purged += 1
+    return purged
+# -----------------------------------------------------------------------------
+
+def init_runners(envInfo: EnvConfig) -> None:
+    """ Logging, backends, limits, memo, timings and CA index of the CommandRunner(s) of the run
+    """
+    APP.init_log(envInfo)               ### Init Logging and stdOut reporting
+    set_backend(make_backend(envInfo))  ### aws CLI commands in-process if configured
+    set_guards(make_guards(envInfo))    ### Cognito/Fabric-CA rate limits and circuit breakers if configured
+    CommandRunner.MEMO = CommandMemo(   ### Read-only lookups: run-scope + TTL across runs if configured
+                MemoStore(envInfo.get_bat_state_db()) if envInfo.get_bat_memo_ttl() > 0 else None,
+                envInfo.get_bat_memo_ttl())
+    CommandRunner.TIMER = CommandTimer(TimingStore(envInfo.get_bat_state_db()))
+    CommandRunner.CA_INDEX = CaIdentityIndex(   ### One bulk Fabric-CA identity list per run (or per TTL)
+                CaIdentityStore(envInfo.get_bat_state_db()) if envInfo.get_bat_ca_index_ttl() > 0 else None,
+                envInfo.get_bat_ca_index_ttl())
+    CommandRunner.TIMER.store.purge_older(envInfo.get_bat_timings_ttl())
+    JournalStore(envInfo.get_bat_state_db()).purge_older(envInfo.get_bat_journal_ttl())
+    purge_request_dirs(envInfo, envInfo.get_bat_journal_ttl())
+    CommandRunner.LOCKS = LockTable(envInfo.get_bat_lock_dir())
+    CommandRunner.ENROLLMENTS = EnrollmentIndex(EnrollmentStore(envInfo.get_bat_state_db()), envInfo.get_amb_clients_dir())
+# -----------------------------------------------------------------------------
+
 @click.command(help="process-s3-file: Creates BloSS🌻M User as required per role")
-@click.option('--s3_file', '-s3',
-                help="BloSS🌻M original S3-sourced YAML-file-trigger")
+@click.option('--s3_file', '-s3', multiple=True,
+                help="BloSS🌻M original S3-sourced YAML-file-trigger (repeat for a batch)")
 # @click.option('--user_file', '-u',
 #                 help="BloSS🌻M user-to-create YAML-file request")
 @click.option('--env_file', '-e', default='./env-ec2-prod.yaml',
                 help="BloSS🌻M AWS-EC2-AMB-GitHub env-description YAML-file")
-def process_s3_file(s3_file:str, 
+def process_s3_file(s3_file:tuple[str], 
                     env_file: str, ):
-    """ Launches whole S3-processing process
+    """ Launches whole S3-processing process for every S3 file of the batch
     Args:
-        s3_file (str): The name of the S3 file to move and process
+        s3_file (tuple[str]): The names of the S3 files to move and process
         env_file (str): The name of the AWS-EC2 environment file
     """
-    envInfo = recInfo = None        ### Create ENV and REC empty objects
-    InfoBoard.pin_info(              ### Print-Log info about the REC-file being processed
-        f'Starting PROCESS-S3-FILE for:\nS3-File:\t{s3_file}\nEnv-File:\t{env_file}'
+    envInfo = None                  ### Create ENV empty object
+    InfoBoard.pin_info(              ### Print-Log info about the REC-files being processed
+        f'Starting PROCESS-S3-FILE for:\nS3-File(s):\t{", ".join(s3_file)}\nEnv-File:\t{env_file}'
         ) 
     
     ### ❌❌❌ BREAK EARLY if parameters or files are missing 
@@ -944,30 +2538,90 @@ def process_s3_file(s3_file:str,
     
     ### ✅✅✅ If we are here - all the params were OK 👍👍👍
     envInfo = EnvConfig(env_file)       ### Read the environment descriptor from the EC2-Located-File
-    APP.init_log(envInfo)               ### Init Logging and stdOut reporting
-    ### Init S3 operations and move the requirements file if needed
-    s3_ops = S3Operations(s3_file, envInfo)     ### Init the commands object for the S3-Ops
-    rec_file = move_s3_file(s3_ops)             ### Get moved file or existing and moved previously
+    init_runners(envInfo)
+    ### De-duplication is off with 0 dedup-ttl
+    dedup = DedupStore(envInfo.get_bat_state_db()) if envInfo.get_bat_dedup_ttl() > 0 else None
+    ### One failed file must not stop the rest of the batch
+    failed = RequestScheduler(envInfo, dedup).run(list(s3_file))
+    if failed:
+        InfoBoard.pin_error(f'Failed S3 File(s) in the batch:\n\t' + '\n\t'.join(failed))
+# -----------------------------------------------------------------------------
 
-    ### ❌❌❌ BREAK EARLY if S3 file did not get moved locally
-    if not( rec_file and os.path.isfile(rec_file) ):
-        InfoBoard.pin_error(f'S3 File {s3_ops.s3_file_url} Not Moved') ### Show Error Message
+@click.command(help="timings: Percentiles of the command timings per kind")
+@click.option('--env_file', '-e', default='./env-ec2-prod.yaml',
+                help="BloSS🌻M AWS-EC2-AMB-GitHub env-description YAML-file")
+@click.option('--window', '-w', default=24.0, show_default=True,
+                help="Hours back to report")
+@click.option('--kind', '-k', default=None,
+                help="Only the command kind (e.g. IDP_READ_USER)")
+def timings(env_file: str, window: float, kind: str):
+    """ Reports the wall-time percentiles, failures, CPU and RSS per command kind
+    Args:
+        env_file (str): The name of the AWS-EC2 environment file (locates the state-db)
+        window (float): Hours back to report
+        kind (str): Only this CommandEC2 key (or program name)
+    """
+    if not(env_file and os.path.isfile(env_file)):
+        click.echo(click.get_current_context().get_help()) ### Show CLI HELP
         return
-    
-    ### ✅✅✅ Work with the local REC-file
-    if rec_file and os.path.isfile(rec_file):
-        InfoBoard.pin_info(f'\tLocal S3 File {s3_ops.s3_file_url}\n\tMoved to {s3_ops.rec_file}')
-        if os.path.isfile(rec_file):
-            recInfo = RequestConfig(rec_file)
-            if not dispatch_command(envInfo, recInfo): ### Dispatch command processing
-                ### ❌❌❌ BREAK EARLY if failed to dispatch
-                InfoBoard.pin_error(f'Failed to dispatch command from REC-file {rec_file}')
-                return
-            else:
-                InfoBoard.pin_info(f'Successfully dispatched command from REC-file {rec_file}')
-        else:
-            InfoBoard.pin_error(f'REC-File {rec_file} Not Found')
-            return 
+    envInfo = EnvConfig(env_file)
+    store = TimingStore(envInfo.get_bat_state_db())
+    report = store.get_report(time.time() - window * 3600, kind)
+    if not report:
+        click.echo(f'No timings in the last {window} hour(s)')
+        return
+    columns = ['kind', 'backend', 'count', 'failed', 'wall_p50', 'wall_p90', 'wall_p99', 'wall_max', 
+               'cpu_p50', 'cpu_p90', 'rss_max', 'bytes_p50']
+    rows = [[('-' if line[column] is None else str(line[column])) for column in columns]
+            for line in sorted(report, key=lambda line: -line['wall_p90'])]
+    widths = [max(len(cell) for cell in cells) for cells in zip(columns, *rows)]
+    click.echo(f'Command timings of the last {window} hour(s) [ms, kB, bytes]')
+    for cells in [columns] + rows:
+        ### kind and backend to the left, the figures to the right
+        click.echo('  '.join(cell.ljust(width) if index < 2 else cell.rjust(width)
+                             for (index, (cell, width)) in enumerate(zip(cells, widths))))
+# -----------------------------------------------------------------------------
+
+@click.command(help="enrollments: The enrolled Fabric client identities of amb/clients-dir")
+@click.option('--env_file', '-e', default='./env-ec2-prod.yaml',
+                help="BloSS🌻M AWS-EC2-AMB-GitHub env-description YAML-file")
+@click.option('--expiring', '-x', default=None, type=float,
+                help="Only the certificates expiring within the days")
+@click.option('--rebuild', is_flag=True, default=False,
+                help="Indexes the MSP directories of amb/clients-dir anew first (e.g. the enrollments made before the index)")
+def enrollments(env_file: str, expiring: float, rebuild: bool):
+    """ Lists the enrolled identities out of the index, the earliest expiry first
+    Args:
+        env_file (str): The name of the AWS-EC2 environment file (locates the state-db and amb/clients-dir)
+        expiring (float): Only the certificates expiring within the days
+        rebuild (bool): Indexes the MSP directories anew first
+    """
+    if not(env_file and os.path.isfile(env_file)):
+        click.echo(click.get_current_context().get_help()) ### Show CLI HELP
+        return
+    envInfo = EnvConfig(env_file)
+    index = EnrollmentIndex(EnrollmentStore(envInfo.get_bat_state_db()), envInfo.get_amb_clients_dir())
+    if not index.store:
+        InfoBoard.pin_error('The enrollment index needs the cryptography package')
+        return
+    if rebuild:
+        (indexed, failed) = index.rebuild()
+        click.echo(f'Indexed {indexed} enrollment(s) of {envInfo.get_amb_clients_dir()}')
+        for failure in failed:
+            InfoBoard.pin_warning(f'Not indexed: {failure}')
+    now = time.time()
+    listed = index.get_expiring(now + expiring * 86400 if expiring is not None else None)
+    if not listed:
+        click.echo('No enrollment' + (f' expiring within {expiring} day(s)' if expiring is not None else ''))
+        return
+    columns = ['identity', 'role', 'serial', 'expires', 'days', 'msp_dir']
+    rows = [[enrollment['identity'], enrollment['role'] or '-', enrollment['serial'],
+             datetime.fromtimestamp(enrollment['not_after'], timezone.utc).strftime('%Y-%m-%d %H:%M'),
+             f"{(enrollment['not_after'] - now) / 86400:.0f}", enrollment['msp_dir']]
+            for enrollment in listed]
+    widths = [max(len(cell) for cell in cells) for cells in zip(columns, *rows)]
+    for cells in [columns] + rows:
+        click.echo('  '.join(cell.ljust(width) for (cell, width) in zip(cells, widths)).rstrip())
 # -----------------------------------------------------------------------------
 
 @click.command(help="create-user: Creates BloSS🌻M User as required per role")
@@ -1048,23 +2702,31 @@ def create_user(req_file:str,
         print(CommandEC2.AMB_DEACTIVATE_USER.cmd_key())
 # -----------------------------------------------------------------------------
 
-@click.command(help="delete-user: Deletes BloSS🌻M User from IDP+Fabric if exists")
-@click.option('--env_file', '-e',
+@click.command(help="delete-user: Deletes BloSS🌻M User(s) from IDP+Fabric+SSP if exist")
+@click.option('--env_file', '-e', default='./env-ec2-prod.yaml',
                 help="BloSS🌻M AWS-EC2-AMB-GitHub environment-description YAML-fle"
                 )
-@click.option('--user_file', '-u',
-                help="BloSS🌻M user-to-delete YAML-file request"
+@click.option('--req_file', '-r',
+                help="BloSS🌻M request-file listing the user-to-delete YAML-file(s)"
                 )
-def delete_user(ctx):
-    ### 1. Validate Input
-    ### 2. Verify Command is Delete USER
-    ### ⇉3.b-(Delete) Create User based on Env&User Files
-    ###     4. Query User to make sure it EXISTS - read PROFILE & UUID
-    ###     5. Delete User in IDP-Cognito [Optional for Fabric-User Deactivate]
-    ###     6. Clone Repo + Checkout Branch
-    ###     7. Remove the user (as Party & Resp-Party) from SSP using UUID
-    ###     8. Add-Commit-Push Repo + Remove Repo Directory
-    pass
+def delete_user(env_file: str, req_file: str):
+    """ Offboards the users of a local request-file as process-s3-file does:
+        Cognito deletes and Fabric-CA removals at once, ONE SSP transform and ONE commit
+    Args:
+        env_file (str): The name of the AWS-EC2 environment file
+        req_file (str): The request-file (branch_name, issue_number, file or files of the delete-user user-files)
+    """
+    if not(env_file and os.path.isfile(env_file) and req_file and os.path.isfile(req_file)):
+        click.echo(click.get_current_context().get_help()) ### Show CLI HELP
+        return
+    envInfo = EnvConfig(env_file)
+    init_runners(envInfo)
+    recInfo = RequestConfig(req_file)
+    if not recInfo.is_valid():
+        InfoBoard.pin_error(f'Invalid REC-file {req_file}:\n\t' + '\n\t'.join(recInfo.errors))
+        raise SystemExit(1)
+    if not run_request(os.path.basename(req_file), envInfo, recInfo):
+        raise SystemExit(1)
 # -----------------------------------------------------------------------------
 #==================================================================================
 
@@ -1102,6 +2764,8 @@ def cli_entries(ctx, execute_flag:str, debug_flag: str):
 cli_entries.add_command(delete_user)
 cli_entries.add_command(create_user)
 cli_entries.add_command(process_s3_file)
+cli_entries.add_command(timings)
+cli_entries.add_command(enrollments)
 #==================================================================================
 
 
@@ -0,0 +1,376 @@
+# =================================================================================
+# In-process client of the Fabric-CA REST API (what fabric-ca-client does per process):
+#   GET  /api/v1/identities/<id>  - identity lookup   (token auth of the registrar)
+#   POST /api/v1/register         - identity register (token auth of the registrar)
+#   POST /api/v1/enroll           - enrollment        (basic auth of the identity)
+# One keep-alive HTTPS connection per thread and CA, the registrar credentials are read once.
+# The token is "b64(cert).b64(signature)", the low-S ECDSA-SHA256 signature of
+#   "<METHOD>.b64(<request URI>).b64(<body>).b64(<cert>)"
+import base64
+import hashlib
+import http.client
+import json
+import os
+import re
+import ssl
+import threading
+import urllib.parse
+
+# From ----------------------------------------------------------------------------
+from datetime import timezone
+
+# Spec+PIP ------------------------------------------------------------------------
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature, encode_dss_signature
+    from cryptography.x509.oid import NameOID
+except ImportError:     ### Optional: the fabric-ca-client CLI does not need it
+    x509 = None
+
+# Local ---------------------------------------------------------------------------
+#==================================================================================
+
+### Order of the curves, the signature S above its half is flipped (Fabric-CA rejects the high-S)
+CURVE_ORDERS = {
+    'secp256r1': 0xFFFFFFFF00000000FFFFFFFFFFFFFFFFBCE6FAADA7179E84F3B9CAC2FC632551,
+    'secp384r1': int('FFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFC7634D81F4372DDF581A0DB248B0A77AECEC196ACCC52973', 16),
+}
+### Fabric-CA error: the identity is not registered
+ERROR_NOT_FOUND = 63
+### The certificate extension of the Fabric attributes: {"attrs": {<name>: <value>}}
+ATTRS_OID = '1.2.3.4.5.6.7.8.1'
+### One identity of the 'fabric-ca-client identity list' output
+IDENTITY_LINE = re.compile(r'^Name: (?P<id>.*?), Type: (?P<type>.*?), Affiliation: (?P<affiliation>.*?), '
+                           r'Max Enrollments: (?P<max_enrollments>-?\d+), Attributes: \[(?P<attrs>.*)\]\s*$')
+IDENTITY_ATTR = re.compile(r'\{Name:(?P<name>.*?) Value:(?P<value>.*?) ECert:(?P<ecert>true|false)\}')
+### -------------------------------------------------------------------------------
+
+
+def b64(data) -> str:
+    return base64.b64encode(data.encode('utf-8') if isinstance(data, str) else data).decode('ascii')
+### -------------------------------------------------------------------------------
+
+
+def format_ca_identity(identity: dict) -> str:
+    """ The 'fabric-ca-client identity list' line of the identity (REST shape: id, type, attrs, ...)
+    """
+    attributes = ' '.join(f"{{Name:{attr.get('name')} Value:{attr.get('value')} "
+                          f"ECert:{str(attr.get('ecert', False)).lower()}}}"
+                          for attr in identity.get('attrs') or [])
+    return (f"Name: {identity.get('id')}, Type: {identity.get('type')}, "
+            f"Affiliation: {identity.get('affiliation')}, Max Enrollments: {identity.get('max_enrollments')}, "
+            f"Attributes: [{attributes}]\n")
+### -------------------------------------------------------------------------------
+
+
+def parse_ca_identities(text: str) -> dict:
+    """ Parses the 'fabric-ca-client identity list' output (the other lines are skipped)
+    Returns:
+        dict: id -> identity in the REST shape (id, type, affiliation, max_enrollments, attrs)
+    """
+    identities = {}
+    for line in (text or '').splitlines():
+        match = IDENTITY_LINE.match(line.strip())
+        if not match:
+            continue
+        identities[match['id']] = {
+            'id': match['id'],
+            'type': match['type'],
+            'affiliation': match['affiliation'],
+            'max_enrollments': int(match['max_enrollments']),
+            'attrs': [{'name': attr['name'], 'value': attr['value'], 'ecert': attr['ecert'] == 'true'}
+                      for attr in IDENTITY_ATTR.finditer(match['attrs'])]}
+    return identities
+### -------------------------------------------------------------------------------
+
+
+def is_available() -> bool:
+    return x509 is not None
+### -------------------------------------------------------------------------------
+
+
+def get_ski(public_key) -> str:
+    """ Subject-Key-Identifier the MSP keystore names the keys by: SHA256 of the uncompressed point
+    """
+    point = public_key.public_bytes(serialization.Encoding.X962,
+                                    serialization.PublicFormat.UncompressedPoint)
+    return hashlib.sha256(point).hexdigest()
+### -------------------------------------------------------------------------------
+
+
+def get_msp_files(msp_dir: str) -> tuple[str, str]:
+    """ The signing certificate of the MSP directory and its keystore key
+        (the newest key if the cryptography package is missing: a re-enroll leaves the old one behind)
+    Returns:
+        tuple[str, str]: (Path-File of signcerts/*.pem, Path-File of keystore/<SKI>_sk)
+    """
+    signcerts = os.path.join(msp_dir, 'signcerts')
+    cert_files = sorted(name for name in os.listdir(signcerts) if name.endswith('.pem'))
+    if not cert_files:
+        raise FileNotFoundError(f'No certificate in {signcerts}')
+    cert_file = os.path.join(signcerts, cert_files[0])
+    keystore = os.path.join(msp_dir, 'keystore')
+    key_files = sorted(os.listdir(keystore), key=lambda name: -os.path.getmtime(os.path.join(keystore, name)))
+    if x509 is not None:
+        with open(cert_file, 'rb') as stream:
+            ski = get_ski(x509.load_pem_x509_certificate(stream.read()).public_key())
+        key_files.sort(key=lambda name: not name.startswith(ski))
+    if not key_files:
+        raise FileNotFoundError(f'No key in {keystore}')
+    return (cert_file, os.path.join(keystore, key_files[0]))
+### -------------------------------------------------------------------------------
+
+
+def read_msp_enrollment(msp_dir: str) -> dict:
+    """ The enrollment the MSP directory holds, out of its signing certificate
+    Returns:
+        dict: id (the CN), attrs (the Fabric attributes of the certificate), serial (hex), 
+              not_after (epoch seconds), msp_dir, cert_file, key_file
+    """
+    (cert_file, key_file) = get_msp_files(msp_dir)
+    with open(cert_file, 'rb') as stream:
+        cert = x509.load_pem_x509_certificate(stream.read())
+    names = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+    try:
+        attrs = json.loads(cert.extensions.get_extension_for_oid(
+                                x509.ObjectIdentifier(ATTRS_OID)).value.value).get('attrs', {})
+    except x509.ExtensionNotFound:
+        attrs = {}
+    ### cryptography < 42 has the naive UTC datetime only
+    not_after = getattr(cert, 'not_valid_after_utc', None) or cert.not_valid_after.replace(tzinfo=timezone.utc)
+    return {'id': names[0].value if names else '',
+            'attrs': attrs,
+            'serial': format(cert.serial_number, 'x'),
+            'not_after': not_after.timestamp(),
+            'msp_dir': msp_dir,
+            'cert_file': cert_file,
+            'key_file': key_file}
+### -------------------------------------------------------------------------------
+
+
+def sign_low_s(private_key, payload: bytes) -> bytes:
+    """ DER ECDSA-SHA256 signature with the S normalized to the lower half of the curve order
+    """
+    (r, s) = decode_dss_signature(private_key.sign(payload, ec.ECDSA(hashes.SHA256())))
+    order = CURVE_ORDERS[private_key.curve.name]
+    if s > order // 2:
+        s = order - s
+    return encode_dss_signature(r, s)
+### -------------------------------------------------------------------------------
+#==================================================================================
+
+
+class FabricCaError(Exception):
+    """ The error answer of the CA, worded as fabric-ca-client does
+    """
+
+    def __init__(self, code: int, message: str) -> None:
+        super().__init__(f'Error Code: {code} - {message}')
+        self.code = code
+        self.message = message
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class CaCredentials(object):
+    """ The signing certificate and key of an MSP directory
+    """
+
+    def __init__(self, cert_pem: bytes, private_key) -> None:
+        super().__init__()
+        self.cert_pem = cert_pem
+        self.private_key = private_key
+        self.b64_cert = b64(cert_pem)
+    # -----------------------------------------------------------------------------
+
+    @classmethod
+    def from_msp(cls, msp_dir: str) -> 'CaCredentials':
+        """ Reads signcerts/*.pem and the keystore key of the certificate
+        """
+        (cert_file, key_file) = get_msp_files(msp_dir)
+        with open(cert_file, 'rb') as stream:
+            cert_pem = stream.read()
+        with open(key_file, 'rb') as stream:
+            private_key = serialization.load_pem_private_key(stream.read(), password=None)
+        return cls(cert_pem, private_key)
+    # -----------------------------------------------------------------------------
+
+    def create_token(self, method: str, uri: str, body: bytes) -> str:
+        payload = f'{method}.{b64(uri)}.{b64(body)}.{self.b64_cert}'.encode('ascii')
+        return f'{self.b64_cert}.{b64(sign_low_s(self.private_key, payload))}'
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class FabricCaClient(object):
+    """ Keep-alive REST client of one CA (one connection per thread)
+    """
+
+    def __init__(self, url: str, tls_cert: str = None, ca_name: str = '', timeout: float = 30) -> None:
+        super().__init__()
+        parts = urllib.parse.urlsplit(url if '://' in url else f'https://{url}')
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.ca_name = ca_name
+        self.timeout = timeout
+        self.ssl_context = None
+        if self.https:
+            self.ssl_context = ssl.create_default_context(cafile=tls_cert if tls_cert else None)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = 0    ### Opened so far: the keep-alive keeps it at one per thread
+    # -----------------------------------------------------------------------------
+
+    def get_connection(self) -> tuple[http.client.HTTPConnection, bool]:
+        """ Returns:
+            tuple: (connection of the thread, True if it served a request already)
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection:
+            return (connection, True)
+        if self.https:
+            connection = http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout,
+                                                     context=self.ssl_context)
+        else:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        self.local.connection = connection
+        with self.lock:
+            self.connections += 1
+        return (connection, False)
+    # -----------------------------------------------------------------------------
+
+    def close(self) -> None:
+        connection = getattr(self.local, 'connection', None)
+        self.local.connection = None
+        if connection:
+            connection.close()
+    # -----------------------------------------------------------------------------
+
+    def request(self, method: str, path: str, body: dict = None,
+                registrar: CaCredentials = None, basic_auth: tuple = None) -> dict:
+        """ Sends the request, authenticated by the registrar token or the basic auth
+        Returns:
+            dict: The 'result' of the answer
+        Raises:
+            FabricCaError: The CA answered with an error
+        """
+        payload = json.dumps(body).encode('utf-8') if body is not None else b''
+        headers = {'Content-Type': 'application/json'}
+        if registrar:
+            headers['Authorization'] = registrar.create_token(method, path, payload)
+        elif basic_auth:
+            headers['Authorization'] = f'Basic {b64(":".join(basic_auth))}'
+        while True:
+            (connection, reused) = self.get_connection()
+            try:
+                connection.request(method, path, body=payload, headers=headers)
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                    BrokenPipeError, ConnectionResetError):
+                self.close()
+                ### Only the idle keep-alive connection closed by the server is worth a fresh try
+                if not reused:
+                    raise
+        if response.getheader('Connection', '').lower() == 'close':
+            self.close()
+        answer = json.loads(data) if data else {}
+        if not answer.get('success', 200 <= response.status < 300):
+            errors = answer.get('errors') or [{'code': response.status, 'message': response.reason}]
+            raise FabricCaError(errors[0].get('code', 0), errors[0].get('message', ''))
+        return answer.get('result') or {}
+    # -----------------------------------------------------------------------------
+
+    def get_path(self, path: str) -> str:
+        return f'{path}?{urllib.parse.urlencode({"ca": self.ca_name})}' if self.ca_name else path
+    # -----------------------------------------------------------------------------
+
+    def get_identity(self, registrar: CaCredentials, identity_id: str) -> dict:
+        """ Returns:
+            dict: id, type, affiliation, attrs, max_enrollments of the identity
+        Raises:
+            FabricCaError: Code ERROR_NOT_FOUND if the identity is not registered
+        """
+        return self.request('GET', self.get_path(f'/api/v1/identities/{urllib.parse.quote(identity_id)}'),
+                            registrar=registrar)
+    # -----------------------------------------------------------------------------
+
+    def get_identities(self, registrar: CaCredentials) -> list[dict]:
+        """ Returns:
+            list[dict]: Every identity the registrar may see (one bulk call)
+        """
+        return self.request('GET', self.get_path('/api/v1/identities'), registrar=registrar).get('identities') or []
+    # -----------------------------------------------------------------------------
+
+    def modify_identity(self, registrar: CaCredentials, identity_id: str, attrs: list[dict]) -> dict:
+        """ Sets the given attributes of the identity (an empty value removes the attribute),
+            its type, affiliation, secret and the rest of its attributes stay
+        Returns:
+            dict: The identity as modified
+        """
+        body = {'attrs': attrs, 'caname': self.ca_name}
+        return self.request('PUT', self.get_path(f'/api/v1/identities/{urllib.parse.quote(identity_id)}'),
+                            body, registrar=registrar)
+    # -----------------------------------------------------------------------------
+
+    def remove_identity(self, registrar: CaCredentials, identity_id: str, force: bool = False) -> dict:
+        """ Removes the identity (the CA must allow it), its certificates are revoked
+        Returns:
+            dict: The identity as removed
+        """
+        query = {'force': 'true'} if force else {}
+        if self.ca_name:
+            query['ca'] = self.ca_name
+        path = f'/api/v1/identities/{urllib.parse.quote(identity_id)}'
+        return self.request('DELETE', f'{path}?{urllib.parse.urlencode(query)}' if query else path,
+                            registrar=registrar)
+    # -----------------------------------------------------------------------------
+
+    def register(self, registrar: CaCredentials, identity_id: str, secret: str = '',
+                 identity_type: str = 'client', affiliation: str = '',
+                 attrs: list[dict] = None, max_enrollments: int = 0) -> str:
+        """ Returns:
+            str: The enrollment secret (generated by the CA if not given)
+        """
+        body = {'id': identity_id, 'type': identity_type, 'secret': secret, 'affiliation': affiliation,
+                'attrs': attrs or [], 'max_enrollments': max_enrollments, 'caname': self.ca_name}
+        return self.request('POST', self.get_path('/api/v1/register'), body, registrar=registrar).get('secret', '')
+    # -----------------------------------------------------------------------------
+
+    def enroll(self, identity_id: str, secret: str, msp_dir: str, attr_reqs: list[dict] = None) -> str:
+        """ Enrolls the identity with a fresh P-256 key and writes its MSP directory
+            (signcerts/cert.pem, keystore/<SKI>_sk, cacerts/<host>-<port>.pem) as fabric-ca-client does
+        Returns:
+            str: Path of the enrollment certificate
+        """
+        private_key = ec.generate_private_key(ec.SECP256R1())
+        csr = (x509.CertificateSigningRequestBuilder()
+                .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, identity_id)]))
+                .sign(private_key, hashes.SHA256()))
+        body = {'certificate_request': csr.public_bytes(serialization.Encoding.PEM).decode('ascii'),
+                'caname': self.ca_name}
+        if attr_reqs:
+            body['attr_reqs'] = attr_reqs
+        result = self.request('POST', '/api/v1/enroll', body, basic_auth=(identity_id, secret))
+
+        for folder in ('signcerts', 'keystore', 'cacerts'):
+            os.makedirs(os.path.join(msp_dir, folder), exist_ok=True)
+        key_file = os.path.join(msp_dir, 'keystore', f'{get_ski(private_key.public_key())}_sk')
+        with open(os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as stream:
+            stream.write(private_key.private_bytes(serialization.Encoding.PEM,
+                                                   serialization.PrivateFormat.PKCS8,
+                                                   serialization.NoEncryption()))
+        cert_file = os.path.join(msp_dir, 'signcerts', 'cert.pem')
+        with open(cert_file, 'wb') as stream:
+            stream.write(base64.b64decode(result['Cert']))
+        ca_chain = (result.get('ServerInfo') or {}).get('CAChain')
+        if ca_chain:
+            with open(os.path.join(msp_dir, 'cacerts', f'{self.host}-{self.port}.pem'), 'wb') as stream:
+                stream.write(base64.b64decode(ca_chain))
+        return cert_file
+    # -----------------------------------------------------------------------------
+#==================================================================================
@@ -0,0 +1,439 @@
+# =================================================================================
+# Local fake Fabric-CA for the tests and the benchmarks of the REST backend (ops_fabric_ca.py):
+#   serve - HTTPS keep-alive server of the identities (list/get/modify/remove)/register/enroll endpoints,
+#           its TLS root, registrar MSP (admin/msp) and an env fragment written into --dir
+#   bench - times the identity lookups on one keep-alive session vs a new connection per call
+# The identities live in memory, the tokens and the basic auth are checked like Fabric-CA does
+import base64
+import datetime
+import http.server
+import ipaddress
+import json
+import os
+import secrets
+import ssl
+import statistics
+import threading
+import time
+import urllib.parse
+
+import click
+from cryptography import x509
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+from cryptography.x509.oid import NameOID
+
+# Local ---------------------------------------------------------------------------
+from ops_fabric_ca import CURVE_ORDERS, CaCredentials, FabricCaClient, FabricCaError, get_ski
+#==================================================================================
+
+### The extension Fabric-CA puts the certificate attributes into
+ATTRS_OID = x509.ObjectIdentifier('1.2.3.4.5.6.7.8.1')
+REGISTRAR_ID = 'admin'
+REGISTRAR_SECRET = 'adminpw'
+### -------------------------------------------------------------------------------
+
+
+def write_key(private_key, file: str) -> None:
+    with open(os.open(file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as stream:
+        stream.write(private_key.private_bytes(serialization.Encoding.PEM,
+                                               serialization.PrivateFormat.PKCS8,
+                                               serialization.NoEncryption()))
+### -------------------------------------------------------------------------------
+
+
+def write_pem(cert, file: str) -> None:
+    with open(file, 'wb') as stream:
+        stream.write(cert.public_bytes(serialization.Encoding.PEM))
+### -------------------------------------------------------------------------------
+#==================================================================================
+
+
+class FakeCa(object):
+    """ The in-memory CA: its root, the identities and the certificates it issues
+    """
+
+    def __init__(self, ca_name: str = 'fake-ca') -> None:
+        super().__init__()
+        self.ca_name = ca_name
+        self.ca_key = ec.generate_private_key(ec.SECP256R1())
+        subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, ca_name)])
+        self.ca_cert = (self.get_builder(subject, self.ca_key.public_key(), days=3650)
+                        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+                        .sign(self.ca_key, hashes.SHA256()))
+        self.identities = {}
+        self.lock = threading.Lock()
+        self.stats = {'connections': 0, 'requests': 0}
+        self.add_identity(REGISTRAR_ID, REGISTRAR_SECRET, 'admin')
+    # -----------------------------------------------------------------------------
+
+    def get_builder(self, subject: x509.Name, public_key, days: int = 365) -> x509.CertificateBuilder:
+        now = datetime.datetime.utcnow()
+        issuer = self.ca_cert.subject if hasattr(self, 'ca_cert') else subject
+        return (x509.CertificateBuilder()
+                .subject_name(subject)
+                .issuer_name(issuer)
+                .public_key(public_key)
+                .serial_number(x509.random_serial_number())
+                .not_valid_before(now - datetime.timedelta(minutes=5))
+                .not_valid_after(now + datetime.timedelta(days=days)))
+    # -----------------------------------------------------------------------------
+
+    def add_identity(self, identity_id: str, secret: str, identity_type: str = 'client',
+                     affiliation: str = '', attrs: list[dict] = None, max_enrollments: int = -1) -> dict:
+        identity = {'id': identity_id, 'type': identity_type, 'affiliation': affiliation,
+                    'max_enrollments': max_enrollments if max_enrollments else -1,
+                    'caname': self.ca_name, 'secret': secret, 'enrollments': 0,
+                    'attrs': list(attrs or []) + [
+                        {'name': 'hf.EnrollmentID', 'value': identity_id, 'ecert': True},
+                        {'name': 'hf.Type', 'value': identity_type, 'ecert': True},
+                        {'name': 'hf.Affiliation', 'value': affiliation, 'ecert': True}]}
+        with self.lock:
+            self.identities[identity_id] = identity
+        return identity
+    # -----------------------------------------------------------------------------
+
+    def issue_cert(self, identity: dict, public_key, attr_reqs: list[dict] = None) -> x509.Certificate:
+        """ The enrollment certificate: CN=<id>, OU=<type> and the requested (+ the ecert) attributes
+        """
+        values = {attr['name']: attr['value'] for attr in identity['attrs']}
+        attrs = {attr['name']: attr['value'] for attr in identity['attrs'] if attr.get('ecert')}
+        for request in attr_reqs or []:
+            if request['name'] in values:
+                attrs[request['name']] = values[request['name']]
+            elif not request.get('optional'):
+                raise FabricCaError(0, f"Identity '{identity['id']}' does not have attribute '{request['name']}'")
+        subject = x509.Name([x509.NameAttribute(NameOID.ORGANIZATIONAL_UNIT_NAME, identity['type']),
+                             x509.NameAttribute(NameOID.COMMON_NAME, identity['id'])])
+        return (self.get_builder(subject, public_key)
+                .add_extension(x509.UnrecognizedExtension(ATTRS_OID, json.dumps({'attrs': attrs}).encode()),
+                               critical=False)
+                .sign(self.ca_key, hashes.SHA256()))
+    # -----------------------------------------------------------------------------
+
+    def write_msp(self, identity_id: str, msp_dir: str) -> None:
+        """ Enrolls the identity straight into the MSP directory (the registrar bootstrap)
+        """
+        private_key = ec.generate_private_key(ec.SECP256R1())
+        for folder in ('signcerts', 'keystore', 'cacerts'):
+            os.makedirs(os.path.join(msp_dir, folder), exist_ok=True)
+        write_key(private_key, os.path.join(msp_dir, 'keystore', f'{get_ski(private_key.public_key())}_sk'))
+        write_pem(self.issue_cert(self.identities[identity_id], private_key.public_key()),
+                  os.path.join(msp_dir, 'signcerts', 'cert.pem'))
+        write_pem(self.ca_cert, os.path.join(msp_dir, 'cacerts', 'ca.pem'))
+    # -----------------------------------------------------------------------------
+
+    def write_tls(self, directory: str, host: str = 'localhost') -> tuple[str, str, str]:
+        """ Returns:
+            tuple[str, str, str]: (TLS root PEM, server cert PEM, server key PEM)
+        """
+        private_key = ec.generate_private_key(ec.SECP256R1())
+        names = [x509.DNSName(host), x509.DNSName('localhost'), x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]
+        cert = (self.get_builder(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, host)]), private_key.public_key())
+                .add_extension(x509.SubjectAlternativeName(names), critical=False)
+                .sign(self.ca_key, hashes.SHA256()))
+        files = tuple(os.path.join(directory, name)
+                      for name in ('tls-ca-cert.pem', 'tls-server-cert.pem', 'tls-server-key.pem'))
+        write_pem(self.ca_cert, files[0])
+        write_pem(cert, files[1])
+        write_key(private_key, files[2])
+        return files
+    # -----------------------------------------------------------------------------
+
+    def authenticate_token(self, method: str, uri: str, body: bytes, token: str) -> dict:
+        """ Checks the registrar token: a certificate of this CA, the low-S signature of the request
+        Returns:
+            dict: The registrar identity
+        """
+        try:
+            (b64_cert, b64_sig) = token.split('.')
+            cert = x509.load_pem_x509_certificate(base64.b64decode(b64_cert))
+            self.ca_key.public_key().verify(cert.signature, cert.tbs_certificate_bytes,
+                                            ec.ECDSA(cert.signature_hash_algorithm))
+            signature = base64.b64decode(b64_sig)
+            if decode_dss_signature(signature)[1] > CURVE_ORDERS['secp256r1'] // 2:
+                raise ValueError('high-S signature')
+            payload = f'{method}.{base64.b64encode(uri.encode()).decode()}.{base64.b64encode(body).decode()}.{b64_cert}'
+            cert.public_key().verify(signature, payload.encode(), ec.ECDSA(hashes.SHA256()))
+            registrar_id = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value
+        except (ValueError, IndexError, InvalidSignature) as ex:
+            raise FabricCaError(20, f'Authentication failure: {ex or type(ex).__name__}')
+        if registrar_id not in self.identities:
+            raise FabricCaError(20, 'Authentication failure')
+        return self.identities[registrar_id]
+    # -----------------------------------------------------------------------------
+
+    def authenticate_basic(self, authorization: str) -> dict:
+        (scheme, _, credentials) = authorization.partition(' ')
+        (identity_id, _, secret) = base64.b64decode(credentials).decode().partition(':') \
+            if scheme == 'Basic' else ('', '', '')
+        identity = self.identities.get(identity_id)
+        if not identity or not secrets.compare_digest(identity['secret'], secret):
+            raise FabricCaError(20, 'Authentication failure')
+        return identity
+    # -----------------------------------------------------------------------------
+
+    def get_identity(self, identity_id: str) -> dict:
+        identity = self.identities.get(identity_id)
+        if not identity:
+            raise FabricCaError(63, 'Failed to get User: sql: no rows in result set')
+        return {k: v for (k, v) in identity.items() if k not in ('secret', 'enrollments')}
+    # -----------------------------------------------------------------------------
+
+    def get_identities(self) -> dict:
+        with self.lock:
+            identity_ids = list(self.identities)
+        return {'identities': [self.get_identity(identity_id) for identity_id in identity_ids],
+                'caname': self.ca_name}
+    # -----------------------------------------------------------------------------
+
+    def modify_identity(self, identity_id: str, request: dict) -> dict:
+        with self.lock:
+            identity = self.identities.get(identity_id)
+            if not identity:
+                raise FabricCaError(63, 'Failed to get User: sql: no rows in result set')
+            ### Fabric-CA merges the attributes: an empty value removes the attribute
+            attrs = {attr['name']: attr for attr in identity['attrs']}
+            for attr in request.get('attrs') or []:
+                if attr.get('value'):
+                    attrs[attr['name']] = {'name': attr['name'], 'value': attr['value'],
+                                           'ecert': bool(attr.get('ecert', False))}
+                else:
+                    attrs.pop(attr['name'], None)
+            identity['attrs'] = list(attrs.values())
+        return self.get_identity(identity_id)
+    # -----------------------------------------------------------------------------
+
+    def remove_identity(self, identity_id: str) -> dict:
+        identity = self.get_identity(identity_id)
+        with self.lock:
+            self.identities.pop(identity_id, None)
+        return identity
+    # -----------------------------------------------------------------------------
+
+    def register(self, request: dict) -> dict:
+        identity_id = request.get('id', '')
+        if not identity_id:
+            raise FabricCaError(0, 'Registration of an identity without id')
+        if identity_id in self.identities:
+            raise FabricCaError(74, f"Identity '{identity_id}' is already registered")
+        secret = request.get('secret') or secrets.token_urlsafe(9)
+        self.add_identity(identity_id, secret, request.get('type') or 'client', request.get('affiliation', ''),
+                          request.get('attrs'), request.get('max_enrollments', 0))
+        return {'secret': secret}
+    # -----------------------------------------------------------------------------
+
+    def enroll(self, identity: dict, request: dict) -> dict:
+        with self.lock:
+            if identity['max_enrollments'] > 0 and identity['enrollments'] >= identity['max_enrollments']:
+                raise FabricCaError(71, f"The identity '{identity['id']}' has already enrolled "
+                                        f"{identity['enrollments']} times, it has reached its maximum enrollment allowance")
+            identity['enrollments'] += 1
+        csr = x509.load_pem_x509_csr(request['certificate_request'].encode())
+        cert = self.issue_cert(identity, csr.public_key(), request.get('attr_reqs'))
+        return {'Cert': base64.b64encode(cert.public_bytes(serialization.Encoding.PEM)).decode(),
+                'ServerInfo': {'CAName': self.ca_name, 'Version': 'fake',
+                               'CAChain': base64.b64encode(
+                                    self.ca_cert.public_bytes(serialization.Encoding.PEM)).decode()}}
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class FakeCaHandler(http.server.BaseHTTPRequestHandler):
+    """ The Fabric-CA endpoints on HTTP/1.1 keep-alive connections
+    """
+    protocol_version = 'HTTP/1.1'
+    timeout = 30
+    ### The headers and the body go out in two writes: no 40ms delayed-ACK stall between them
+    disable_nagle_algorithm = True
+
+    def setup(self) -> None:
+        super().setup()
+        with self.server.ca.lock:
+            self.server.ca.stats['connections'] += 1
+    # -----------------------------------------------------------------------------
+
+    def log_message(self, format: str, *args) -> None:
+        if self.server.verbose:
+            super().log_message(format, *args)
+    # -----------------------------------------------------------------------------
+
+    def send_answer(self, status: int, answer: dict) -> None:
+        data = json.dumps(answer).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+    # -----------------------------------------------------------------------------
+
+    def handle_request(self, method: str) -> None:
+        ca = self.server.ca
+        with ca.lock:
+            ca.stats['requests'] += 1
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = urllib.parse.urlsplit(self.path).path
+        try:
+            authorization = self.headers.get('Authorization', '')
+            if method == 'POST' and path == '/api/v1/enroll':
+                result = ca.enroll(ca.authenticate_basic(authorization), json.loads(body))
+            else:
+                ca.authenticate_token(method, self.path, body, authorization)
+                if method == 'GET' and path == '/api/v1/identities':
+                    result = ca.get_identities()
+                elif method == 'GET' and path.startswith('/api/v1/identities/'):
+                    result = ca.get_identity(urllib.parse.unquote(path[len('/api/v1/identities/'):]))
+                elif method == 'PUT' and path.startswith('/api/v1/identities/'):
+                    result = ca.modify_identity(urllib.parse.unquote(path[len('/api/v1/identities/'):]),
+                                                json.loads(body))
+                elif method == 'DELETE' and path.startswith('/api/v1/identities/'):
+                    result = ca.remove_identity(urllib.parse.unquote(path[len('/api/v1/identities/'):]))
+                elif method == 'POST' and path == '/api/v1/register':
+                    result = ca.register(json.loads(body))
+                else:
+                    self.send_answer(404, {'success': False, 'result': None,
+                                           'errors': [{'code': 404, 'message': f'No such endpoint: {path}'}]})
+                    return
+        except FabricCaError as ex:
+            status = 401 if ex.code == 20 else (404 if ex.code == 63 else 400)
+            self.send_answer(status, {'success': False, 'result': None,
+                                      'errors': [{'code': ex.code, 'message': ex.message}], 'messages': []})
+            return
+        except (ValueError, KeyError) as ex:
+            self.send_answer(400, {'success': False, 'result': None,
+                                   'errors': [{'code': 0, 'message': f'Bad request: {ex}'}], 'messages': []})
+            return
+        self.send_answer(200, {'success': True, 'result': result, 'errors': [], 'messages': []})
+    # -----------------------------------------------------------------------------
+
+    def do_GET(self) -> None:
+        self.handle_request('GET')
+    # -----------------------------------------------------------------------------
+
+    def do_POST(self) -> None:
+        self.handle_request('POST')
+    # -----------------------------------------------------------------------------
+
+    def do_PUT(self) -> None:
+        self.handle_request('PUT')
+    # -----------------------------------------------------------------------------
+
+    def do_DELETE(self) -> None:
+        self.handle_request('DELETE')
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class FakeCaServer(http.server.ThreadingHTTPServer):
+    """ HTTPS server of the FakeCa, writes its TLS root and registrar MSP into the directory
+    """
+    daemon_threads = True
+
+    def __init__(self, directory: str, host: str = '127.0.0.1', port: int = 0, verbose: bool = False) -> None:
+        super().__init__((host, port), FakeCaHandler)
+        os.makedirs(directory, exist_ok=True)
+        self.ca = FakeCa()
+        self.verbose = verbose
+        (self.tls_cert, server_cert, server_key) = self.ca.write_tls(directory)
+        self.msp_dir = os.path.join(directory, REGISTRAR_ID, 'msp')
+        self.ca.write_msp(REGISTRAR_ID, self.msp_dir)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(server_cert, server_key)
+        ### The handshake runs in the connection thread, not in the accepting one
+        self.socket = context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+        self.url = f'https://localhost:{self.server_address[1]}'
+    # -----------------------------------------------------------------------------
+
+    def start(self) -> 'FakeCaServer':
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+    # -----------------------------------------------------------------------------
+
+    def get_env_yaml(self) -> str:
+        """ The env/bat + env/amb lines pointing the REST backend at this server
+        """
+        return (f'env:\n'
+                f'  bat:\n'
+                f'    ca-backend: fabric-ca-rest\n'
+                f'  amb:\n'
+                f'    ca-url: {self.url}\n'
+                f'    enroll-url: "@localhost:{self.server_address[1]}"\n'
+                f'    msp-dir: {self.msp_dir}\n'
+                f'    tls-cert: {self.tls_cert}\n')
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+@click.command(help="serve: Runs the fake Fabric-CA until interrupted")
+@click.option('--dir', '-d', 'directory', required=True,
+                help="Directory of the TLS root, the registrar MSP and env-fake-ca.yaml")
+@click.option('--port', '-p', default=7054, show_default=True,
+                help="Port to listen on (0 - any free one)")
+@click.option('--verbose', '-v', is_flag=True, default=False,
+                help="Logs every request")
+def serve(directory: str, port: int, verbose: bool) -> None:
+    server = FakeCaServer(directory, port=port, verbose=verbose)
+    env_file = os.path.join(directory, 'env-fake-ca.yaml')
+    with open(env_file, 'w') as stream:
+        stream.write(server.get_env_yaml())
+    print(f'Fake Fabric-CA at {server.url} (registrar {REGISTRAR_ID}/{REGISTRAR_SECRET}), env: {env_file}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+# -----------------------------------------------------------------------------
+
+
+@click.command(help="bench: Times the identity lookups, keep-alive session vs new connection per call")
+@click.option('--dir', '-d', 'directory', required=True,
+                help="Work directory of the in-process fake Fabric-CA")
+@click.option('--calls', '-n', default=200, show_default=True,
+                help="Lookups per mode")
+def bench(directory: str, calls: int) -> None:
+    server = FakeCaServer(directory).start()
+    registrar = CaCredentials.from_msp(server.msp_dir)
+    FabricCaClient(server.url, server.tls_cert).register(registrar, 'bench-user', 'bench-pw')
+
+    def run(keep_alive: bool) -> list[float]:
+        samples = []
+        client = FabricCaClient(server.url, server.tls_cert)
+        for _ in range(calls):
+            started = time.perf_counter()
+            client.get_identity(registrar, 'bench-user')
+            if not keep_alive:
+                ### The next call pays the TCP connect + the TLS handshake again
+                client.close()
+            samples.append((time.perf_counter() - started) * 1000)
+        client.close()
+        return samples
+
+    print(f"{'MODE':<18} {'CALLS':>6} {'CONNS':>6} {'TOTAL ms':>10} {'MEAN ms':>8} {'P50 ms':>8} {'MAX ms':>8}")
+    for (mode, keep_alive) in (('keep-alive', True), ('connect-per-call', False)):
+        connections = server.ca.stats['connections']
+        samples = run(keep_alive)
+        print(f'{mode:<18} {calls:>6} {server.ca.stats["connections"] - connections:>6} {sum(samples):>10.1f} '
+              f'{statistics.mean(samples):>8.2f} {statistics.median(samples):>8.2f} {max(samples):>8.2f}')
+    server.shutdown()
+    server.server_close()
+# -----------------------------------------------------------------------------
+
+
+@click.group(   invoke_without_command=False,
+                help='BloSS🌻M fake Fabric-CA for the tests and benchmarks'
+            )
+@click.pass_context
+def cli_entries(ctx):
+    if ctx.invoked_subcommand is None:
+        click.echo(ctx.get_help())
+# -----------------------------------------------------------------------------
+
+cli_entries.add_command(serve)
+cli_entries.add_command(bench)
+#==================================================================================
+
+if __name__ == "__main__":
+    cli_entries()
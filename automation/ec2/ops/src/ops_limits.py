@@ -0,0 +1,221 @@
+# =================================================================================
+# Client-side limits of the throttling services (Cognito admin APIs, AMB Fabric-CA, SSM):
+#   TokenBucket     - the steady rate + the burst of the calls
+#   CircuitBreaker  - pauses the service that keeps failing instead of hammering it
+#   ServiceGuard    - both of the above + the jittered retry of the throttled calls
+# Configured per service in the env YAML (env/limits/<service>), no limits otherwise
+import random
+import threading
+import time
+
+# Local ---------------------------------------------------------------------------
+from ops_yaml import EnvConfig, InfoBoard
+#==================================================================================
+
+### CommandEC2 family -> the service its commands call
+FAMILY_SERVICES = {
+    'IDP': 'cognito',
+    'AMB': 'fabric-ca',
+    'SSM': 'ssm',
+}
+### The errors worth a retry: throttling and the transient network failures
+RETRY_MARKERS = {
+    'cognito': ('TooManyRequestsException', 'ThrottlingException', 'Rate exceeded',
+                'RequestLimitExceeded', 'ServiceUnavailable', 'Could not connect to the endpoint URL'),
+    'fabric-ca': ('Too Many Requests', 'TooManyRequests', 'connection reset by peer', 'connection refused',
+                  'i/o timeout', 'timed out', 'TLS handshake timeout', 'Service Unavailable'),
+    'ssm': ('ThrottlingException', 'TooManyUpdates', 'Rate exceeded', 'ServiceUnavailable',
+            'Could not connect to the endpoint URL'),
+}
+### The command did not run at all: the circuit of its service is open
+CIRCUIT_OPEN_CODE = '-104'
+### -------------------------------------------------------------------------------
+
+
+class TokenBucket(object):
+    """ Thread-safe token bucket: 'rate' calls per second, up to 'burst' at once
+    """
+
+    def __init__(self, rate: float, burst: int, clock: callable = time.monotonic, sleep: callable = time.sleep) -> None:
+        super().__init__()
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(self.burst)
+        self.updated_at = clock()
+        self.lock = threading.Lock()
+    # -----------------------------------------------------------------------------
+
+    def acquire(self) -> float:
+        """ Takes a token, waiting for it if the bucket is empty
+        Returns:
+            float: Seconds waited
+        """
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            ### Reserve the token now, the callers queue up behind the negative balance
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class CircuitBreaker(object):
+    """ Opens after 'failures' consecutive failures, lets one trial call through after 'reset' seconds
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failures: int, reset: float, clock: callable = time.monotonic) -> None:
+        super().__init__()
+        self.failures = max(1, int(failures))
+        self.reset = float(reset)
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failed = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+    # -----------------------------------------------------------------------------
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == self.OPEN and self.clock() - self.opened_at >= self.reset:
+                ### The trial call: its outcome closes or re-opens the circuit
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+    # -----------------------------------------------------------------------------
+
+    def get_retry_in(self) -> float:
+        return max(0.0, self.opened_at + self.reset - self.clock())
+    # -----------------------------------------------------------------------------
+
+    def record(self, succeeded: bool) -> None:
+        with self.lock:
+            if succeeded:
+                (self.state, self.failed) = (self.CLOSED, 0)
+                return
+            self.failed += 1
+            if self.state == self.HALF_OPEN or self.failed >= self.failures:
+                (self.state, self.opened_at) = (self.OPEN, self.clock())
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class ServiceGuard(object):
+    """ Rate limit, jittered retry of the throttled calls and circuit breaker of one service
+    """
+
+    def __init__(   self,
+                    name: str,
+                    rate: float = 10,
+                    burst: int = 10,
+                    retries: int = 3,
+                    backoff_ms: float = 200,
+                    backoff_max_ms: float = 5000,
+                    breaker_failures: int = 5,
+                    breaker_reset: float = 30,
+                    markers: tuple = (),
+                    sleep: callable = time.sleep,
+                ) -> None:
+        super().__init__()
+        self.name = name
+        self.bucket = TokenBucket(rate, burst, sleep=sleep)
+        self.breaker = CircuitBreaker(breaker_failures, breaker_reset)
+        self.retries = max(0, int(retries))
+        self.backoff_ms = float(backoff_ms)
+        self.backoff_max_ms = float(backoff_max_ms)
+        self.markers = tuple(markers)
+        self.sleep = sleep
+    # -----------------------------------------------------------------------------
+
+    @classmethod
+    def from_config(cls, name: str, config: dict, **kwargs) -> 'ServiceGuard':
+        """ Args:
+            config (dict): env/limits/<service> - rate, burst, retries, backoff-ms, backoff-max-ms,
+                           breaker-failures, breaker-reset (the missing ones default)
+        """
+        names = {'rate': 'rate', 'burst': 'burst', 'retries': 'retries',
+                 'backoff-ms': 'backoff_ms', 'backoff-max-ms': 'backoff_max_ms',
+                 'breaker-failures': 'breaker_failures', 'breaker-reset': 'breaker_reset'}
+        params = {names[key]: float(value) for (key, value) in (config or {}).items() if key in names}
+        return cls(name, markers=RETRY_MARKERS.get(name, ()), **params, **kwargs)
+    # -----------------------------------------------------------------------------
+
+    def is_retryable(self, result: tuple) -> bool:
+        """ Args:
+            result (tuple): (stdOut, stdErr, OS-ReturnCode, ...)
+        """
+        (out, err, code) = result[:3]
+        if code == 0:
+            return False
+        text = f'{err or ""}\n{out or ""}'.lower()
+        return any(marker.lower() in text for marker in self.markers)
+    # -----------------------------------------------------------------------------
+
+    def get_backoff(self, attempt: int) -> float:
+        ### Full jitter: the retrying callers spread out instead of retrying in lockstep
+        return random.uniform(0, min(self.backoff_max_ms, self.backoff_ms * (2 ** attempt))) / 1000
+    # -----------------------------------------------------------------------------
+
+    def call(self, run: callable) -> tuple:
+        """ Runs the call within the limits of the service
+        Args:
+            run (callable): The call returning (stdOut, stdErr, OS-ReturnCode, ...)
+        Returns:
+            tuple: The result of the last attempt, 
+                   ('', error, CIRCUIT_OPEN_CODE, None) if the service is paused (no resource usage either)
+        """
+        if not self.breaker.allow():
+            return ('', (f'Circuit open: {self.name} is paused for {self.breaker.get_retry_in():.1f}s '
+                           f'after {self.breaker.failed} failed call(s)'), CIRCUIT_OPEN_CODE, None)
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            try:
+                result = run()
+            except Exception:
+                self.breaker.record(False)
+                raise
+            if not self.is_retryable(result):
+                ### Answered (even "not found" is an answer): the service is fine
+                self.breaker.record(True)
+                return result
+            if attempt < self.retries:
+                self.sleep(self.get_backoff(attempt))
+        InfoBoard.pin_warning(f'{self.name}: still throttled/failing after {self.retries + 1} attempt(s)')
+        self.breaker.record(False)
+        return result
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+_GUARDS = {}
+
+
+def get_guard(family: str) -> ServiceGuard:
+    """ The guard of the service the CommandEC2 family calls, None if not limited
+    """
+    return _GUARDS.get(FAMILY_SERVICES.get(family))
+### -------------------------------------------------------------------------------
+
+
+def set_guards(guards: dict) -> None:
+    _GUARDS.clear()
+    _GUARDS.update(guards or {})
+### -------------------------------------------------------------------------------
+
+
+def make_guards(envInfo: EnvConfig) -> dict:
+    """ Builds the guards of the services configured in env/limits
+    Returns:
+        dict: service -> ServiceGuard
+    """
+    return {service: ServiceGuard.from_config(service, envInfo.get_limits(service))
+            for service in FAMILY_SERVICES.values() if envInfo.get_limits(service)}
+### -------------------------------------------------------------------------------
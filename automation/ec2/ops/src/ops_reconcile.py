@@ -0,0 +1,412 @@
+# =================================================================================
+# Reconciles the BloSS🌻M users across Cognito, the Fabric-CA and the SSP parties.
+# Cognito is the roster: the party UUID is the Cognito 'sub', the Fabric-CA id its username
+#   ADD_PARTY    - the user has a role and no party in the SSP
+#   UPDATE_PARTY - the party name, email or job-title differs (removed and inserted anew)
+#   REMOVE_PARTY - the managed party (inserted by the automation) of no user with a role
+#   CREATE_CA    - the user of a Fabric role is not registered (register + enroll)
+#   UPDATE_CA    - the blossom.role of the identity differs (modify + re-enroll)
+#   REMOVE_CA    - the identity carries a blossom.role, its user is gone or of no Fabric role
+# The removals are planned always, executed with --prune only.
+# The three lists load at once (in the print-only mode too), the CA work runs as one
+# concurrent batch and ALL the SSP changes go into one transform and one commit
+import asyncio
+import json
+import os
+import xml.etree.ElementTree as ET
+
+# Spec+PIP ------------------------------------------------------------------------
+import click
+
+# Local ---------------------------------------------------------------------------
+from ops_common import (
+    BatchRunner,
+    CaIdentityIndex,
+    CommandEC2,
+    CommandRunner,
+    RepoOperations,
+    SsmPublisher,
+    UserOperations,
+    init_runners,
+    write_party_fragment_file,
+    write_party_remove_file,
+)
+from ops_fabric_ca import parse_ca_identities
+from ops_yaml import APP, AuthRoles, EnvConfig, InfoBoard, RequestConfig, UserConfig
+#==================================================================================
+
+ADD_PARTY = 'ADD_PARTY'
+UPDATE_PARTY = 'UPDATE_PARTY'
+REMOVE_PARTY = 'REMOVE_PARTY'
+CREATE_CA = 'CREATE_CA'
+UPDATE_CA = 'UPDATE_CA'
+REMOVE_CA = 'REMOVE_CA'
+REMOVALS = (REMOVE_PARTY, REMOVE_CA)
+### The party props the automation writes (get_create_party_xml): its parties are the managed ones
+MANAGED_NS = 'https://github.com/marketplace/actions/upload-s3'
+### -------------------------------------------------------------------------------
+
+
+def get_local_name(tag: str) -> str:
+    return tag.rsplit('}', 1)[-1]
+### -------------------------------------------------------------------------------
+
+
+def parse_cognito_users(text: str) -> dict:
+    """ Parses the 'aws cognito-idp list-users' output
+    Returns:
+        dict: username -> {sub, email, name, role, enabled}, the role name out of the 'profile' (AuthRoles value)
+    """
+    users = {}
+    for user in (json.loads(text) if text and text.strip() else {}).get('Users', []):
+        attributes = {attr['Name']: attr.get('Value', '') for attr in user.get('Attributes', [])}
+        try:
+            role = AuthRoles(int(attributes.get('profile') or 0))
+        except ValueError:
+            role = AuthRoles.No_Role_Assigned
+        users[user['Username']] = {
+            'sub': attributes.get('sub', ''),
+            'email': attributes.get('email', ''),
+            'name': attributes.get('name', ''),
+            'role': '' if role == AuthRoles.No_Role_Assigned else role.name.replace('_', ' '),
+            'enabled': user.get('Enabled', True),
+        }
+    return users
+### -------------------------------------------------------------------------------
+
+
+def parse_ssp_parties(ssp_file: str) -> dict:
+    """ Reads the parties of the SSP (any OSCAL namespace)
+    Returns:
+        dict: party-uuid -> {name, short_name, email, role (job-title), managed}
+    """
+    parties = {}
+    for element in ET.parse(ssp_file).getroot().iter():
+        if get_local_name(element.tag) != 'party' or not element.get('uuid'):
+            continue
+        party = {'name': '', 'short_name': '', 'email': '', 'role': '', 'managed': False}
+        for child in element:
+            name = get_local_name(child.tag)
+            if name in ('name', 'short-name', 'email-address'):
+                party[{'name': 'name', 'short-name': 'short_name', 'email-address': 'email'}[name]] = (
+                    (child.text or '').strip())
+            elif name == 'prop' and child.get('name') == 'job-title':
+                party['role'] = child.get('value', '')
+            elif name == 'prop' and child.get('ns') == MANAGED_NS:
+                party['managed'] = True
+        parties[element.get('uuid')] = party
+    return parties
+### -------------------------------------------------------------------------------
+
+
+def get_ca_role(identity: dict) -> str:
+    return next((attr['value'] for attr in (identity or {}).get('attrs', [])
+                 if attr['name'] == CaIdentityIndex.ROLE_ATTR), '')
+### -------------------------------------------------------------------------------
+
+
+def plan_actions(users: dict, parties: dict, identities: dict) -> list[dict]:
+    """ The minimal actions making the SSP parties and the Fabric-CA identities follow Cognito
+    Args:
+        users (dict): parse_cognito_users
+        parties (dict): parse_ssp_parties
+        identities (dict): parse_ca_identities
+    Returns:
+        list[dict]: {kind, user, uuid, role, detail} - the users in name order, the removals last
+    """
+    actions = []
+    def plan(kind: str, user: str, uuid: str = '', role: str = '', detail: str = '') -> None:
+        actions.append({'kind': kind, 'user': user, 'uuid': uuid, 'role': role, 'detail': detail})
+
+    for (username, user) in sorted(users.items()):
+        ### A disabled user keeps no access: as if of no role
+        role = user['role'] if user['enabled'] else ''
+        party = parties.get(user['sub'])
+        if role and not party:
+            plan(ADD_PARTY, username, user['sub'], role)
+        elif role:
+            changes = [f'{field}: {party[field]!r} -> {user[field]!r}' for field in ('name', 'email', 'role')
+                       if party[field] != user[field]]
+            if changes:
+                plan(UPDATE_PARTY, username, user['sub'], role, ', '.join(changes))
+        elif party and party['managed']:
+            plan(REMOVE_PARTY, username, user['sub'], party['role'], 'no role in Cognito')
+
+        fabric_role = role if AuthRoles.is_fabric_role(role) else ''
+        ca_role = get_ca_role(identities.get(username))
+        if fabric_role and username not in identities:
+            plan(CREATE_CA, username, role=fabric_role)
+        elif fabric_role and ca_role != fabric_role:
+            plan(UPDATE_CA, username, role=fabric_role, detail=f'blossom.role: {ca_role!r} -> {fabric_role!r}')
+        elif not fabric_role and ca_role:
+            plan(REMOVE_CA, username, role=ca_role, detail=f'no Fabric role in Cognito ({role or "none"})')
+
+    subs = {user['sub'] for user in users.values()}
+    for (uuid, party) in sorted(parties.items(), key=lambda item: item[1]['name']):
+        if party['managed'] and uuid not in subs:
+            plan(REMOVE_PARTY, party['short_name'] or party['name'], uuid, party['role'], 'not in Cognito')
+    for (identity_id, identity) in sorted(identities.items()):
+        if identity_id not in users and get_ca_role(identity):
+            plan(REMOVE_CA, identity_id, role=get_ca_role(identity), detail='not in Cognito')
+    return actions
+### -------------------------------------------------------------------------------
+#==================================================================================
+
+
+class Reconciler(BatchRunner):
+    """ Loads the three lists, runs the planned CA work as one batch and updates the SSP once
+        (the commands of the per-user UserOperations run on this runner: backends, limits and memo apply)
+    """
+
+    def __init__(self, reqInfo: RequestConfig, envInfo: EnvConfig) -> None:
+        super().__init__()
+        self.userReq = reqInfo
+        self.envInfo = envInfo
+        self.repo_ops = RepoOperations(reqInfo, envInfo)
+        self.user_ops = {}      ### (username, role) -> UserOperations of the planned work
+        self.commands = self.init_commands()
+    # -----------------------------------------------------------------------------
+
+    def init_commands(self, ) -> dict:
+        commands = dict()
+        commands[CommandEC2.IDP_LIST_USERS] = [
+                'aws', 'cognito-idp', 'list-users',
+                '--user-pool-id', f'{self.envInfo.get_aws_idp_pool()}',
+                '--output', 'json', ]
+        commands[CommandEC2.AMB_LIST_USERS] = [
+                'fabric-ca-client', 'identity', 'list',
+                '--tls.certfiles', self.envInfo.get_amb_tls_cert()]
+        return commands
+    # -----------------------------------------------------------------------------
+
+    def load(self, ) -> tuple[dict, dict, dict]:
+        """ Cognito list, Fabric-CA list and the fresh clone at once - read-only,
+            so in the print-only mode too
+        Returns:
+            tuple[dict, dict, dict]: (users, parties, identities), None if a list failed
+        """
+        git_ids = [command_id for command_id in self.repo_ops.get_init_git_repo_commands()
+                   if command_id != CommandEC2.DEB_PRINT_ENV]
+        commands = dict(self.commands)
+        commands.update({command_id: self.adopt(command_id, self.repo_ops.commands[command_id])
+                         for command_id in git_ids})
+        outcomes = asyncio.run(self.run_graph_async(
+                        commands, self.repo_ops.get_init_git_repo_dependencies(), self.get_max_parallel()))
+        failed = [f'{key}: {err}' for (key, (out, err, code, _)) in outcomes.items() if code != 0]
+        if failed:
+            InfoBoard.pin_error('Reconcile could not load:\n\t' + '\n\t'.join(failed))
+            return None
+        identities = parse_ca_identities(outcomes[CommandEC2.AMB_LIST_USERS][0])
+        if not identities:
+            ### Even an empty CA lists its registrar: nothing parsed is a failure, not an empty CA
+            InfoBoard.pin_error('Reconcile could not parse the Fabric-CA identity list')
+            return None
+        ssp_file = os.path.join(self.envInfo.get_git_repo_dir(), self.envInfo.get_ssp_xml())
+        return (parse_cognito_users(outcomes[CommandEC2.IDP_LIST_USERS][0]),
+                parse_ssp_parties(ssp_file),
+                identities)
+    # -----------------------------------------------------------------------------
+
+    def get_user_ops(self, action: dict, user: dict = None) -> UserOperations:
+        ### Keyed on the role too: the identity removed may carry another role than the party inserted
+        (username, role) = (action['user'], action['role'])
+        if (username, role) not in self.user_ops:
+            user = user or {}
+            userInfo = UserConfig({'command': 'reconcile', 'user': {
+                                    'username': username,
+                                    'name': user.get('name') or username,
+                                    'email-address': user.get('email', ''),
+                                    'role': role, }})
+            self.user_ops[(username, role)] = UserOperations(self.userReq, userInfo, self.envInfo)
+        return self.user_ops[(username, role)]
+    # -----------------------------------------------------------------------------
+
+    def get_ca_batch(self, actions: list[dict], users: dict) -> tuple[dict, dict]:
+        """ Returns:
+            tuple[dict, dict]: ('<user>/<COMMAND>' -> command, '<user>/<COMMAND>' -> keys to succeed first)
+        """
+        steps = {
+            CREATE_CA: [CommandEC2.AMB_REGISTER_USER, CommandEC2.AMB_ENROLL_USER],
+            ### The enrollment certificate carries the role: a fresh one
+            UPDATE_CA: [CommandEC2.AMB_UPDATE_USER, CommandEC2.AMB_ENROLL_USER],
+            REMOVE_CA: [CommandEC2.AMB_REMOVE_USER],
+        }
+        (batch, depends) = ({}, {})
+        for action in actions:
+            if action['kind'] not in steps:
+                continue
+            user_ops = self.get_user_ops(action, users.get(action['user']))
+            keys = []
+            for command_id in steps[action['kind']]:
+                key = f"{action['user']}/{command_id.cmd_key()}"
+                batch[key] = self.adopt(command_id, user_ops.commands[command_id])
+                keys.append(key)
+            ### One chain per user, the users side by side
+            depends.update({later: [earlier] for (earlier, later) in zip(keys, keys[1:])})
+            action['keys'] = keys
+        return (batch, depends)
+    # -----------------------------------------------------------------------------
+
+    def publish_ssm(self, actions: list[dict], users: dict) -> bool:
+        """ Publishes the enrollment material of the identities enrolled (anew), the user locks held
+        Returns:
+            bool: False if the SSM puts of a user failed
+        """
+        ssm = SsmPublisher(self.envInfo)
+        enrolled = {action['user']: action for action in actions if action['kind'] in (CREATE_CA, UPDATE_CA)
+                    and (action['status'] == 'done' or APP.CMD_ONLY_PRINT)}
+        for action in enrolled.values():
+            ssm.add(self.get_user_ops(action, users.get(action['user'])))
+        failed = {user: error for (user, error) in ssm.publish().items() if error}
+        for (user, error) in failed.items():
+            enrolled[user]['status'] = 'failed'
+            InfoBoard.pin_error(f'SSM entries of {user} failed: {error}')
+        return not failed
+    # -----------------------------------------------------------------------------
+
+    def update_ssp(self, actions: list[dict], users: dict) -> bool:
+        """ ONE remove + insert transform and ONE commit of all the party changes
+        Returns:
+            bool: False if the SSP update failed
+        """
+        party_xmls = [self.get_user_ops(action, users.get(action['user'])).get_create_party_xml(action['uuid'])
+                      for action in actions if action['kind'] in (ADD_PARTY, UPDATE_PARTY)]
+        removed = [action['uuid'] for action in actions if action['kind'] in (UPDATE_PARTY, REMOVE_PARTY)]
+        if not (party_xmls or removed):
+            return True
+        if party_xmls:
+            write_party_fragment_file(party_xmls, self.repo_ops.party_file)
+        if removed:
+            write_party_remove_file(removed, self.repo_ops.remove_file)
+        InfoBoard.pin_info(f'Parties to insert into SSP: {len(party_xmls)}, to remove: {len(removed)}\n\t'
+                           f'{self.repo_ops.party_file}\n\t{self.repo_ops.remove_file}')
+        finish_ids = self.repo_ops.get_finish_git_repo_commands(bool(removed), bool(party_xmls))
+        if APP.CMD_ONLY_PRINT or not self.envInfo.get_bat_publish():
+            self.repo_ops.print_commands_by_ids(finish_ids)
+            return True
+        outcome = self.repo_ops.execute_batch_by_ids(
+                        finish_ids, self.repo_ops.get_finish_git_repo_dependencies(bool(removed), bool(party_xmls)))
+        failed_steps = ([str(key) for (key, (out, err, code, text)) in outcome[0].items() if code != 0]
+                        if outcome else ['all'])
+        if failed_steps:
+            InfoBoard.pin_error(f'SSP update of the reconcile failed at: {", ".join(failed_steps)}')
+            return False
+        return True
+    # -----------------------------------------------------------------------------
+
+    def reconcile(self, prune: bool = False) -> bool:
+        """ Plans and applies the actions, the SSP of the branch locked: it stays as loaded until the commit
+        Args:
+            prune (bool, optional): Executes the removals too. Defaults to False.
+        Returns:
+            bool: True if every action executed (or only printed) succeeded
+        """
+        with self.LOCKS.hold([self.repo_ops.get_ssp_lock_name()] if not APP.CMD_ONLY_PRINT else []):
+            return self.apply(prune)
+    # -----------------------------------------------------------------------------
+
+    def apply(self, prune: bool) -> bool:
+        state = self.load()
+        if not state:
+            return False
+        (users, parties, identities) = state
+        actions = plan_actions(users, parties, identities)
+        for action in actions:
+            action['status'] = 'planned' if (prune or action['kind'] not in REMOVALS) else 'not pruned'
+        todo = [action for action in actions if action['status'] == 'planned']
+
+        (batch, depends) = self.get_ca_batch(todo, users)
+        with self.LOCKS.hold([f"user:{action['user']}" for action in todo if action.get('keys')]):
+            outcome = self.execute_batch_concurrent(batch, depends) if batch else None
+            all_ok = True
+            for action in todo:
+                if APP.CMD_ONLY_PRINT or not action.get('keys'):
+                    continue
+                codes = [outcome[0][key][2] if outcome else -1 for key in action['keys']]
+                action['status'] = 'done' if all(code == 0 for code in codes) else 'failed'
+                all_ok = all_ok and action['status'] == 'done'
+            ### The fresh enrollments go to SSM as one batch
+            all_ok = self.publish_ssm(todo, users) and all_ok
+        ssp_ok = self.update_ssp(todo, users)
+        for action in todo:
+            if action['kind'] in (ADD_PARTY, UPDATE_PARTY, REMOVE_PARTY) and not APP.CMD_ONLY_PRINT:
+                action['status'] = ('failed' if not ssp_ok
+                                    else ('done' if self.envInfo.get_bat_publish() else 'fragment only'))
+        report_actions(actions, len(users), len(parties), len(identities))
+        return all_ok and ssp_ok
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+def report_actions(actions: list[dict], users: int, parties: int, identities: int) -> None:
+    click.echo(f'Reconciled {users} Cognito user(s), {parties} SSP part(y/ies), {identities} Fabric-CA identit(y/ies)')
+    if not actions:
+        click.echo('In sync: nothing to do')
+        return
+    columns = ['kind', 'user', 'role', 'status', 'detail']
+    rows = [[str(action.get(column) or '-') for column in columns] for action in actions]
+    widths = [max(len(cell) for cell in cells) for cells in zip(columns, *rows)]
+    for cells in [columns] + rows:
+        click.echo('  '.join(cell.ljust(width) for (cell, width) in zip(cells, widths)).rstrip())
+### -------------------------------------------------------------------------------
+
+
+@click.command(help="reconcile: Makes the SSP parties and Fabric-CA identities follow the Cognito users")
+@click.option('--env_file', '-e', default='./env-ec2-prod.yaml',
+                help="BloSS🌻M AWS-EC2-AMB-GitHub env-description YAML-file")
+@click.option('--branch', '-b', default=None,
+                help="BloSS🌻M branch to commit the SSP into (env git/default-branch if none)")
+@click.option('--issue', '-i', default='reconcile',
+                help="BloSS🌻M ticket number for the SSP commit message")
+@click.option('--prune', is_flag=True, default=False,
+                help="BloSS🌻M also removes the parties and identities of no Cognito user (otherwise only planned)")
+def reconcile(env_file: str, branch: str, issue: str, prune: bool):
+    """ Reconciles Cognito, the Fabric-CA and the SSP parties
+    Args:
+        env_file (str): The name of the AWS-EC2 environment file
+        branch (str): The GitHub branch of the SSP
+        issue (str): The ticket of the commit message
+        prune (bool): Executes the removals too
+    """
+    if not(env_file and os.path.isfile(env_file)):
+        click.echo(click.get_current_context().get_help()) ### Show CLI HELP
+        return
+    envInfo = EnvConfig(env_file)
+    init_runners(envInfo)
+    ### A clone of its own: the requests may run meanwhile
+    envInfo = envInfo.for_request(f'reconcile-issue-{issue}')
+    ### No user-file: the name only shapes the fragment files (reconcile-issue-<N>-party-*.*)
+    reqInfo = RequestConfig({'branch_name': branch or envInfo.get_git_default_branch(),
+                             'issue_number': issue,
+                             'file': f'reconcile-issue-{issue}_created_users.yaml'})
+    CommandRunner.TIMER.request_id = f'reconcile-issue-{issue}'
+    if not Reconciler(reqInfo, envInfo).reconcile(prune):
+        raise SystemExit(1)
+# -----------------------------------------------------------------------------
+
+
+@click.group(   invoke_without_command=False,
+                help='BloSS🌻M users reconcile CLI'
+            )
+@click.option(  '--print', '-p', 'execute_flag',
+                default='', show_default=True, flag_value='print',
+                help="BloSS🌻M CLI would only load, plan and print the commands")
+@click.option('--execute', '-x', 'execute_flag',
+                default='execute', show_default=True, flag_value='execute',
+                help="BloSS🌻M CLI will execute and print commands")
+@click.option('--debug', '-d', 'debug_flag',
+                default='', show_default=True, flag_value='debug',
+                help="BloSS🌻M CLI will execute with all debug messages")
+@click.pass_context
+def cli_entries(ctx, execute_flag:str, debug_flag: str):
+    if ctx.invoked_subcommand is None:
+        click.echo(ctx.get_help())
+    APP.CMD_ONLY_PRINT = True if execute_flag=='print' else False
+    APP.CLI_DEBUG_MODE = True if debug_flag=="debug" else False
+# -----------------------------------------------------------------------------
+
+cli_entries.add_command(reconcile)
+#==================================================================================
+
+if __name__ == "__main__":
+    cli_entries()
@@ -0,0 +1,162 @@
+# =================================================================================
+# Request-file codec shared by the Blossom-S3-Watcher Lambda and the EC2 ops.
+# Dependency-free on purpose: it is deployed next to the Lambda body, where
+# pulling PyYAML in costs cold-start time and package size.
+#
+# The request-file is a flat "key: value" YAML map, e.g.:
+#   branch_name: account-request
+#   file: ato/created_users/jdoe_created_user.yaml
+#   issue_number: 42
+#
+# A team onboarding lists its user files as a block list instead of the 'file':
+#   files:
+#     - ato/created_users/jdoe_created_user.yaml
+#     - ato/created_users/asmith_created_user.yaml
+#
+# The optional 'command' (create-user if none) is the command of ALL its user files,
+# the EC2 worker runs the request in the lane of that command (e.g. the deletions first):
+#   command: delete-user
+#
+# Micro-benchmark against PyYAML:
+#   python ops_request.py [--loops 20000]
+import sys
+import timeit
+
+# Local ---------------------------------------------------------------------------
+#==================================================================================
+
+REQUIRED_KEYS = ('branch_name', 'file', 'issue_number')
+### The block list of the user files - replaces the single 'file'
+LIST_KEY = 'files'
+### The command of the user files, the lane of the request
+COMMAND_KEY = 'command'
+COMMANDS = ('create-user', 'modify-user', 'delete-user')
+### -------------------------------------------------------------------------------
+
+
+class RequestFormatError(ValueError):
+    """ The request-file is not a flat "key: value" map (plus the 'files' block list)
+    """
+### -------------------------------------------------------------------------------
+
+
+def unquote(value: str) -> str:
+    if len(value) > 1 and value[0] == value[-1] and value[0] in ('"', "'"):
+        return value[1:-1]
+    return value
+### -------------------------------------------------------------------------------
+
+
+def strip_comment(value: str) -> str:
+    if ' #' not in value:
+        return value
+    if value[0] in ('"', "'"):
+        ### The comment may only follow the closing quote
+        end = value.find(value[0], 1)
+        if end > 0 and value[end + 1:].lstrip().startswith('#'):
+            return value[:end + 1]
+        return value
+    return value[:value.index(' #')].rstrip()
+### -------------------------------------------------------------------------------
+
+
+def parse_request(content) -> dict:
+    """ Parses the request-file content - the flat "key: value" subset of YAML
+    Args:
+        content (str|bytes): The request-file content
+    Returns:
+        dict: The key-value pairs of the request-file (strings, the 'files' is a list of strings)
+    Raises:
+        RequestFormatError: The content is not a flat "key: value" map
+    """
+    if isinstance(content, (bytes, bytearray)):
+        try:
+            content = content.decode('utf-8-sig')
+        except UnicodeDecodeError as ex:
+            raise RequestFormatError(f'Not UTF-8 text: {ex}')
+    request = {}
+    list_key = None     ### The 'files:' whose "- item" lines follow
+    for (number, line) in enumerate(content.splitlines(), 1):
+        stripped = line.strip()
+        if not stripped or stripped[0] == '#' or stripped in ('---', '...'):
+            continue
+        if list_key and (stripped == '-' or stripped.startswith('- ')):
+            item = unquote(strip_comment(stripped[1:].strip()))
+            if item:
+                request[list_key].append(item)
+            continue
+        if line[0] in (' ', '\t'):
+            raise RequestFormatError(f'Line {number}: nested values are not supported')
+        (key, sep, value) = stripped.partition(':')
+        if not sep or (value and value[0] not in (' ', '\t')):
+            raise RequestFormatError(f'Line {number}: "key: value" expected')
+        key = key.strip()
+        value = strip_comment(value.strip())
+        list_key = key if (key == LIST_KEY and not value) else None
+        request[key] = [] if list_key else unquote(value)
+    return request
+### -------------------------------------------------------------------------------
+
+
+def validate_request(request: dict) -> list[str]:
+    """ Checks the request-file has all the keys the EC2 worker needs
+    Args:
+        request (dict): The parsed request-file
+    Returns:
+        list[str]: The errors found, empty if the request is valid
+    """
+    request = request or {}
+    files = request.get(LIST_KEY)
+    errors = [f'Missing {key}' for key in REQUIRED_KEYS
+              if not str(request.get(key) or '').strip()
+              and not (key == 'file' and files)]
+    if files and not (isinstance(files, list) and all(str(name).strip() for name in files)):
+        errors.append(f'The {LIST_KEY} must be a list of the user files')
+    command = str(request.get(COMMAND_KEY) or '').strip()
+    if command and command not in COMMANDS:
+        errors.append(f'Unknown {COMMAND_KEY} {command}, one of {", ".join(COMMANDS)} expected')
+    return errors
+### -------------------------------------------------------------------------------
+
+
+def check_request(content) -> tuple[dict, list[str]]:
+    """ Parses and validates the request-file content
+    Args:
+        content (str|bytes): The request-file content
+    Returns:
+        tuple[dict, list[str]]: (parsed request, errors) - no errors means valid
+    """
+    try:
+        request = parse_request(content)
+    except RequestFormatError as ex:
+        return ({}, [f'{ex}'])
+    return (request, validate_request(request))
+### -------------------------------------------------------------------------------
+#==================================================================================
+
+
+def run_benchmark(loops: int) -> None:
+    sample = ('branch_name: account-request\n'
+              'file: ato/created_users/jdoe_created_user.yaml\n'
+              'issue_number: 42\n')
+    results = {'ops_request': timeit.timeit(lambda: check_request(sample), number=loops)}
+    try:
+        import yaml
+        def yaml_check():
+            request = yaml.safe_load(sample)
+            return all(key in request for key in REQUIRED_KEYS)
+        results['yaml.safe_load'] = timeit.timeit(yaml_check, number=loops)
+        if hasattr(yaml, 'CSafeLoader'):
+            results['yaml CSafeLoader'] = timeit.timeit(
+                lambda: yaml.load(sample, Loader=yaml.CSafeLoader), number=loops)
+    except ImportError:
+        print('PyYAML is not installed, only the codec is measured')
+    print(f'{loops} parse+validate loops [us per request-file]')
+    for (name, seconds) in results.items():
+        print(f'{name:<20}{seconds / loops * 1e6:>10.2f}')
+### -------------------------------------------------------------------------------
+
+
+if __name__ == '__main__':
+    loops = int(sys.argv[sys.argv.index('--loops') + 1]) if '--loops' in sys.argv else 20000
+    run_benchmark(loops)
@@ -0,0 +1,547 @@
+# =================================================================================
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+# From ----------------------------------------------------------------------------
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Spec+PIP ------------------------------------------------------------------------
+try:
+    import resource
+except ImportError:     ### POSIX only: no CPU/RSS figures elsewhere
+    resource = None
+
+# Local ---------------------------------------------------------------------------
+#==================================================================================
+
+
+def get_file_md5(path_to_file: str) -> str:
+    """ MD5 of the local file - equals the S3 ETag of a single-part upload
+    Args:
+        path_to_file (str): Path to the file
+    Returns:
+        str: Hex digest of the file content
+    """
+    digest = hashlib.md5()
+    with open(path_to_file, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+### -------------------------------------------------------------------------------
+
+
+def get_percentile(values: list, percent: float) -> float:
+    """ Nearest-rank percentile
+    Args:
+        values (list): The samples (None-s are ignored)
+        percent (float): 0..100
+    Returns:
+        float: The percentile, None if there are no samples
+    """
+    ordered = sorted(value for value in values if value is not None)
+    if not ordered:
+        return None
+    rank = max(1, -(-len(ordered) * percent // 100))    ### ceil without float noise
+    return ordered[int(rank) - 1]
+### -------------------------------------------------------------------------------
+
+
+def get_usage_figures(before, after) -> tuple[float, int]:
+    """ CPU and peak RSS out of the resource usage (resource.struct_rusage)
+    Args:
+        before: The usage at the start, None for the usage of a reaped child
+        after: The usage at the end (or of the reaped child)
+    Returns:
+        tuple[float, int]: (user+system CPU ms, peak RSS kB), (None, None) without the usage
+    """
+    if after is None:
+        return (None, None)
+    cpu = after.ru_utime + after.ru_stime
+    if before is not None:
+        cpu -= before.ru_utime + before.ru_stime
+    ### ru_maxrss is kB on Linux, bytes on macOS
+    rss_kb = after.ru_maxrss // 1024 if sys.platform == 'darwin' else after.ru_maxrss
+    return (round(cpu * 1000, 3), rss_kb)
+### -------------------------------------------------------------------------------
+#==================================================================================
+
+
+class SqliteStore(object):
+    """ Base of the local SQLite-backed state stores
+        All the stores may share one DB-file (each one owns its tables)
+    """
+    SCHEMA: str = ''
+
+    def __init__(self, db_file: str) -> None:
+        super().__init__()
+        self.db_file = db_file
+        if db_file != ':memory:' and os.path.dirname(db_file):
+            os.makedirs(os.path.dirname(db_file), exist_ok=True)
+        ### Autocommit mode, the multi-statement changes use explicit transactions
+        self.conn = sqlite3.connect(db_file, timeout=30,
+                                    isolation_level=None,
+                                    check_same_thread=False)
+        self.lock = threading.RLock()
+        if db_file != ':memory:':
+            self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(self.SCHEMA)
+    # -----------------------------------------------------------------------------
+
+    def execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self.lock:
+            return self.conn.execute(sql, params)
+    # -----------------------------------------------------------------------------
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class DedupStore(SqliteStore):
+    """ De-duplication of the at-least-once S3 notifications
+        Keyed on bucket/key/(VersionId or ETag), every key lives for its TTL
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS dedup (
+            dedup_key   TEXT PRIMARY KEY,
+            state       TEXT NOT NULL,
+            expires_at  REAL NOT NULL
+        );
+    '''
+    IN_FLIGHT = 'in-flight'
+    DONE = 'done'
+
+    @staticmethod
+    def get_dedup_key(bucket: str, s3_file: str, version: str) -> str:
+        return f'{bucket}/{s3_file}/{version}'
+    # -----------------------------------------------------------------------------
+
+    def claim(self, dedup_key: str, ttl: int) -> bool:
+        """ Marks the key in-flight unless it is in-flight or done within its TTL
+        Args:
+            dedup_key (str): The de-duplication key
+            ttl (int): Seconds to keep the in-flight claim
+        Returns:
+            bool: True if the caller owns the key, False for a duplicate
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.conn.execute(
+                    'SELECT expires_at FROM dedup WHERE dedup_key=?', (dedup_key,)).fetchone()
+                if row and row[0] > now:
+                    return False
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO dedup VALUES (?, ?, ?)',
+                    (dedup_key, self.IN_FLIGHT, now + ttl))
+                return True
+            finally:
+                self.conn.execute('COMMIT')
+    # -----------------------------------------------------------------------------
+
+    def mark_done(self, dedup_key: str, ttl: int) -> None:
+        self.execute('INSERT OR REPLACE INTO dedup VALUES (?, ?, ?)',
+                     (dedup_key, self.DONE, time.time() + ttl))
+    # -----------------------------------------------------------------------------
+
+    def release(self, dedup_key: str) -> None:
+        """ Forgets the key, so the failed file can be processed again
+        """
+        self.execute('DELETE FROM dedup WHERE dedup_key=?', (dedup_key,))
+    # -----------------------------------------------------------------------------
+
+    def get_state(self, dedup_key: str) -> str:
+        row = self.execute('SELECT state FROM dedup WHERE dedup_key=? AND expires_at>?',
+                           (dedup_key, time.time())).fetchone()
+        return row[0] if row else ''
+    # -----------------------------------------------------------------------------
+
+    def purge_expired(self) -> int:
+        return self.execute('DELETE FROM dedup WHERE expires_at<=?', (time.time(),)).rowcount
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class MemoStore(SqliteStore):
+    """ TTL cache of the read-only command results across the runs
+        Keyed on the exact command vector, tagged with the family/identity it reads
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS memo (
+            memo_key    TEXT PRIMARY KEY,
+            family      TEXT NOT NULL,
+            identity    TEXT NOT NULL,
+            stdout      TEXT,
+            stderr      TEXT,
+            code        INTEGER,
+            expires_at  REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS memo_identity ON memo (family, identity);
+    '''
+
+    def get(self, memo_key: str) -> tuple:
+        """ Returns:
+            tuple: (stdOut, stdErr, OS-ReturnCode), None if missing or expired
+        """
+        row = self.execute('SELECT stdout, stderr, code FROM memo WHERE memo_key=? AND expires_at>?',
+                           (memo_key, time.time())).fetchone()
+        return tuple(row) if row else None
+    # -----------------------------------------------------------------------------
+
+    def put(self, memo_key: str, family: str, identity: str, result: tuple, ttl: int) -> None:
+        (stdout, stderr, code) = result
+        self.execute('INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (memo_key, family, identity, stdout, stderr, code, time.time() + ttl))
+    # -----------------------------------------------------------------------------
+
+    def invalidate(self, family: str, identity: str) -> int:
+        return self.execute('DELETE FROM memo WHERE family=? AND identity=?',
+                            (family, identity)).rowcount
+    # -----------------------------------------------------------------------------
+
+    def purge_expired(self) -> int:
+        return self.execute('DELETE FROM memo WHERE expires_at<=?', (time.time(),)).rowcount
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class CaIdentityStore(SqliteStore):
+    """ TTL snapshot of the bulk-fetched Fabric-CA identities across the runs
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS ca_identity (
+            identity        TEXT PRIMARY KEY,
+            type            TEXT,
+            affiliation     TEXT,
+            max_enrollments INTEGER,
+            attrs           TEXT
+        );
+        CREATE TABLE IF NOT EXISTS ca_snapshot (
+            snapshot    INTEGER PRIMARY KEY CHECK (snapshot = 1),
+            fetched_at  REAL NOT NULL
+        );
+    '''
+
+    def load(self, ttl: int) -> dict:
+        """ Returns:
+            dict: id -> identity (id, type, affiliation, max_enrollments, attrs), None if missing or expired
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT fetched_at FROM ca_snapshot').fetchone()
+            if not row or row[0] + ttl <= time.time():
+                return None
+            rows = self.conn.execute(
+                'SELECT identity, type, affiliation, max_enrollments, attrs FROM ca_identity').fetchall()
+        return {identity: {'id': identity, 'type': identity_type, 'affiliation': affiliation,
+                           'max_enrollments': max_enrollments, 'attrs': json.loads(attrs)}
+                for (identity, identity_type, affiliation, max_enrollments, attrs) in rows}
+    # -----------------------------------------------------------------------------
+
+    def save(self, identities: dict) -> None:
+        """ Replaces the snapshot with the freshly fetched identities
+        """
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute('DELETE FROM ca_identity')
+                self.conn.executemany('INSERT INTO ca_identity VALUES (?, ?, ?, ?, ?)',
+                    [(identity['id'], identity['type'], identity['affiliation'],
+                      identity['max_enrollments'], json.dumps(identity['attrs']))
+                     for identity in identities.values()])
+                self.conn.execute('INSERT OR REPLACE INTO ca_snapshot VALUES (1, ?)', (time.time(),))
+                self.conn.execute('COMMIT')
+            except sqlite3.Error:
+                self.conn.execute('ROLLBACK')
+                raise
+    # -----------------------------------------------------------------------------
+
+    def expire(self) -> None:
+        """ An identity changed: the next run fetches a fresh snapshot
+        """
+        self.execute('DELETE FROM ca_snapshot')
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class JournalStore(SqliteStore):
+    """ The steps each request completed and their outputs (JSON), a retry resumes after them
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS journal (
+            request_key TEXT NOT NULL,
+            step        TEXT NOT NULL,
+            output      TEXT,
+            done_at     REAL NOT NULL,
+            PRIMARY KEY (request_key, step)
+        );
+        CREATE INDEX IF NOT EXISTS journal_done_at ON journal (done_at);
+    '''
+
+    def load(self, request_key: str) -> dict:
+        """ Returns:
+            dict: step -> output of the steps the request completed
+        """
+        rows = self.execute('SELECT step, output FROM journal WHERE request_key=? ORDER BY done_at',
+                            (request_key,)).fetchall()
+        return {step: json.loads(output) if output else {} for (step, output) in rows}
+    # -----------------------------------------------------------------------------
+
+    def record(self, request_key: str, step: str, output: dict) -> None:
+        self.execute('INSERT OR REPLACE INTO journal VALUES (?, ?, ?, ?)',
+                     (request_key, step, json.dumps(output), time.time()))
+    # -----------------------------------------------------------------------------
+
+    def forget(self, request_key: str, steps: list[str] = None) -> int:
+        """ Forgets the steps (all of them if None) of the request
+        """
+        if steps is None:
+            return self.execute('DELETE FROM journal WHERE request_key=?', (request_key,)).rowcount
+        return sum(self.execute('DELETE FROM journal WHERE request_key=? AND step=?', 
+                                (request_key, step)).rowcount for step in steps)
+    # -----------------------------------------------------------------------------
+
+    def purge_older(self, seconds: float) -> int:
+        ### The requests never retried (nor completed) within the time
+        return self.execute('DELETE FROM journal WHERE request_key IN '
+                            '(SELECT request_key FROM journal GROUP BY request_key HAVING MAX(done_at)<?)',
+                            (time.time() - seconds,)).rowcount
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class SsmParamStore(SqliteStore):
+    """ The SSM parameters as last published or read: version + SHA256 of the value (never the value)
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS ssm_param (
+            name        TEXT PRIMARY KEY,
+            version     INTEGER NOT NULL,
+            value_hash  TEXT NOT NULL,
+            checked_at  REAL NOT NULL
+        );
+    '''
+
+    def load(self, names: list[str]) -> dict:
+        """ Returns:
+            dict: name -> (version, value_hash, checked_at) of the names known
+        """
+        rows = [self.execute('SELECT version, value_hash, checked_at FROM ssm_param WHERE name=?',
+                             (name,)).fetchone() for name in names]
+        return {name: tuple(row) for (name, row) in zip(names, rows) if row}
+    # -----------------------------------------------------------------------------
+
+    def save(self, name: str, version: int, value_hash: str) -> None:
+        self.execute('INSERT OR REPLACE INTO ssm_param VALUES (?, ?, ?, ?)',
+                     (name, version, value_hash, time.time()))
+    # -----------------------------------------------------------------------------
+
+    def forget(self, names: list[str]) -> int:
+        ### The parameters deleted from SSM
+        return sum(self.execute('DELETE FROM ssm_param WHERE name=?', (name,)).rowcount for name in names)
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class EnrollmentStore(SqliteStore):
+    """ The enrolled Fabric client identities of amb/clients-dir: id, role, certificate serial, expiry and MSP
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS enrollment (
+            identity    TEXT PRIMARY KEY,
+            role        TEXT,
+            serial      TEXT NOT NULL,
+            not_after   REAL NOT NULL,
+            msp_dir     TEXT NOT NULL,
+            cert_file   TEXT NOT NULL,
+            key_file    TEXT NOT NULL,
+            indexed_at  REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS enrollment_not_after ON enrollment (not_after);
+    '''
+    COLUMNS = ('identity', 'role', 'serial', 'not_after', 'msp_dir', 'cert_file', 'key_file', 'indexed_at')
+
+    def get_row(self, enrollment: dict) -> tuple:
+        return tuple(enrollment[column] for column in self.COLUMNS[:-1]) + (time.time(),)
+    # -----------------------------------------------------------------------------
+
+    def record(self, enrollment: dict) -> None:
+        self.execute('INSERT OR REPLACE INTO enrollment VALUES (?, ?, ?, ?, ?, ?, ?, ?)', self.get_row(enrollment))
+    # -----------------------------------------------------------------------------
+
+    def get(self, identity: str) -> dict:
+        """ Returns:
+            dict: The enrollment of the identity (the COLUMNS), None if not enrolled
+        """
+        row = self.execute('SELECT * FROM enrollment WHERE identity=?', (identity,)).fetchone()
+        return dict(zip(self.COLUMNS, row)) if row else None
+    # -----------------------------------------------------------------------------
+
+    def get_expiring(self, before: float = None) -> list[dict]:
+        """ Returns:
+            list[dict]: The enrollments expiring before the time (all of them if None), the earliest first
+        """
+        if before is None:
+            rows = self.execute('SELECT * FROM enrollment ORDER BY not_after').fetchall()
+        else:
+            rows = self.execute('SELECT * FROM enrollment WHERE not_after<? ORDER BY not_after', (before,)).fetchall()
+        return [dict(zip(self.COLUMNS, row)) for row in rows]
+    # -----------------------------------------------------------------------------
+
+    def forget(self, identity: str) -> int:
+        return self.execute('DELETE FROM enrollment WHERE identity=?', (identity,)).rowcount
+    # -----------------------------------------------------------------------------
+
+    def replace(self, enrollments: list[dict]) -> None:
+        """ Replaces the index with the enrollments read from disk
+        """
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.conn.execute('DELETE FROM enrollment')
+                self.conn.executemany('INSERT INTO enrollment VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                      [self.get_row(enrollment) for enrollment in enrollments])
+                self.conn.execute('COMMIT')
+            except sqlite3.Error:
+                self.conn.execute('ROLLBACK')
+                raise
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class TimingStore(SqliteStore):
+    """ Append-only timings of the commands: wall time, exit code, output bytes, CPU and peak RSS
+        Keyed on the request (S3 file) and the command kind (CommandEC2 key)
+        The child RSS on Linux counts the pages of the fork, i.e. never below the worker RSS
+    """
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS timing (
+            recorded_at REAL NOT NULL,
+            request_id  TEXT NOT NULL,
+            kind        TEXT NOT NULL,
+            backend     TEXT NOT NULL,
+            wall_ms     REAL NOT NULL,
+            code        TEXT,
+            out_bytes   INTEGER,
+            cpu_ms      REAL,
+            rss_kb      INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS timing_recorded ON timing (recorded_at, kind);
+    '''
+    PERCENTILES = (50, 90, 99)
+
+    def record(self, request_id: str, kind: str, backend: str, wall_ms: float, code, 
+               out_bytes: int = None, cpu_ms: float = None, rss_kb: int = None) -> None:
+        self.execute('INSERT INTO timing VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (time.time(), request_id, kind, backend, wall_ms, str(code), out_bytes, cpu_ms, rss_kb))
+    # -----------------------------------------------------------------------------
+
+    def get_samples(self, since: float, kind: str = None) -> dict:
+        """ Returns:
+            dict: (kind, backend) -> list of (wall_ms, code, out_bytes, cpu_ms, rss_kb) recorded since the time
+        """
+        sql = ('SELECT kind, backend, wall_ms, code, out_bytes, cpu_ms, rss_kb FROM timing WHERE recorded_at>=?'
+               + (' AND kind=?' if kind else '') + ' ORDER BY kind, backend')
+        samples = {}
+        for row in self.execute(sql, (since, kind) if kind else (since,)).fetchall():
+            samples.setdefault((row[0], row[1]), []).append(tuple(row[2:]))
+        return samples
+    # -----------------------------------------------------------------------------
+
+    def get_report(self, since: float, kind: str = None) -> list[dict]:
+        """ Percentiles per command kind (and backend) since the time
+        Returns:
+            list[dict]: kind, backend, count, failed, wall_p50.., wall_max, cpu_p50, cpu_p90, rss_max, bytes_p50
+        """
+        report = []
+        for ((kind_name, backend), rows) in self.get_samples(since, kind).items():
+            (walls, codes, out_bytes, cpus, rsses) = zip(*rows)
+            line = {'kind': kind_name, 'backend': backend, 'count': len(rows),
+                    'failed': sum(1 for code in codes if code != '0')}
+            for percent in self.PERCENTILES:
+                line[f'wall_p{percent}'] = get_percentile(walls, percent)
+            line['wall_max'] = max(walls)
+            line['cpu_p50'] = get_percentile(cpus, 50)
+            line['cpu_p90'] = get_percentile(cpus, 90)
+            line['rss_max'] = max((rss for rss in rsses if rss is not None), default=None)
+            line['bytes_p50'] = get_percentile(out_bytes, 50)
+            report.append(line)
+        return report
+    # -----------------------------------------------------------------------------
+
+    def purge_older(self, seconds: float) -> int:
+        return self.execute('DELETE FROM timing WHERE recorded_at<?', (time.time() - seconds,)).rowcount
+    # -----------------------------------------------------------------------------
+#==================================================================================
+
+
+class CommandTimer(object):
+    """ Records the timings of the current request, nothing without the store
+    """
+    ### Per thread (and the asyncio tasks/threads it starts): the concurrent requests are timed apart
+    REQUEST_ID: ContextVar = ContextVar('request_id', default='')
+
+    def __init__(self, store: TimingStore = None, request_id: str = '') -> None:
+        super().__init__()
+        self.store = store
+        if request_id:
+            self.request_id = request_id
+    # -----------------------------------------------------------------------------
+
+    @property
+    def request_id(self) -> str:
+        return self.REQUEST_ID.get()
+
+    @request_id.setter
+    def request_id(self, request_id: str) -> None:
+        self.REQUEST_ID.set(request_id)
+    # -----------------------------------------------------------------------------
+
+    def record(self, kind: str, backend: str, wall_ms: float, code, 
+               out: str = None, usage=None, usage_before=None) -> None:
+        """ Args:
+            usage: The resource usage of the reaped child (or of the process at the end)
+            usage_before: The process usage at the start, None for a child usage
+        """
+        if not self.store:
+            return
+        (cpu_ms, rss_kb) = get_usage_figures(usage_before, usage)
+        out_bytes = None
+        if isinstance(out, str):
+            ### The streamed outputs keep their head/tail only, but know the whole size
+            out_bytes = getattr(out, 'total_bytes', 0) or len(out.encode('utf-8', 'replace'))
+        try:
+            self.store.record(self.request_id or '-', kind, backend, round(wall_ms, 3), code,
+                              out_bytes, cpu_ms, rss_kb)
+        except sqlite3.Error:
+            ### Timings are best-effort: never fail the command for them
+            pass
+    # -----------------------------------------------------------------------------
+
+    @contextmanager
+    def measure(self, kind: str, backend: str = 'in-process'):
+        """ Times the in-process work of a single-threaded process (e.g. the Saxon transforms)
+            Yields:
+                dict: set 'out' (the produced text) and 'code' if not 0
+        """
+        sample = {'out': None, 'code': 0}
+        usage_before = resource.getrusage(resource.RUSAGE_SELF) if resource else None
+        start = time.perf_counter()
+        try:
+            yield sample
+        except Exception:
+            sample['code'] = '-101'
+            raise
+        finally:
+            self.record(kind, backend, (time.perf_counter() - start) * 1000, sample['code'], sample['out'],
+                        resource.getrusage(resource.RUSAGE_SELF) if resource else None, usage_before)
+    # -----------------------------------------------------------------------------
+#==================================================================================
@@ -9,6 +9,7 @@ import click
 from saxonche import PySaxonProcessor
 
 import ops_yaml as oy
+from ops_store import CommandTimer, TimingStore
 from ops_yaml import APP
 
 # def get_timestamp(datetime: datetime = None)
@@ -66,10 +67,29 @@ class XmlFragmentOps:
         APP.print(correctly_spaced_xml) 
         return correctly_spaced_xml
 
+### Drops the parties of the $uuids and their responsible-party references (namespace-agnostic),
+### a responsible-party left with no party-uuid goes too
+REMOVE_PARTY_XSL = """<?xml version="1.0" encoding="UTF-8"?>
+<xsl:stylesheet version="3.0" xmlns:xsl="http://www.w3.org/1999/XSL/Transform">
+    <xsl:param name="uuids" select="''"/>
+    <xsl:param name="changedDateTime" select="''"/>
+    <xsl:variable name="removed" select="tokenize(normalize-space($uuids), ' ')"/>
+    <xsl:mode on-no-match="shallow-copy"/>
+    <xsl:template match="*:party[@uuid = $removed]"/>
+    <xsl:template match="*:responsible-party/*:party-uuid[normalize-space(.) = $removed]"/>
+    <xsl:template match="*:responsible-party[every $ref in *:party-uuid satisfies normalize-space($ref) = $removed]"/>
+    <xsl:template match="*:metadata/*:last-modified[$changedDateTime]">
+        <xsl:copy><xsl:value-of select="$changedDateTime"/></xsl:copy>
+    </xsl:template>
+</xsl:stylesheet>
+"""
+
 class saxon_operations:
     
-    def __init__(self, source:str ='' , target:str=''):
+    def __init__(self, source:str ='' , target:str='', timer: CommandTimer = None):
         
+        ### Times the transforms (nothing is recorded without the timings store)
+        self.timer = timer if timer else CommandTimer()
         (self.root_dir, self.temp) = get_work_directories()
         if source:
             self.root_dir = os.path.dirname(source)
@@ -137,9 +157,11 @@ class saxon_operations:
             xslt_proc.set_parameter('docUUID', proc.make_string_value(str( uuid4() )) ) 
             xslt_proc.set_parameter('changedDateTime', proc.make_string_value(datetime.now().isoformat()) ) 
                                     
-            document = proc.parse_xml(xml_text=src_xml)
-            executable = xslt_proc.compile_stylesheet(stylesheet_file=trans_file)
-            output = executable.transform_to_string(xdm_node=document)
+            with self.timer.measure('XSL_INSERT_PARTY') as sample:
+                document = proc.parse_xml(xml_text=src_xml)
+                executable = xslt_proc.compile_stylesheet(stylesheet_file=trans_file)
+                output = executable.transform_to_string(xdm_node=document)
+                sample['out'] = output
 
             ### print(output)
 
@@ -167,9 +189,11 @@ class saxon_operations:
 
             xslt_proc = proc.new_xslt30_processor()
                                     
-            document = proc.parse_xml(xml_text=src_xml)
-            executable = xslt_proc.compile_stylesheet(stylesheet_file=trans_file)
-            output = executable.transform_to_string(xdm_node=document)
+            with self.timer.measure('XSL_CLEANUP_RESPONSIBLE') as sample:
+                document = proc.parse_xml(xml_text=src_xml)
+                executable = xslt_proc.compile_stylesheet(stylesheet_file=trans_file)
+                output = executable.transform_to_string(xdm_node=document)
+                sample['out'] = output
 
             ### print(output)
 
@@ -185,6 +209,35 @@ class saxon_operations:
 
         return updated_xml        
     ### -----------------------------------------------------------------------------------  
+    def remove_parties( self, src_file: str, uuids: list[str], ) -> str:
+        updated_xml = ''
+        with open(src_file, 'r') as file:
+            src_xml  = file.read()
+
+        with PySaxonProcessor(license=False) as proc:
+            print(f'{proc.version=}\n{"="*90}')	
+
+            xslt_proc = proc.new_xslt30_processor()
+            xslt_proc.set_parameter('uuids', proc.make_string_value(' '.join(uuids)))
+            xslt_proc.set_parameter('changedDateTime', proc.make_string_value(datetime.now().astimezone().isoformat()) ) 
+
+            with self.timer.measure('XSL_REMOVE_PARTY') as sample:
+                document = proc.parse_xml(xml_text=src_xml)
+                executable = xslt_proc.compile_stylesheet(stylesheet_text=REMOVE_PARTY_XSL)
+                output = executable.transform_to_string(xdm_node=document)
+                sample['out'] = output
+
+            # UPDATE MASTER XML
+            timestamp = self.get_file_timestamp()   
+            print(f'\n\t{timestamp=}')
+            updated_xml = src_file.replace('.xml', f"-v{timestamp}.xml")
+
+            # WRITE TRANSFORMED TREE INTO FILE
+            with open(updated_xml, 'wb') as s:
+                s.write(output.encode("utf-8"))
+
+        return updated_xml        
+    ### -----------------------------------------------------------------------------------  
 ### =======================================================================================
 @click.command(help="insert-party: Inserts BloSS🌻M User into SSP")
 @click.option('--ssp_file', '-s',
@@ -195,11 +248,17 @@ class saxon_operations:
                 help="BloSS🌻M SSP file for final copying of the result")
 @click.option('--xsl_config', '-x',
                 help="BloSS🌻M XSl Config YAML-file")
+@click.option('--timings_db', '-t', default=None,
+                help="BloSS🌻M state-db to record the transform timings into")
+@click.option('--request_id', '-r', default='',
+                help="BloSS🌻M request (S3 file) the timings belong to")
 def insert_party(
                 ssp_file:str,
                 user_info: str,
                 copy_to: str,
                 xsl_config: str,
+                timings_db: str,
+                request_id: str,
             ) -> None:
     
     transInfo = oy.TransConfig(get_abs_path(xsl_config))
@@ -216,7 +275,8 @@ def insert_party(
     
     ### Perform Insert-Party/Resp-Party Transformations With Saxon-CHE
     trans_status_OK = True
-    sax = saxon_operations()
+    sax = saxon_operations(timer=CommandTimer(
+                TimingStore(timings_db) if timings_db else None, request_id))
     try:
         print(f"Insert-transforming {src_ssp_file}")
         temp_file = sax.insert_party(
@@ -248,6 +308,51 @@ def insert_party(
                                     )
         else:
             print('failure')
+            ### Non-zero exit: the caller must not commit the unchanged SSP
+            raise SystemExit(1)
+    ### ---------------------------------------------------------------------------  
+### ===============================================================================
+
+@click.command(help="remove-party: Removes BloSS🌻M Users (party UUIDs) from SSP")
+@click.option('--ssp_file', '-s',
+                help="BloSS🌻M SSP-file in XMLformat")
+@click.option('--user_uuids', '-u',
+                 help="BloSS🌻M file of the party UUIDs to remove, one per line")
+@click.option('--copy_to', '-c',
+                help="BloSS🌻M SSP file for final copying of the result")
+@click.option('--timings_db', '-t', default=None,
+                help="BloSS🌻M state-db to record the transform timings into")
+@click.option('--request_id', '-r', default='',
+                help="BloSS🌻M request (S3 file) the timings belong to")
+def remove_party(
+                ssp_file:str,
+                user_uuids: str,
+                copy_to: str,
+                timings_db: str,
+                request_id: str,
+            ) -> None:
+    src_ssp_file = get_abs_path(ssp_file)
+    src_uuids_file = get_abs_path(user_uuids)
+    uuids = []
+    if src_uuids_file and os.path.isfile(src_uuids_file):
+        with open(src_uuids_file) as stream:
+            uuids = [line.strip() for line in stream if line.strip()]
+    if not (src_ssp_file and os.path.isfile(src_ssp_file) and uuids):
+        print(f'Nothing to remove from {ssp_file} (UUIDs: {user_uuids})')
+        raise SystemExit(1)
+
+    sax = saxon_operations(timer=CommandTimer(
+                TimingStore(timings_db) if timings_db else None, request_id))
+    try:
+        print(f"Remove-transforming {src_ssp_file}: {len(uuids)} part(y/ies)")
+        temp_file = sax.remove_parties(src_file = src_ssp_file, uuids = uuids)
+    except Exception as ex:
+        print(ex)
+        print('failure')
+        ### Non-zero exit: the caller must not commit the unchanged SSP
+        raise SystemExit(1)
+    shutil.copy2(temp_file, copy_to)
+    os.remove(temp_file)
     ### ---------------------------------------------------------------------------  
 ### ===============================================================================
 #==================================================================================
@@ -267,6 +372,7 @@ def cli_entries(ctx):
 # -----------------------------------------------------------------------------
 
 cli_entries.add_command(insert_party)
+cli_entries.add_command(remove_party)
 # cli_entries.add_command(create_user)
 # cli_entries.add_command(process_s3_file)
 #==================================================================================
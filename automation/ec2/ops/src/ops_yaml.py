@@ -1,6 +1,8 @@
 # =================================================================================
+import copy
 import logging
 import os
+import re
 import sys
 
 # From ----------------------------------------------------------------------------
@@ -13,6 +15,7 @@ import click
 import yaml
 
 # Local ---------------------------------------------------------------------------
+from ops_request import RequestFormatError, parse_request, validate_request
 #==================================================================================
 
 
@@ -137,6 +140,9 @@ class YamlMap(object):
             dict: YAML file content
         """
         file_content = None
+        if isinstance(yaml_file, dict):
+            ### Built in-process (e.g. the reconcile of the Cognito users), not read from a file
+            return yaml_file
         if os.path.exists(yaml_file):
             with open(yaml_file) as stream:
                 try:
@@ -212,18 +218,33 @@ class RequestConfig(YamlMap):
                 print(f'\t{entry}')    
     # -----------------------------------------------------------------------------
 
+    def read_yaml_file(self, yaml_file) -> dict:
+        """ Reads the request-file with the codec shared with the S3-Watcher Lambda,
+            falls back to YAML for anything beyond the flat "key: value" map
+        Args:
+            yaml_file (_type_): Path-File-Name to read
+        Returns:
+            dict: Request-file content
+        """
+        if isinstance(yaml_file, dict) or not os.path.exists(yaml_file):
+            return super().read_yaml_file(yaml_file)
+        with open(yaml_file, 'rb') as stream:
+            content = stream.read()
+        try:
+            return parse_request(content)
+        except RequestFormatError as ex:
+            APP.debug(f'{yaml_file}: {ex}, reading as YAML')
+            return super().read_yaml_file(yaml_file)
+    # -----------------------------------------------------------------------------
+
     def is_valid(self)-> bool:
-        """ VErifies the YAML validity
+        """ VErifies the YAML validity - the same check the Lambda preflight does
         Returns:
             bool: True is YAML is valid, False: otherwise
         """
-        if ('branch_name' in self.config.keys()
-            and 'file' in self.config.keys()
-            and 'issue_number' in self.config.keys() ):
-            # The status OK
-            return True
-        else:
-            return False
+        self.errors = [f"YAML File:'{self.yaml_file}' {entry} !!!"
+                       for entry in validate_request(self.config)]
+        return len(self.errors) == 0
     # -----------------------------------------------------------------------------
 
     def get_cmd_file_name(self)-> str:
@@ -233,6 +254,17 @@ class RequestConfig(YamlMap):
         """
         return self.get_attr_str('file')
     # -----------------------------------------------------------------------------
+
+    def get_cmd_file_names(self)-> list[str]:
+        """ Returns the user-files of the request
+        Returns: The 'files' list of the multi-user request, the single 'file' otherwise
+            list[str]: Repo-relative paths of the user-files
+        """
+        files = [str(name).strip() for name in self.get_attr_list('files') if str(name).strip()]
+        if files:
+            return files
+        return [self.get_cmd_file_name()] if self.get_cmd_file_name() else []
+    # -----------------------------------------------------------------------------
     
     def get_issue_number(self)-> str:
         """ Returns Issue Number
@@ -242,6 +274,18 @@ class RequestConfig(YamlMap):
         return self.get_attr_str('issue_number')
     # -----------------------------------------------------------------------------
 
+    def get_command(self)-> str:
+        """ Returns the command of the request (the lane it waits in), 'create-user' if not given
+        """
+        return self.get_declared_command() or 'create-user'
+    # -----------------------------------------------------------------------------
+
+    def get_declared_command(self)-> str:
+        """ Returns the command the request-file gives, '' if none (its user files are not checked against it)
+        """
+        return self.get_attr_str('command')
+    # -----------------------------------------------------------------------------
+
     def get_branch_name(self)-> str:
         """ Returns branch name
         Returns: GitHub branch name to checkout and push into
@@ -250,7 +294,11 @@ class RequestConfig(YamlMap):
         return self.get_attr_str('branch_name')
     # -----------------------------------------------------------------------------
     def get_party_xml_file(self,) -> str:
-        src = self.get_cmd_file_name()
+        files = self.get_cmd_file_names()
+        if len(files) != 1:
+            ### One fragment of all the parties of the multi-user request
+            return f'issue-{self.get_issue_number()}-party-frag.xml'
+        src = files[0]
         post_slash = src.rfind('/') + 1
         ts_end = src.rfind('_created')
         return f'{src[post_slash:ts_end]}-party-frag.xml'
@@ -282,6 +330,81 @@ class EnvConfig(YamlMap):
     def get_bat_print_at(self) -> str:
         return self.get_attr_str('env/bat/print-at')
     # -----------------------------------------------------------------------------
+    def get_bat_state_db(self) -> str:
+        state_db = self.get_attr_str('env/bat/state-db')
+        if state_db:
+            return state_db
+        return os.path.join(self.get_bat_work_dir(), 'state', 'b@-state.sqlite')
+    # -----------------------------------------------------------------------------
+    def get_bat_dedup_ttl(self) -> int:
+        ### get_attr_by_path() drops a 0, which turns de-duplication off
+        ttl = (self.get_attr_by_path('env/bat') or {}).get('dedup-ttl')
+        return 86400 if ttl is None or str(ttl).strip() == '' else int(ttl)
+    # -----------------------------------------------------------------------------
+    def get_bat_dedup_lease(self) -> int:
+        lease = self.get_attr_str('env/bat/dedup-lease')
+        return int(lease) if lease else 3600
+    # -----------------------------------------------------------------------------
+    def get_bat_max_parallel(self) -> int:
+        max_parallel = self.get_attr_str('env/bat/max-parallel')
+        return int(max_parallel) if max_parallel else 4
+    # -----------------------------------------------------------------------------
+    def get_bat_memo_ttl(self) -> int:
+        ttl = self.get_attr_str('env/bat/memo-ttl')
+        return int(ttl) if ttl else 0
+    # -----------------------------------------------------------------------------
+    def get_bat_ca_index_ttl(self) -> int:
+        ttl = self.get_attr_str('env/bat/ca-index-ttl')
+        return int(ttl) if ttl else 0
+    # -----------------------------------------------------------------------------
+    def get_bat_command_backend(self) -> str:
+        return self.get_attr_str('env/bat/command-backend') or 'cli'
+    # -----------------------------------------------------------------------------
+    def get_bat_ca_backend(self) -> str:
+        return self.get_attr_str('env/bat/ca-backend') or 'cli'
+    # -----------------------------------------------------------------------------
+    def get_bat_timings_ttl(self) -> int:
+        ttl = self.get_attr_str('env/bat/timings-ttl')
+        return int(ttl) if ttl else 30 * 86400
+    # -----------------------------------------------------------------------------
+    def get_bat_journal_ttl(self) -> int:
+        ttl = self.get_attr_str('env/bat/journal-ttl')
+        return int(ttl) if ttl else 7 * 86400
+    # -----------------------------------------------------------------------------
+    def get_bat_ssm_ttl(self) -> int:
+        ttl = self.get_attr_str('env/bat/ssm-ttl')
+        return int(ttl) if ttl else 0
+    # -----------------------------------------------------------------------------
+    def get_bat_max_requests(self) -> int:
+        max_requests = self.get_attr_str('env/bat/max-requests')
+        return max(1, int(max_requests)) if max_requests else 1
+    # -----------------------------------------------------------------------------
+    def get_bat_lanes(self) -> list[str]:
+        ### The request commands in their priority order, the unlisted ones go last
+        return [str(lane) for lane in self.get_attr_list('env/bat/lanes')] or ['delete-user', 'modify-user', 'create-user']
+    # -----------------------------------------------------------------------------
+    def get_bat_lock_dir(self) -> str:
+        lock_dir = self.get_attr_str('env/bat/lock-dir')
+        if lock_dir:
+            return lock_dir
+        return os.path.join(self.get_bat_work_dir(), 'locks')
+    # -----------------------------------------------------------------------------
+    def get_bat_trans_config(self) -> str:
+        trans_config = self.get_attr_str('env/bat/trans-config')
+        if trans_config:
+            return trans_config
+        return os.path.join(self.get_bat_work_dir(), 'env-ec2-trans.yaml')
+    # -----------------------------------------------------------------------------
+    def get_bat_publish(self) -> bool:
+        ### SSP transform + Add-Commit-Push of the request, off unless configured
+        return self.get_attr_str('env/bat/publish').lower() in ('true', 'yes', '1')
+    # -----------------------------------------------------------------------------
+
+    def get_limits(self, service: str) -> dict:
+        ### env/limits/<service>: rate, burst, retries, backoff-ms, backoff-max-ms, breaker-failures, breaker-reset
+        limits = self.get_attr_by_path(f'env/limits/{service}')
+        return limits if isinstance(limits, dict) else {}
+    # -----------------------------------------------------------------------------
 
     def get_git_repo(self) -> str:
         return self.get_attr_str('env/git/repo')
@@ -289,6 +412,32 @@ class EnvConfig(YamlMap):
     def get_git_repo_dir(self) -> str:
         return self.get_attr_str('env/git/repo-dir')
     # -----------------------------------------------------------------------------
+    def for_request(self, request_key: str) -> 'EnvConfig':
+        """ The same environment with a repo-dir and a user-dir of the request (created here):
+            the concurrent requests never share a clone nor the party fragment/remove files
+        Args:
+            request_key (str): Names the directories, the same for the retries of the request (e.g. the S3 file)
+        Raises:
+            ValueError: No env/git/repo-dir or env/bat/user-dir to put the directories of the request next to
+        """
+        if not (self.get_git_repo_dir().rstrip('/') and self.get_bat_user_dir()):
+            ### An empty base gives a relative '-<key>' that 'rm -rf' and 'git clone' read as an option
+            raise ValueError('env/git/repo-dir and env/bat/user-dir are required to run a request')
+        request_name = re.sub(r'[^A-Za-z0-9._-]+', '_', request_key).strip('_')
+        envInfo = copy.copy(self)
+        envInfo.config = copy.deepcopy(self.config)
+        envInfo.config['env']['git']['repo-dir'] = self.get_request_repo_dir(request_name)
+        envInfo.config['env']['bat']['user-dir'] = os.path.join(self.get_bat_requests_dir(), request_name)
+        os.makedirs(envInfo.get_bat_user_dir(), exist_ok=True)
+        os.utime(envInfo.get_bat_user_dir())    ### The purge of the stale requests counts from the last attempt
+        return envInfo
+    # -----------------------------------------------------------------------------
+    def get_bat_requests_dir(self) -> str:
+        return os.path.join(self.get_bat_user_dir(), 'requests')
+    # -----------------------------------------------------------------------------
+    def get_request_repo_dir(self, request_name: str) -> str:
+        return self.get_git_repo_dir().rstrip('/') + '-' + request_name
+    # -----------------------------------------------------------------------------
     def get_git_default_branch(self) -> str:
         return self.get_attr_str('env/git/default-branch')
     # -----------------------------------------------------------------------------
@@ -309,12 +458,22 @@ class EnvConfig(YamlMap):
     def get_aws_idp_pool(self) -> str:
         return self.get_attr_str('env/aws/idp-pool')
     # -----------------------------------------------------------------------------
+    def get_aws_region(self) -> str:
+        return self.get_attr_str('env/aws/region')
+    # -----------------------------------------------------------------------------
     def get_aws_s3_drop_name(self) -> str:
         return self.get_attr_str('env/aws/s3-drop-name')
     # -----------------------------------------------------------------------------
     def get_aws_s3_drop_url(self) -> str:
         return self.get_attr_str('env/aws/s3-drop-url')
     # -----------------------------------------------------------------------------
+    def get_aws_ssm_prefix(self) -> str:
+        return self.get_attr_str('env/aws/ssm-prefix')
+    # -----------------------------------------------------------------------------
+    def get_aws_ssm_values(self) -> list[str]:
+        ### The enrollment material published per user: <ssm-prefix><user>/<value>
+        return [str(value) for value in self.get_attr_list('env/aws/ssm-values')] or ['pk', 'cert', 'mspid', 'roles']
+    # -----------------------------------------------------------------------------
 
 
     def get_amb_ca_url(self) -> str:       
@@ -347,6 +506,16 @@ class EnvConfig(YamlMap):
     def get_amb_tls_cert(self) -> str:       
         return self.get_attr_str('env/amb/tls-cert')
     # -----------------------------------------------------------------------------
+    def get_amb_ca_name(self) -> str:       
+        return self.get_attr_str('env/amb/ca-name')
+    # -----------------------------------------------------------------------------
+    def get_amb_member(self) -> str:       
+        return self.get_attr_str('env/amb/member')
+    # -----------------------------------------------------------------------------
+    def get_amb_msp_id(self) -> str:       
+        ### The AMB member ID is the MSP ID of its peers
+        return self.get_attr_str('env/amb/msp-id') or self.get_amb_member()
+    # -----------------------------------------------------------------------------
 
     def get_config(self) -> object:
         return self.config
@@ -0,0 +1,164 @@
+# =================================================================================
+# Tests of the in-process aws CLI (Boto3Backend) against stubbed botocore clients:
+#   python -m pytest -q test_ops_backend.py
+# The answers must be those of the CLI: its JSON stdout, error text and return codes
+import io
+import json
+
+import pytest
+
+boto3 = pytest.importorskip('boto3')
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+# Local ---------------------------------------------------------------------------
+import ops_backend
+from ops_backend import Boto3Backend, CommandBackend, StubBackend, make_backend
+from ops_yaml import EnvConfig
+#==================================================================================
+
+POOL = 'us-east-1_pool'
+USER_UUID = '3f2b7c8e-1d4a-4e6b-9c2d-0a1b2c3d4e5f'
+### -------------------------------------------------------------------------------
+
+
+@pytest.fixture
+def backend():
+    boto3_backend = Boto3Backend('us-east-1')
+    stubbers = {}
+    for service in ('cognito-idp', 'ssm', 's3'):
+        client = boto3.session.Session().client(service, region_name='us-east-1',
+                                                 aws_access_key_id='test', aws_secret_access_key='test')
+        boto3_backend.clients[service] = client
+        stubbers[service] = Stubber(client)
+        stubbers[service].activate()
+    boto3_backend.stubbers = stubbers
+    yield boto3_backend
+    for stubber in stubbers.values():
+        stubber.assert_no_pending_responses()
+        stubber.deactivate()
+### -------------------------------------------------------------------------------
+
+
+def test_idp_read_user(backend):
+    backend.stubbers['cognito-idp'].add_response(
+        'admin_get_user',
+        {'Username': 'jdoe', 'UserAttributes': [{'Name': 'sub', 'Value': USER_UUID}],
+         'ResponseMetadata': {'RequestId': 'r1'}},
+        {'UserPoolId': POOL, 'Username': 'jdoe'})
+    (out, err, code) = backend.execute('IDP_READ_USER', [
+        'aws', 'cognito-idp', 'admin-get-user', '--user-pool-id', POOL, '--username', 'jdoe', '--output', 'json'])
+    assert (err, code) == ('', 0)
+    assert json.loads(out) == {'Username': 'jdoe', 'UserAttributes': [{'Name': 'sub', 'Value': USER_UUID}]}
+### -------------------------------------------------------------------------------
+
+
+def test_idp_create_user_attributes(backend):
+    backend.stubbers['cognito-idp'].add_response(
+        'admin_create_user',
+        {'User': {'Username': 'jdoe', 'Attributes': [{'Name': 'sub', 'Value': USER_UUID}]}},
+        {'UserPoolId': POOL, 'Username': 'jdoe',
+         'UserAttributes': [{'Name': 'email', 'Value': 'jdoe@example.org'},
+                            {'Name': 'name', 'Value': 'John Doe'}]})
+    (out, err, code) = backend.execute('IDP_CREATE_USER', [
+        'aws', 'cognito-idp', 'admin-create-user', '--user-pool-id', POOL, '--username', 'jdoe',
+        '--user-attributes', 'Name=email,Value="jdoe@example.org"', 'Name=name,Value="John Doe"'])
+    assert code == 0 and json.loads(out)['User']['Username'] == 'jdoe'
+### -------------------------------------------------------------------------------
+
+
+def test_service_error_is_254(backend):
+    backend.stubbers['cognito-idp'].add_client_error(
+        'admin_get_user', service_error_code='UserNotFoundException', service_message='User does not exist.')
+    (out, err, code) = backend.execute('IDP_READ_USER', [
+        'aws', 'cognito-idp', 'admin-get-user', '--user-pool-id', POOL, '--username', 'nobody'])
+    assert (out, code) == ('', 254)
+    assert ('An error occurred (UserNotFoundException) when calling the AdminGetUser operation: '
+            'User does not exist.') in err
+### -------------------------------------------------------------------------------
+
+
+def test_client_error_is_255(backend):
+    ### The missing --username fails before any call, as the CLI argument check does
+    (out, err, code) = backend.execute('IDP_READ_USER', [
+        'aws', 'cognito-idp', 'admin-get-user', '--user-pool-id', POOL])
+    assert (out, code) == ('', 255)
+### -------------------------------------------------------------------------------
+
+
+def test_ssm_put_parameter_reads_the_file(backend, tmp_path):
+    cert_file = tmp_path / 'cert.pem'
+    cert_file.write_text('-----BEGIN CERTIFICATE-----\nMIIB\n-----END CERTIFICATE-----\n')
+    backend.stubbers['ssm'].add_response(
+        'put_parameter', {'Version': 2, 'Tier': 'Standard'},
+        {'Name': '/nist/blossom/dev/user/jdoe/cert', 'Value': cert_file.read_text(),
+         'Type': 'SecureString', 'Overwrite': True})
+    (out, err, code) = backend.execute('SSM_PUT_CERT', [
+        'aws', 'ssm', 'put-parameter', '--name', '/nist/blossom/dev/user/jdoe/cert',
+        '--value', f'file://{cert_file}', '--type', 'SecureString', '--overwrite'])
+    assert code == 0 and json.loads(out) == {'Version': 2, 'Tier': 'Standard'}
+### -------------------------------------------------------------------------------
+
+
+def test_ssm_put_parameter_missing_file_is_255(backend, tmp_path):
+    (out, err, code) = backend.execute('SSM_PUT_PK', [
+        'aws', 'ssm', 'put-parameter', '--name', 'pk', '--value', f'file://{tmp_path}/missing_sk',
+        '--type', 'SecureString'])
+    assert (out, code) == ('', 255)
+### -------------------------------------------------------------------------------
+
+
+def test_s3_move_file(backend, tmp_path):
+    content = b'branch_name: b1\nissue_number: 1\nfile: ato/jdoe.yaml\n'
+    target = str(tmp_path / 'users' / 'jdoe.yaml')
+    s3 = backend.stubbers['s3']
+    s3.add_response('head_object', {'ContentLength': len(content), 'ETag': '"e1"'},
+                    {'Bucket': 'bk', 'Key': 'jdoe.yaml'})
+    s3.add_response('get_object', {'Body': StreamingBody(io.BytesIO(content), len(content)),
+                                   'ContentLength': len(content), 'ETag': '"e1"'},
+                    None)   ### The s3transfer version decides on the IfMatch
+    s3.add_response('delete_object', {}, {'Bucket': 'bk', 'Key': 'jdoe.yaml'})
+    (out, err, code) = backend.execute('S3_MOVE_FILE', ['aws', 's3', 'mv', 's3://bk/jdoe.yaml', target])
+    assert (out, err, code) == (f'move: s3://bk/jdoe.yaml to {target}\n', '', 0)
+    with open(target, 'rb') as stream:
+        assert stream.read() == content
+### -------------------------------------------------------------------------------
+
+
+def test_s3_move_missing_file_is_1(backend, tmp_path):
+    backend.stubbers['s3'].add_client_error('head_object', service_error_code='404',
+                                            service_message='Not Found', http_status_code=404)
+    (out, err, code) = backend.execute('S3_MOVE_FILE', [
+        'aws', 's3', 'mv', 's3://bk/gone.yaml', str(tmp_path / 'gone.yaml')])
+    assert (out, code) == ('', 1)
+    assert err.startswith('fatal error: An error occurred (404) when calling the HeadObject operation')
+### -------------------------------------------------------------------------------
+
+
+def test_s3_head_object_missing_is_254(backend):
+    backend.stubbers['s3'].add_client_error('head_object', service_error_code='404',
+                                            service_message='Not Found', http_status_code=404)
+    (out, err, code) = backend.execute('S3_FILE_EXISTS', [
+        'aws', 's3api', 'head-object', '--bucket', 'bk', '--key', 'gone.yaml'])
+    assert (out, code) == ('', 254)
+### -------------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize(('name', 'backend_class'), [
+    ('boto3', Boto3Backend),
+    ('stub', StubBackend),
+    ('cli', CommandBackend),
+    ('', CommandBackend),
+])
+def test_make_backend(name, backend_class):
+    backend = make_backend(EnvConfig({'env': {'bat': {'command-backend': name}, 'aws': {'region': 'us-east-1'}}}))
+    assert type(backend) is backend_class
+### -------------------------------------------------------------------------------
+
+
+def test_make_backend_without_boto3(monkeypatch):
+    monkeypatch.setattr(ops_backend, 'boto3', None)
+    backend = make_backend(EnvConfig({'env': {'bat': {'command-backend': 'boto3'}}}))
+    assert type(backend) is CommandBackend
+    assert not backend.supports('IDP_READ_USER')
+### -------------------------------------------------------------------------------
@@ -0,0 +1,185 @@
+# =================================================================================
+# Tests of the outcomes of the offboarding (delete-user) of the users of a request
+# and of the de-duplication of the staged S3 files:
+#   python -m pytest -q test_ops_common.py
+# The commands are answered by the StubBackend, nothing is run
+import json
+import os
+import uuid
+
+import pytest
+
+# Local ---------------------------------------------------------------------------
+import ops_common
+from ops_backend import StubBackend, parse_cli_options, set_backend
+from ops_common import (USER_DONE, USER_FAILED, USER_SKIPPED, CommandEC2, delete_users, get_lookup_state,
+                        stage_s3_file)
+from ops_fabric_ca import format_ca_identity
+from ops_store import DedupStore
+from ops_yaml import APP, EnvConfig, RequestConfig, UserConfig
+#==================================================================================
+
+SSM_PREFIX = '/nist/blossom/dev/user/'
+NOT_FOUND = ('', 'An error occurred (UserNotFoundException) when calling the AdminGetUser operation: '
+                 'User does not exist.', 254)
+THROTTLED = ('', 'An error occurred (TooManyRequestsException) when calling the AdminGetUser operation: '
+                 'Rate exceeded', 254)
+### -------------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize(('command_id', 'outcome', 'state'), [
+    (CommandEC2.IDP_READ_USER, ('{}', '', 0), 'present'),
+    (CommandEC2.IDP_READ_USER, NOT_FOUND, 'absent'),
+    (CommandEC2.IDP_READ_USER, THROTTLED, 'failed'),
+    (CommandEC2.IDP_READ_USER, ('', 'Circuit open', 1), 'failed'),
+    (CommandEC2.AMB_READ_USER, ('Name: jdoe', '', 0), 'present'),
+    (CommandEC2.AMB_READ_USER, ('', 'Error: Response from server: Error Code: 63 - Failed to get User', 1), 'absent'),
+    (CommandEC2.AMB_READ_USER, ('', 'Error: Response from server: Error Code: 20 - Authentication failure', 1), 'failed'),
+    (CommandEC2.AMB_READ_USER, NOT_FOUND, 'failed'),
+    (CommandEC2.IDP_READ_USER, None, 'failed'),
+])
+def test_get_lookup_state(command_id, outcome, state):
+    assert get_lookup_state(command_id, outcome) == state
+### -------------------------------------------------------------------------------
+
+
+class Services:
+    """ The Cognito users, the Fabric-CA identities and the answers of their commands
+    """
+    def __init__(self, cognito: dict, identities: list[str]):
+        self.cognito = cognito
+        self.identities = identities
+        self.idp_failures = set()
+        self.ssm_failure = False
+        self.backend = StubBackend({
+            'IDP_READ_USER': self.idp_read_user,
+            'AMB_LIST_USERS': self.amb_list_users,
+            'IDP_DELETE_USER': self.idp_delete_user,
+            'AMB_REMOVE_USER': ('', '', 0),
+            'SSM_DELETE_PARAMS': self.ssm_delete_params})
+
+    def idp_read_user(self, command: list[str]) -> tuple:
+        user_id = parse_cli_options(command)['username'][0]
+        if user_id in self.idp_failures:
+            return THROTTLED
+        if user_id not in self.cognito:
+            return NOT_FOUND
+        return (json.dumps({'Username': user_id,
+                            'UserAttributes': [{'Name': 'sub', 'Value': self.cognito[user_id]}]}), '', 0)
+
+    def amb_list_users(self, command: list[str]) -> tuple:
+        return (''.join(format_ca_identity({'id': identity_id, 'type': 'client', 'affiliation': '',
+                                            'max_enrollments': -1, 'attrs': []})
+                        for identity_id in self.identities), '', 0)
+
+    def idp_delete_user(self, command: list[str]) -> tuple:
+        self.cognito.pop(parse_cli_options(command)['username'][0], None)
+        return ('', '', 0)
+
+    def ssm_delete_params(self, command: list[str]) -> tuple:
+        if self.ssm_failure:
+            return ('', 'An error occurred (AccessDeniedException) when calling the DeleteParameters operation', 254)
+        return (json.dumps({'DeletedParameters': parse_cli_options(command)['names'], 'InvalidParameters': []}), '', 0)
+
+    def get_calls(self, command_key: str) -> list[list[str]]:
+        return [command for (key, command) in self.backend.calls if key == command_key]
+### -------------------------------------------------------------------------------
+
+
+@pytest.fixture
+def envInfo(tmp_path):
+    work_dir = str(tmp_path)
+    env = EnvConfig({'env': {
+        'bat': {'user-dir': f'{work_dir}/users', 'work-dir': work_dir, 'logs-dir': f'{work_dir}/logs',
+                'state-db': f'{work_dir}/state.sqlite', 'log-at': 'ALL', 'print-at': 'PROD'},
+        'git': {'repo': f'{work_dir}/origin', 'repo-dir': f'{work_dir}/repo', 'ssp': 'ssp.xml'},
+        'aws': {'s3-drop-name': 'bk', 's3-drop-url': 's3://bk/', 'idp-pool': 'pool', 'ssm-prefix': SSM_PREFIX},
+        'amb': {'tls-cert': f'{work_dir}/tls.pem'}}})
+    ops_common.init_runners(env)
+    yield env
+    set_backend(None)
+### -------------------------------------------------------------------------------
+
+
+def offboard(envInfo: EnvConfig, services: Services, user_ids: list[str]) -> dict:
+    set_backend(services.backend)
+    recInfo = RequestConfig({'branch_name': 'b1', 'issue_number': '1', 'command': 'delete-user',
+                             'files': [f'ato/created_users/{user_id}_deleted_user.yaml' for user_id in user_ids]})
+    userInfos = {user_id: UserConfig({'command': 'delete-user',
+                                      'user': {'username': user_id, 'name': 'John Doe',
+                                               'email-address': f'{user_id}@example.org',
+                                               'role': 'Authorizing Official'}})
+                 for user_id in user_ids}
+    return delete_users(envInfo, recInfo, userInfos)
+### -------------------------------------------------------------------------------
+
+
+def test_delete_users_outcomes(envInfo):
+    party_uuid = str(uuid.uuid4())
+    services = Services({'jdoe': party_uuid}, ['jdoe', 'asmith'])
+    services.idp_failures.add('bjones')
+    results = offboard(envInfo, services, ['jdoe', 'asmith', 'cwhite', 'bjones'])
+
+    assert results['jdoe'] == (USER_DONE, 'jdoe removed from: SSP, IDP, AMB', party_uuid)
+    assert results['asmith'] == (USER_DONE, 'asmith removed from: AMB', '')
+    assert results['cwhite'] == (USER_SKIPPED, 'cwhite is in neither Cognito nor the Fabric-CA', '')
+    assert results['bjones'] == (USER_FAILED, 'bjones: IDP lookup failed', '')
+    assert services.cognito == {}
+    assert len(services.get_calls('AMB_LIST_USERS')) == 1
+    assert len(services.get_calls('AMB_REMOVE_USER')) == 2
+    ### The SSM entries of every user not failed, also of the one found nowhere
+    names = [name for command in services.get_calls('SSM_DELETE_PARAMS')
+             for name in parse_cli_options(command)['names']]
+    assert sorted({name[len(SSM_PREFIX):].split('/')[0] for name in names}) == ['asmith', 'cwhite', 'jdoe']
+### -------------------------------------------------------------------------------
+
+
+def test_delete_users_ssm_failure(envInfo):
+    services = Services({}, ['jdoe'])
+    services.ssm_failure = True
+    results = offboard(envInfo, services, ['jdoe', 'cwhite'])
+
+    for user_id in ('jdoe', 'cwhite'):
+        (status, message, _) = results[user_id]
+        assert status == USER_FAILED
+        assert f'{CommandEC2.SSM_DELETE_PARAMS.cmd_key()} failed with code 254' in message
+### -------------------------------------------------------------------------------
+
+
+def test_delete_users_print_only(envInfo, monkeypatch):
+    monkeypatch.setattr(APP, 'CMD_ONLY_PRINT', True)
+    services = Services({'jdoe': str(uuid.uuid4())}, ['jdoe'])
+    assert offboard(envInfo, services, ['jdoe']) == {'jdoe': (USER_SKIPPED, 'Commands printed only', '')}
+    assert services.backend.calls == []
+### -------------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize('head', [
+    {'ETag': '"0123456789abcdef0123456789abcdef-2"', 'VersionId': 'v1'},
+    {'ETag': '"fedcba9876543210fedcba9876543210"'},
+])
+def test_stage_s3_file_after_the_move(envInfo, head):
+    """ The duplicate run finds the S3 file moved by the first one: the same key, skipped
+    """
+    s3_file = 'jdoe_request.yaml'
+    content = 'branch_name: b1\nissue_number: 1\nfile: ato/created_users/jdoe_created_user.yaml\n'
+    moved = []
+
+    def s3_mv(command: list[str]) -> tuple:
+        with open(command[-1], 'w') as stream:
+            stream.write(content)
+        moved.append(command[-1])
+        return ('', '', 0)
+
+    set_backend(StubBackend({
+        'S3_FILE_EXISTS': lambda command: (json.dumps(head), '', 0) if not moved else ('', 'Not Found', 254),
+        'S3_MOVE_FILE': s3_mv}))
+    os.makedirs(envInfo.get_bat_user_dir(), exist_ok=True)
+    dedup = DedupStore(envInfo.get_bat_state_db())
+
+    (recInfo, dedup_key, ok) = stage_s3_file(s3_file, envInfo, dedup)
+    assert recInfo and ok and len(moved) == 1
+    (duplicate, duplicate_key, ok) = stage_s3_file(s3_file, envInfo, dedup)
+    assert (duplicate, duplicate_key, ok) == (None, dedup_key, True)
+    assert len(moved) == 1
+### -------------------------------------------------------------------------------
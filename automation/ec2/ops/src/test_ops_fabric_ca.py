@@ -0,0 +1,110 @@
+# =================================================================================
+# Tests of the Fabric-CA REST client against the local fake CA (ops_fake_ca.py):
+#   python -m pytest -q test_ops_fabric_ca.py
+import os
+
+import pytest
+
+pytest.importorskip('cryptography')
+
+# Local ---------------------------------------------------------------------------
+from ops_fabric_ca import (ERROR_NOT_FOUND, CaCredentials, FabricCaClient, FabricCaError,
+                           format_ca_identity, parse_ca_identities, read_msp_enrollment)
+from ops_fake_ca import REGISTRAR_ID, FakeCaServer
+#==================================================================================
+
+ATTRS = [{'name': 'blossom.role', 'value': 'Authorized', 'ecert': True}]
+### -------------------------------------------------------------------------------
+
+
+@pytest.fixture(scope='module')
+def server(tmp_path_factory):
+    srv = FakeCaServer(str(tmp_path_factory.mktemp('fake-ca'))).start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+### -------------------------------------------------------------------------------
+
+
+@pytest.fixture
+def client(server):
+    ca_client = FabricCaClient(server.url, server.tls_cert)
+    yield ca_client
+    ca_client.close()
+### -------------------------------------------------------------------------------
+
+
+@pytest.fixture
+def registrar(server):
+    return CaCredentials.from_msp(server.msp_dir)
+### -------------------------------------------------------------------------------
+
+
+def test_register_enroll_read_duplicate(server, client, registrar, tmp_path):
+    secret = client.register(registrar, 'jdoe', attrs=ATTRS)
+    assert secret and server.ca.identities['jdoe']['secret'] == secret
+
+    msp_dir = str(tmp_path / 'jdoe' / 'msp')
+    cert_file = client.enroll('jdoe', secret, msp_dir, attr_reqs=[{'name': 'blossom.role'}])
+    assert cert_file == os.path.join(msp_dir, 'signcerts', 'cert.pem')
+    assert os.listdir(os.path.join(msp_dir, 'cacerts'))
+    enrollment = read_msp_enrollment(msp_dir)
+    assert enrollment['id'] == 'jdoe'
+    assert enrollment['attrs'].get('blossom.role') == 'Authorized'
+
+    identity = client.get_identity(registrar, 'jdoe')
+    assert identity['id'] == 'jdoe' and identity['type'] == 'client'
+    assert {'name': 'blossom.role', 'value': 'Authorized', 'ecert': True} in identity['attrs']
+    assert 'secret' not in identity
+
+    with pytest.raises(FabricCaError) as info:
+        client.register(registrar, 'jdoe')
+    assert 'already registered' in info.value.message
+### -------------------------------------------------------------------------------
+
+
+def test_enrolled_identity_signs_requests(client, registrar, tmp_path):
+    secret = client.register(registrar, 'asmith', secret='asmithpw')
+    assert secret == 'asmithpw'
+    msp_dir = str(tmp_path / 'asmith' / 'msp')
+    client.enroll('asmith', secret, msp_dir)
+    ### The token of the new MSP is accepted like the one of the registrar
+    assert client.get_identity(CaCredentials.from_msp(msp_dir), 'asmith')['id'] == 'asmith'
+### -------------------------------------------------------------------------------
+
+
+def test_unknown_identity(client, registrar):
+    with pytest.raises(FabricCaError) as info:
+        client.get_identity(registrar, 'nobody')
+    assert info.value.code == ERROR_NOT_FOUND
+### -------------------------------------------------------------------------------
+
+
+def test_wrong_secret(client, registrar, tmp_path):
+    client.register(registrar, 'bjones', secret='bjonespw')
+    with pytest.raises(FabricCaError):
+        client.enroll('bjones', 'wrong', str(tmp_path / 'msp'))
+### -------------------------------------------------------------------------------
+
+
+def test_modify_and_remove(client, registrar):
+    client.register(registrar, 'cwhite', attrs=ATTRS)
+    identity = client.modify_identity(registrar, 'cwhite', [{'name': 'blossom.role', 'value': ''}])
+    assert not [attr for attr in identity['attrs'] if attr['name'] == 'blossom.role']
+    assert client.remove_identity(registrar, 'cwhite')['id'] == 'cwhite'
+    with pytest.raises(FabricCaError) as info:
+        client.get_identity(registrar, 'cwhite')
+    assert info.value.code == ERROR_NOT_FOUND
+### -------------------------------------------------------------------------------
+
+
+def test_identities_keep_alive(server, client, registrar):
+    identities = client.get_identities(registrar)
+    assert REGISTRAR_ID in [identity['id'] for identity in identities]
+    for _ in range(5):
+        client.get_identity(registrar, REGISTRAR_ID)
+    assert client.connections == 1
+    ### The text of 'fabric-ca-client identity list' parses back to the same identities
+    text = ''.join(format_ca_identity(identity) for identity in identities)
+    assert sorted(parse_ca_identities(text)) == sorted(identity['id'] for identity in identities)
+### -------------------------------------------------------------------------------
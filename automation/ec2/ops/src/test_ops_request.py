@@ -0,0 +1,104 @@
+# =================================================================================
+# Tests of the request-file codec:
+#   python -m pytest -q test_ops_request.py
+import pytest
+
+# Local ---------------------------------------------------------------------------
+from ops_request import (COMMANDS, LIST_KEY, REQUIRED_KEYS, RequestFormatError,
+                         check_request, parse_request, validate_request)
+#==================================================================================
+
+REQUEST = ('branch_name: account-request\n'
+           'file: ato/created_users/jdoe_created_user.yaml\n'
+           'issue_number: 42\n')
+### -------------------------------------------------------------------------------
+
+
+def test_parse_flat_map():
+    assert parse_request(REQUEST) == {'branch_name': 'account-request',
+                                      'file': 'ato/created_users/jdoe_created_user.yaml',
+                                      'issue_number': '42'}
+### -------------------------------------------------------------------------------
+
+
+def test_parse_comments_quotes_and_markers():
+    content = ('---\n'
+               '# The request of jdoe\n'
+               'branch_name: "account-request"  # quoted\n'
+               "file: 'ato/a #b.yaml'\n"
+               'issue_number: 42 # trailing\n'
+               'empty:\n'
+               '...\n')
+    assert parse_request(content) == {'branch_name': 'account-request',
+                                      'file': 'ato/a #b.yaml',
+                                      'issue_number': '42',
+                                      'empty': ''}
+### -------------------------------------------------------------------------------
+
+
+def test_parse_bytes_with_bom():
+    assert parse_request(b'\xef\xbb\xbf' + REQUEST.encode('utf-8')) == parse_request(REQUEST)
+### -------------------------------------------------------------------------------
+
+
+def test_parse_files_list():
+    content = ('branch_name: team-request\n'
+               'files:\n'
+               '  - ato/created_users/jdoe_created_user.yaml\n'
+               '  - "ato/created_users/asmith_created_user.yaml"  # quoted\n'
+               '  -\n'
+               'issue_number: 7\n')
+    request = parse_request(content)
+    assert request[LIST_KEY] == ['ato/created_users/jdoe_created_user.yaml',
+                                 'ato/created_users/asmith_created_user.yaml']
+    assert request['issue_number'] == '7'
+### -------------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize('content', [
+    'branch_name:\n  nested: value\n',
+    'items:\n  - not-the-files-list\n',
+    'no separator\n',
+    'key:value\n',
+    b'file: \xff\n',
+])
+def test_parse_rejects(content):
+    with pytest.raises(RequestFormatError):
+        parse_request(content)
+### -------------------------------------------------------------------------------
+
+
+def test_validate_valid():
+    assert validate_request(parse_request(REQUEST)) == []
+### -------------------------------------------------------------------------------
+
+
+def test_validate_missing_keys():
+    assert validate_request(None) == [f'Missing {key}' for key in REQUIRED_KEYS]
+    assert validate_request({'branch_name': 'b', 'file': ' ', 'issue_number': '1'}) == ['Missing file']
+### -------------------------------------------------------------------------------
+
+
+def test_validate_files_replace_file():
+    request = {'branch_name': 'b', 'issue_number': '1', LIST_KEY: ['a.yaml', 'b.yaml']}
+    assert validate_request(request) == []
+    request[LIST_KEY] = ['a.yaml', ' ']
+    assert validate_request(request) == [f'The {LIST_KEY} must be a list of the user files']
+### -------------------------------------------------------------------------------
+
+
+def test_validate_command():
+    request = parse_request(REQUEST)
+    for command in COMMANDS:
+        assert validate_request({**request, 'command': command}) == []
+    errors = validate_request({**request, 'command': 'drop-user'})
+    assert len(errors) == 1 and 'drop-user' in errors[0]
+### -------------------------------------------------------------------------------
+
+
+def test_check_request():
+    assert check_request(REQUEST) == (parse_request(REQUEST), [])
+    assert check_request('issue_number: 42\n') == ({'issue_number': '42'}, ['Missing branch_name', 'Missing file'])
+    (request, errors) = check_request('branch_name:\n  nested: value\n')
+    assert request == {} and errors == ['Line 2: nested values are not supported']
+### -------------------------------------------------------------------------------
@@ -0,0 +1,109 @@
+# =================================================================================
+# Tests of the de-duplication store of the S3 notifications:
+#   python -m pytest -q test_ops_store.py
+import time
+
+import pytest
+
+# Local ---------------------------------------------------------------------------
+import ops_store
+from ops_store import DedupStore
+from ops_yaml import EnvConfig
+#==================================================================================
+
+KEY = DedupStore.get_dedup_key('blossom-bucket', 'requests/jdoe.yaml', 'v1')
+### -------------------------------------------------------------------------------
+
+
+class Clock:
+    """ The time.time() of the store, moved by the test
+    """
+    def __init__(self):
+        self.now = time.time()
+
+    def __call__(self) -> float:
+        return self.now
+### -------------------------------------------------------------------------------
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock()
+    monkeypatch.setattr(ops_store.time, 'time', fake)
+    return fake
+### -------------------------------------------------------------------------------
+
+
+@pytest.fixture(params=['memory', 'file'])
+def store(request, tmp_path):
+    dedup = DedupStore(':memory:' if request.param == 'memory' else str(tmp_path / 'state' / 'ops.db'))
+    yield dedup
+    dedup.close()
+### -------------------------------------------------------------------------------
+
+
+def test_claim_once(store, clock):
+    assert store.claim(KEY, 60)
+    assert store.get_state(KEY) == DedupStore.IN_FLIGHT
+    assert not store.claim(KEY, 60)
+    assert store.claim(DedupStore.get_dedup_key('blossom-bucket', 'requests/jdoe.yaml', 'v2'), 60)
+### -------------------------------------------------------------------------------
+
+
+def test_release_allows_the_retry(store, clock):
+    assert store.claim(KEY, 60)
+    store.release(KEY)
+    assert store.get_state(KEY) == ''
+    assert store.claim(KEY, 60)
+### -------------------------------------------------------------------------------
+
+
+def test_lease_expires(store, clock):
+    assert store.claim(KEY, 60)
+    clock.now += 59
+    assert not store.claim(KEY, 60)
+    ### A killed run does not block the file beyond its lease
+    clock.now += 2
+    assert store.get_state(KEY) == ''
+    assert store.claim(KEY, 60)
+### -------------------------------------------------------------------------------
+
+
+def test_done_lives_for_the_ttl(store, clock):
+    assert store.claim(KEY, 60)
+    store.mark_done(KEY, 3600)
+    assert store.get_state(KEY) == DedupStore.DONE
+    clock.now += 61
+    assert not store.claim(KEY, 60)
+    clock.now += 3600
+    assert store.purge_expired() == 1
+    assert store.claim(KEY, 60)
+### -------------------------------------------------------------------------------
+
+
+def test_stores_share_the_file(tmp_path, clock):
+    db_file = str(tmp_path / 'ops.db')
+    (first, second) = (DedupStore(db_file), DedupStore(db_file))
+    try:
+        assert first.claim(KEY, 60)
+        assert not second.claim(KEY, 60)
+        first.release(KEY)
+        assert second.claim(KEY, 60)
+    finally:
+        first.close()
+        second.close()
+### -------------------------------------------------------------------------------
+
+
+@pytest.mark.parametrize(('bat', 'ttl', 'lease'), [
+    ({}, 86400, 3600),
+    ({'dedup-ttl': 0, 'dedup-lease': 600}, 0, 600),
+    ({'dedup-ttl': '0'}, 0, 3600),
+    ({'dedup-ttl': ''}, 86400, 3600),
+    ({'dedup-ttl': 7200}, 7200, 3600),
+])
+def test_env_dedup_settings(bat, ttl, lease):
+    envInfo = EnvConfig({'env': {'bat': bat}})
+    assert envInfo.get_bat_dedup_ttl() == ttl
+    assert envInfo.get_bat_dedup_lease() == lease
+### -------------------------------------------------------------------------------